@@ -0,0 +1,279 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import secrets
+import threading
+import time
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import HumanMessage, ToolMessage
+from langgraph.types import Command
+
+import doctor_appointment as app
+from fakes import LocalSMTPSink, ScriptedChatModel
+
+# Load benchmark
+# Drives simulated patients, admins and guests through scripted conversations against
+# the compiled graph, concurrently, with a scripted chat model standing in for the LLM
+# and a LocalSMTPSink standing in for Gmail. The model goes to the graph through each
+# run's config and mail through the benchmark's own outbox worker, so nothing else in
+# the process changes. The database is whatever DATABASE_URL points at, so run it
+# against a scratch SQLite file or Postgres database: the doctors, users and
+# appointments it creates are tagged with the run id and left in place.
+
+BENCHMARK_MODEL = os.getenv("BENCHMARK_MODEL", "fake:default")
+BENCHMARK_DOCTORS = 10  # fresh doctors per run, so bookings never collide with earlier runs
+BENCHMARK_PASSWORD = "bench-password"
+
+
+def percentiles(samples: List[float]) -> Dict[str, Any]:
+    """
+    Count and nearest-rank p50/p95/p99/max of durations in seconds, reported in milliseconds.
+    """
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def rank(p: float) -> float:
+        return round(ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)] * 1000, 2)
+
+    return {"count": len(ordered), "p50": rank(50), "p95": rank(95), "p99": rank(99), "max": rank(100)}
+
+
+class NodeTimer(BaseCallbackHandler):
+    """
+    Callback handler recording how long each graph node run takes.
+    """
+
+    run_inline = True  # time on the node's own thread/loop, not a callback executor
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self._started: Dict[Any, tuple] = {}
+        self._lock = threading.Lock()
+
+    def on_chain_start(self, serialized, inputs, *, run_id, tags=None, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        # Node runs are the graph's direct steps; routers and inner runnables share the metadata
+        if node and kwargs.get("name") == node and any(tag.startswith("graph:step:") for tag in tags or []):
+            self._started[run_id] = (node, time.perf_counter())
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)  # includes interrupts, which end a node run normally
+
+    def _finish(self, run_id) -> None:
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            node, began = started
+            with self._lock:
+                self.samples.setdefault(node, []).append(time.perf_counter() - began)
+
+
+class LoadBenchmark:
+    """
+    One benchmark run: sets up doctors and admin accounts, runs every simulated
+    conversation through graph.ainvoke with at most `concurrency` in flight,
+    and reports throughput, latencies, DB statement counts and email delivery.
+    """
+
+    def __init__(self, patients: int = 20, admins: int = 2, guests: int = 20, concurrency: int = 10,
+                 model: str = BENCHMARK_MODEL, model_latency: float = 0.0, sink: Optional[LocalSMTPSink] = None):
+        self.patients = patients
+        self.admins = admins
+        self.guests = guests
+        self.concurrency = concurrency
+        self.model = model
+        self.model_latency = model_latency
+        self.sink = sink
+        self.chat_model = None
+        self.run_id = secrets.token_hex(4)
+        self.timer = NodeTimer()
+        self.turns: Dict[str, List[float]] = {}
+        self.errors: List[str] = []
+        self.doctor_ids: List[int] = []
+        self.admin_sessions: List[str] = []
+        self.first_day = app.datetime.now(app.CLINIC_TIMEZONE).date() + timedelta(days=30)
+
+    def setup(self) -> None:
+        """
+        Builds the benchmark model and creates the run's doctors and admins.
+        """
+        self.chat_model = app.chat_model(self.model)
+        if isinstance(self.chat_model, ScriptedChatModel):
+            self.chat_model = self.chat_model.model_copy(update={"latency": self.model_latency})
+        self.doctor_ids = [app.add_doctor(f"Bench {self.run_id} {i}", "Cardiologist", True).id for i in range(BENCHMARK_DOCTORS)]
+        for i in range(self.admins):
+            username = f"bench_admin_{self.run_id}_{i}"
+            app.signup(username, BENCHMARK_PASSWORD, "admin", f"{username}@bench.local")
+            self.admin_sessions.append(app.create_session(username, BENCHMARK_PASSWORD))
+
+    def conversation_turns(self, role: str, index: int) -> List[tuple]:
+        """
+        The (turn name, message) pairs one simulated user sends. A message may be a
+        callable taking what the conversation learnt so far.
+        """
+        if role == "patient":
+            username = f"bench_{self.run_id}_{index}"
+            slot = index // BENCHMARK_DOCTORS
+            day = self.first_day + timedelta(days=slot // 8)
+            return [
+                ("signup", f"Sign up as {username} with password {BENCHMARK_PASSWORD} and email {username}@bench.local"),
+                ("search", "Find me a cardiologist"),
+                ("book", f"Book doctor {self.doctor_ids[index % BENCHMARK_DOCTORS]} for {username} ({username}@bench.local) "
+                         f"on {day.isoformat()} at {9 + slot % 8:02d}:00"),
+                ("cancel", lambda learnt: f"Cancel appointment {learnt['appointment_id']}"),
+            ]
+        if role == "admin":
+            return [("list_doctors", "Show me all doctors"), ("search", "Find me a heart doctor")]
+        return [("faq", "Which doctors do you have?"), ("search", "Find me a cardiologist")]
+
+    async def conversation(self, role: str, index: int, gate: asyncio.Semaphore) -> None:
+        config = {
+            "configurable": {"thread_id": f"bench-{self.run_id}-{role}-{index}", "chat_model": self.chat_model},
+            "callbacks": [self.timer],
+        }
+        session = self.admin_sessions[index % len(self.admin_sessions)] if role == "admin" and self.admin_sessions else None
+        learnt: Dict[str, Any] = {}
+        async with gate:
+            for name, message in self.conversation_turns(role, index):
+                try:
+                    if callable(message):
+                        message = message(learnt)
+                    graph_input = {"messages": [HumanMessage(content=message)]}
+                    if session:
+                        graph_input["session"] = session
+                    result = await self.timed(f"{role}:{name}", app.graph.ainvoke(graph_input, config))
+                    if result.get("__interrupt__"):
+                        result = await self.timed(f"{role}:{name}:resume", app.graph.ainvoke(Command(resume="yes"), config))
+                    for tool_message in result["messages"]:
+                        if isinstance(tool_message, ToolMessage) and tool_message.name == "book_appointment":
+                            learnt["appointment_id"] = json.loads(tool_message.content)["appointment_id"]
+                except Exception as e:
+                    self.errors.append(f"{role} {index} {name}: {e!r}")
+                    return
+
+    async def timed(self, name: str, call):
+        began = time.perf_counter()
+        try:
+            return await call
+        finally:
+            self.turns.setdefault(name, []).append(time.perf_counter() - began)
+
+    async def run_conversations(self) -> None:
+        gate = asyncio.Semaphore(self.concurrency)
+        conversations = (
+            [("patient", i) for i in range(self.patients)]
+            + [("admin", i) for i in range(self.admins)]
+            + [("guest", i) for i in range(self.guests)]
+        )
+        await asyncio.gather(*(self.conversation(role, index, gate) for role, index in conversations))
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Runs the benchmark and returns the report.
+        """
+        if app.outbox_worker is not None:
+            raise RuntimeError("Set EMAIL_OUTBOX_WORKER=off: the in-process outbox worker would mail the run's patients over SMTP_HOST.")
+        sink = self.sink or LocalSMTPSink().start()
+        pool = app.SMTPPool(host="127.0.0.1", port=sink.port, use_ssl=False)
+        worker = app.OutboxWorker(pool=pool, poll_interval=0.2).start()
+        try:
+            self.setup()
+            queries_before = self.query_counts()
+            began = time.perf_counter()
+            asyncio.run(self.run_conversations())
+            wall_seconds = time.perf_counter() - began
+            queries = {verb: count - queries_before.get(verb, 0) for verb, count in self.query_counts().items()}
+            queries = {verb: count for verb, count in queries.items() if count}
+            # Confirmation emails go out through the outbox; give the worker a moment to drain it
+            expected_emails = len(self.turns.get("patient:book:resume", []))
+            deadline = time.monotonic() + 10 * worker.poll_interval + 5
+            while len(self.delivered(sink)) < expected_emails and time.monotonic() < deadline:
+                time.sleep(0.1)
+        finally:
+            worker.stop()
+            pool.close()
+            if sink is not self.sink:
+                sink.stop()
+
+        turn_count = sum(len(samples) for samples in self.turns.values())
+        total_queries = sum(queries.values())
+        return {
+            "run_id": self.run_id,
+            "started_at": app.utcnow().isoformat(),
+            "config": {
+                "patients": self.patients, "admins": self.admins, "guests": self.guests,
+                "concurrency": self.concurrency, "model": self.model, "model_latency": self.model_latency,
+                "database": app.engine.dialect.name,
+            },
+            "wall_seconds": round(wall_seconds, 3),
+            "throughput": {
+                "conversations_per_second": round((self.patients + self.admins + self.guests) / wall_seconds, 2),
+                "turns_per_second": round(turn_count / wall_seconds, 2),
+            },
+            "errors": len(self.errors),
+            "error_samples": self.errors[:10],
+            "turns": {name: percentiles(samples) for name, samples in sorted(self.turns.items())},
+            "nodes": {node: percentiles(samples) for node, samples in sorted(self.timer.samples.items())},
+            "db": {"queries": queries, "total": total_queries, "per_turn": round(total_queries / turn_count, 2) if turn_count else 0},
+            "emails": {"expected": expected_emails, "delivered": len(self.delivered(sink))},
+        }
+
+    def delivered(self, sink: LocalSMTPSink) -> list:
+        # Only this run's patients; the outbox may also hold mail queued before the run
+        return [message for message in sink.messages if f"_{self.run_id}_" in str(message["To"])]
+
+    @staticmethod
+    def query_counts() -> Dict[str, int]:
+        counts = dict(app.engine_metrics.stats()["queries"])
+        for verb, count in app.async_engine_metrics.stats()["queries"].items():
+            counts[verb] = counts.get(verb, 0) + count
+        return counts
+
+
+def compare_benchmarks(report: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """
+    Lines comparing a report's throughput, node p95s and queries per turn to a baseline report.
+    """
+
+    def change(now: float, then: float) -> str:
+        return f"{then} -> {now} ({(now - then) / then * 100:+.1f}%)" if then else f"{then} -> {now}"
+
+    lines = [f"turns/s: {change(report['throughput']['turns_per_second'], baseline['throughput']['turns_per_second'])}"]
+    for node, stats in report["nodes"].items():
+        if "p95" in stats and "p95" in baseline["nodes"].get(node, {}):
+            lines.append(f"{node} p95 ms: {change(stats['p95'], baseline['nodes'][node]['p95'])}")
+    lines.append(f"queries/turn: {change(report['db']['per_turn'], baseline['db']['per_turn'])}")
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the graph with simulated conversations and a scripted model.")
+    parser.add_argument("--patients", type=int, default=20)
+    parser.add_argument("--admins", type=int, default=2)
+    parser.add_argument("--guests", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--model", default=BENCHMARK_MODEL, help="provider:model spec, e.g. fake:default or fake:script.json.")
+    parser.add_argument("--model-latency", type=float, default=0.0, help="Seconds the fake model waits per reply.")
+    parser.add_argument("--output", help="Write the JSON report here.")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare against.")
+    args = parser.parse_args()
+
+    if app.outbox_worker is not None:
+        app.outbox_worker.stop()  # the benchmark drains the outbox into its own sink
+        app.outbox_worker = None
+    report = LoadBenchmark(args.patients, args.admins, args.guests, args.concurrency, args.model, args.model_latency).run()
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as destination:
+            json.dump(report, destination, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as source:
+            print("\n".join(compare_benchmarks(report, json.load(source))))
@@ -1,22 +1,51 @@
-from langchain_core.messages import SystemMessage
-from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, ToolMessage, RemoveMessage, message_chunk_to_message
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.language_models import BaseChatModel
+from langchain_core.exceptions import ModelAPIError, ModelConnectionError, ModelRateLimitError, ModelTimeoutError
 from langgraph.types import Command, interrupt
-from langgraph.graph import START, StateGraph, MessagesState
-from langgraph.prebuilt import tools_condition, ToolNode
+from langgraph.graph import START, END, StateGraph, MessagesState
+from langgraph.prebuilt import ToolNode, InjectedState
 from langgraph.graph.state import CompiledStateGraph
+from langgraph.config import get_stream_writer, get_config
+from langchain_core.runnables import RunnableLambda, RunnableConfig
 from typing import Dict,Any
-# tools definitions
-#==============================
-from sqlmodel import Session, select
-from typing import Optional,List
-import bcrypt
+import asyncio
+import logging
+import threading
+import time
+import functools
+import weakref
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone, date as calendar_date, time as clock_time
+import base64
+import json
+import secrets
+import random
+import re
+import difflib
+import csv
+import io
+import hmac
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from langchain_core.tools import StructuredTool, InjectedToolCallId
+from typing import Annotated, Iterable, Iterator
+from sqlalchemy import make_url, event, inspect, text, DateTime, Index, update, bindparam, or_, and_
+from sqlalchemy.schema import AddConstraint
+from zoneinfo import ZoneInfo
+from sqlalchemy.exc import IntegrityError, DBAPIError
+from sqlalchemy.dialects import postgresql, sqlite
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlmodel.ext.asyncio.session import AsyncSession
+from passwords import hash_password, verify_password, needs_rehash
+from sqlmodel import SQLModel, Field, create_engine, Session, select, Column, String
+from typing import Optional, List, Tuple
 from email.message import EmailMessage
 import smtplib
-
-
-from sqlmodel import SQLModel, Field, create_engine, Session, select, Column, String
-from typing import Optional
 import os
+# tools definitions
+#==============================
 # Define the path for the SQLite database in Google Drive
 db_path = "/local_database.db"
 
@@ -31,9 +60,135 @@ MAIL_PASSWORD = os.environ['MAIL_PASSWORD']
 DATABASE_URL = os.environ['DATABASE_URL']
 MEMORY_DATABASE = os.environ['DB_URL']
 
+# Background jobs and admin commands report progress here
+logger = logging.getLogger(__name__)
+
+
+
+# studio2/doctor.py and studio3/doctor_appointment.py keep copies of this block, since
+# each app is deployed on its own. Change the copies with it.
+# Connection pool settings for the domain database. Neon closes idle connections, so
+# connections are pre-pinged and recycled before the server drops them.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "300"))  # seconds
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+
+
+def create_db_engine(database_url, is_async: bool = False):
+    """
+    Creates the SQLAlchemy engine with pool sizing, pre-ping, recycle and
+    statement timeout taken from the environment.
+    """
+    url = make_url(database_url)
+    kwargs = {"pool_pre_ping": True, "pool_recycle": DB_POOL_RECYCLE}
+    if url.get_backend_name() != "sqlite":
+        kwargs.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+
+    new_engine = create_async_engine(url, **kwargs) if is_async else create_engine(url, **kwargs)
 
+    if url.get_backend_name() in ("postgres", "postgresql") and DB_STATEMENT_TIMEOUT_MS:
+        # Set per connection rather than via the `options` startup parameter,
+        # which Neon's pooled (PgBouncer) endpoints reject.
+        @event.listens_for(new_engine.sync_engine if is_async else new_engine, "connect")
+        def set_statement_timeout(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"SET statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+            cursor.close()
+            dbapi_connection.commit()
 
-engine = create_engine(DATABASE_URL)
+    return new_engine
+
+
+class PoolMetrics:
+    """
+    Counts pool checkouts, new connections, invalidations and executed statements
+    (by SQL verb), and how long connections stay checked out.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.held_seconds_total = 0.0
+        self.held_seconds_max = 0.0
+        self.queries: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+        event.listen(engine, "invalidate", self._on_invalidate)
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checked_out_at"] = time.monotonic()
+        with self._lock:
+            self.checkouts += 1
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop("checked_out_at", None)
+        with self._lock:
+            self.checkins += 1
+            if checked_out_at is not None:
+                held = time.monotonic() - checked_out_at
+                self.held_seconds_total += held
+                self.held_seconds_max = max(self.held_seconds_max, held)
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+    def _on_execute(self, connection, cursor, statement, parameters, context, executemany):
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        with self._lock:
+            self.queries[verb] = self.queries.get(verb, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the counters plus the pool's own status line.
+        """
+        with self._lock:
+            return {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checked_out": self.checkouts - self.checkins,
+                "invalidations": self.invalidations,
+                "queries": dict(self.queries),
+                "held_seconds_avg": self.held_seconds_total / self.checkins if self.checkins else 0.0,
+                "held_seconds_max": self.held_seconds_max,
+                "pool": self.engine.pool.status(),
+            }
+
+
+engine = create_db_engine(DATABASE_URL)
+engine_metrics = PoolMetrics(engine)
+
+
+def async_database_url(database_url: str):
+    """
+    Maps the sync DATABASE_URL onto the matching async driver
+    (psycopg 3 for Postgres/Neon, aiosqlite for local SQLite).
+    """
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if backend in ("postgres", "postgresql"):
+        return url.set(drivername="postgresql+psycopg")
+    if backend == "sqlite":
+        return url.set(drivername="sqlite+aiosqlite")
+    return url
+
+
+# Async engine used by the tool coroutines, so DB round-trips don't hold a worker thread
+async_engine = create_db_engine(async_database_url(DATABASE_URL), is_async=True)
+async_engine_metrics = PoolMetrics(async_engine.sync_engine)
+async_session = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
 
 
 # Function to set up the database
@@ -46,8 +201,6 @@ engine = create_engine(DATABASE_URL)
 # # Set up the database connection (SQLite stored in Google Drive)
 # engine = setup_database()
 
-from sqlmodel import SQLModel, Field, Column, String
-from typing import Optional
 from langgraph.checkpoint.memory import MemorySaver
 # SQLModel Schema for User
 class User(SQLModel, table=True):
@@ -59,6 +212,8 @@ class User(SQLModel, table=True):
 
 # SQLModel Schema for Doctor
 class Doctor(SQLModel, table=True):
+    __table_args__ = (Index("ux_doctor_name_specialty", "name", "specialty", unique=True),)
+
     id: Optional[int] = Field(default=None, primary_key=True)  # Doctor ID
     name: str  # Doctor's name
     specialty: str  # Doctor's specialty (e.g., 'Cardiologist')
@@ -66,14 +221,121 @@ class Doctor(SQLModel, table=True):
 
 # SQLModel Schema for Appointment
 class Appointment(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_appointment_doctor_id_start_time", "doctor_id", "start_time"),
+        Index("ix_appointment_patient_name_start_time", "patient_name", "start_time"),
+        Index("ix_appointment_status_id", "status", "id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)  # Appointment ID
-    doctor_id: int  # Foreign key to Doctor
+    doctor_id: int = Field(foreign_key="doctor.id", ondelete="RESTRICT")  # Foreign key to Doctor
     patient_name: str  # Patient's name
     patient_email: str  # Patient's email for notifications
     date: str  # Appointment date
     time: str  # Appointment time
     status: str = "Booked"  # Default status ("Booked", "Completed", "Cancelled", etc.)
     send_notification: bool = Field(default=False)  # Notification status
+    idempotency_key: Optional[str] = Field(default=None, sa_column=Column(String, unique=True, index=True))  # Tool call that booked it
+    start_time: Optional[datetime] = Field(default=None, sa_column=Column(DateTime(timezone=True)))  # Parsed from date + time
+    end_time: Optional[datetime] = Field(default=None, sa_column=Column(DateTime(timezone=True)))  # start_time + slot length
+
+
+# SQLModel Schema for a doctor's weekly working hours (one row per working block)
+class DoctorSchedule(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    doctor_id: int = Field(foreign_key="doctor.id", ondelete="CASCADE", index=True)
+    weekday: int  # 0 = Monday ... 6 = Sunday
+    opens: clock_time  # Start of the first slot, clinic local time
+    closes: clock_time  # No slot may end after this
+    slot_minutes: int = 30
+
+
+# SQLModel Schema for days (or parts of days) a doctor is not working
+class ScheduleException(SQLModel, table=True):
+    __table_args__ = (Index("ix_scheduleexception_doctor_id_day", "doctor_id", "day"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    doctor_id: int = Field(foreign_key="doctor.id", ondelete="CASCADE")
+    day: calendar_date
+    starts: Optional[clock_time] = None  # None blocks the whole day
+    ends: Optional[clock_time] = None
+    reason: Optional[str] = None
+
+
+def utcnow() -> datetime:
+    """
+    Current time as a timezone-aware UTC datetime.
+    """
+    return datetime.now(timezone.utc)
+
+
+# Appointment date/time strings are in the clinic's local time
+CLINIC_TIMEZONE = ZoneInfo(os.getenv("CLINIC_TIMEZONE", "UTC"))
+DEFAULT_SLOT_MINUTES = int(os.getenv("DEFAULT_SLOT_MINUTES", "30"))  # For doctors without a schedule
+MAX_AVAILABILITY_DAYS = int(os.getenv("MAX_AVAILABILITY_DAYS", "31"))
+
+DATE_FORMATS = ["%Y-%m-%d", "%d-%m-%Y", "%d/%m/%Y", "%m/%d/%Y", "%Y/%m/%d", "%B %d, %Y", "%b %d, %Y", "%d %B %Y", "%d %b %Y"]
+TIME_FORMATS = ["%H:%M", "%H:%M:%S", "%I:%M %p", "%I:%M%p", "%I %p", "%I%p"]
+
+
+def parse_date(value: str) -> Optional[calendar_date]:
+    """
+    Parses a date in any of DATE_FORMATS, or returns None.
+    """
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), date_format).date()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_clock_time(value: str) -> Optional[clock_time]:
+    """
+    Parses a time of day in any of TIME_FORMATS, or returns None.
+    """
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.strptime(value.strip().upper(), time_format).time()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_appointment_start(date: str, time: str) -> Optional[datetime]:
+    """
+    Parses the free-form appointment date and time into an aware datetime,
+    or returns None if either part isn't in a recognised format.
+    """
+    parsed_date = parse_date(date)
+    parsed_time = parse_clock_time(time)
+    if parsed_date is None or parsed_time is None:
+        return None
+    return datetime.combine(parsed_date, parsed_time, tzinfo=CLINIC_TIMEZONE)
+
+
+def as_clinic_time(value: datetime) -> datetime:
+    """
+    Normalises a stored timestamp to the clinic timezone. SQLite hands back
+    naive datetimes holding the clinic-local wall time that was written.
+    """
+    if value.tzinfo is None:
+        return value.replace(tzinfo=CLINIC_TIMEZONE)
+    return value.astimezone(CLINIC_TIMEZONE)
+
+
+# SQLModel Schema for queued emails (transactional outbox)
+class EmailOutbox(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    to_email: str
+    subject: str
+    body: str
+    status: str = Field(default="pending", index=True)  # "pending", "sending", "sent" or "failed"
+    attempts: int = 0
+    next_attempt_at: datetime = Field(default_factory=utcnow, index=True)
+    last_error: Optional[str] = None
+    created_at: datetime = Field(default_factory=utcnow)
+    sent_at: Optional[datetime] = None
 
 
 
@@ -83,17 +345,185 @@ def create_db_and_tables() -> None:
     """
     # Dropping and recreating all tables for a fresh start
     SQLModel.metadata.create_all(engine)
+    upgrade_schema()
     print("Database tables synced successfully.")
 
+
+def upgrade_schema() -> None:
+    """
+    Adds columns, indexes and foreign keys that were introduced after a table was
+    first created, since create_all only creates missing tables. New columns must be nullable.
+    Raises RuntimeError, changing nothing, if existing duplicates block a unique index.
+    """
+    inspector = inspect(engine)
+    missing_unique = []
+    with engine.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(engine.dialect)
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                    logger.info("Added column %s.%s", table.name, column.name)
+            for index in table.indexes:
+                try:
+                    with connection.begin_nested():
+                        index.create(connection, checkfirst=True)
+                except IntegrityError as e:
+                    missing_unique.append(f"{index.name}: {e.orig}")
+            # SQLite can't add constraints to an existing table
+            if engine.dialect.name == "postgresql":
+                existing_keys = {tuple(key["constrained_columns"]) for key in inspector.get_foreign_keys(table.name)}
+                for constraint in table.foreign_key_constraints:
+                    if tuple(constraint.column_keys) not in existing_keys:
+                        # NOT VALID: enforced for new rows without scanning (or failing on) old ones
+                        ddl = AddConstraint(constraint).compile(dialect=engine.dialect)
+                        connection.execute(text(f"{ddl} NOT VALID"))
+                        logger.info("Added foreign key on %s(%s)", table.name, ", ".join(constraint.column_keys))
+        if missing_unique:
+            # Rolls the whole upgrade back: code such as the doctor import relies on these indexes
+            raise RuntimeError(
+                "Could not create unique indexes because existing rows repeat the indexed values. "
+                "Merge or rename the duplicates and restart.\n" + "\n".join(missing_unique)
+            )
+
 # Create database tables
 create_db_and_tables()
 
+
+def backfill_appointment_start_times(batch_size: int = 500) -> Dict[str, Any]:
+    """
+    Fills Appointment.start_time and end_time for rows written before the columns existed,
+    parsing their date/time strings one batch (and one short transaction) at a time.
+    Legacy rows get a DEFAULT_SLOT_MINUTES slot. Rows that can't be parsed are left
+    NULL and listed in the result.
+    """
+    updated = 0
+    unparsed: List[int] = []
+    last_id = 0
+    statement = (
+        update(Appointment)
+        .where(Appointment.id == bindparam("appointment_id"))
+        .values(start_time=bindparam("parsed_start"), end_time=bindparam("parsed_end"))
+    )
+    while True:
+        with Session(engine) as session:
+            rows = session.exec(
+                select(Appointment.id, Appointment.date, Appointment.time)
+                .where(or_(Appointment.start_time.is_(None), Appointment.end_time.is_(None)), Appointment.id > last_id)
+                .order_by(Appointment.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            params = []
+            for appointment_id, date, appointment_time in rows:
+                start = parse_appointment_start(date, appointment_time)
+                if start is None:
+                    unparsed.append(appointment_id)
+                else:
+                    params.append({
+                        "appointment_id": appointment_id,
+                        "parsed_start": start,
+                        "parsed_end": start + timedelta(minutes=DEFAULT_SLOT_MINUTES),
+                    })
+            if params:
+                session.connection().execute(statement, params)
+            session.commit()
+            updated += len(params)
+            logger.info("Backfilled %d appointments (up to id %d)", updated, last_id)
+    return {"updated": updated, "unparsed": unparsed}
+
 #==============================
-from sqlmodel import Session, select
-from typing import Optional,List
-import bcrypt
-from email.message import EmailMessage
-import smtplib
+
+# Password hashing
+# bcrypt costs ~100-300 ms of CPU per call, so hashing and checking run on a small
+# dedicated pool (threads by default; bcrypt releases the GIL) instead of the event
+# loop or ToolNode's worker threads, and a login burst queues there rather than
+# stalling other conversations. Hashes made with an old BCRYPT_ROUNDS are upgraded on
+# the next successful login, and repeated failures for a username are throttled
+# before any hashing is done. The bcrypt helpers themselves are in passwords.py.
+
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_EXECUTOR = os.getenv("PASSWORD_HASH_EXECUTOR", "thread")  # 'thread' or 'process'
+LOGIN_MAX_FAILURES = int(os.getenv("LOGIN_MAX_FAILURES", "5"))
+LOGIN_FAILURE_WINDOW = float(os.getenv("LOGIN_FAILURE_WINDOW", "300"))  # seconds
+LOGIN_THROTTLE_MAX_USERNAMES = int(os.getenv("LOGIN_THROTTLE_MAX_USERNAMES", "10000"))  # oldest dropped beyond this
+
+
+if PASSWORD_HASH_EXECUTOR == "process":
+    password_executor = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS)
+else:
+    password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+
+
+def run_password_job(func, *args):
+    return password_executor.submit(func, *args).result()
+
+
+async def arun_password_job(func, *args):
+    return await asyncio.wrap_future(password_executor.submit(func, *args))
+
+
+class LoginThrottle:
+    """
+    Counts failed logins per username over a sliding window and refuses further
+    attempts once LOGIN_MAX_FAILURES is reached, until the oldest failure ages out.
+    Usernames are kept in order of their latest failure, so expired ones are pruned
+    from the front on every failure and the table never tracks more than max_usernames.
+    """
+
+    def __init__(self, max_failures: int = LOGIN_MAX_FAILURES, window: float = LOGIN_FAILURE_WINDOW,
+                 max_usernames: int = LOGIN_THROTTLE_MAX_USERNAMES):
+        self.max_failures = max_failures
+        self.window = window
+        self.max_usernames = max_usernames
+        self._failures: OrderedDict = OrderedDict()  # username -> failure times, oldest latest-failure first
+        self._lock = threading.Lock()
+
+    def retry_after(self, username: str) -> float:
+        """
+        Seconds until username may try again, or 0 if it may try now.
+        """
+        now = time.monotonic()
+        with self._lock:
+            failures = [at for at in self._failures.get(username, []) if now - at < self.window]
+            if failures:
+                self._failures[username] = failures
+            else:
+                self._failures.pop(username, None)
+            if len(failures) < self.max_failures:
+                return 0
+            return self.window - (now - failures[0])
+
+    def failed(self, username: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._failures.setdefault(username, []).append(now)
+            self._failures.move_to_end(username)
+            while self._failures:
+                oldest, failures = next(iter(self._failures.items()))
+                if now - failures[-1] < self.window and len(self._failures) <= self.max_usernames:
+                    break
+                del self._failures[oldest]
+
+    def succeeded(self, username: str) -> None:
+        with self._lock:
+            self._failures.pop(username, None)
+
+
+login_throttle = LoginThrottle()
+
+
+def throttled_error(username: str) -> Optional[Dict[str, str]]:
+    wait = login_throttle.retry_after(username)
+    if wait:
+        return {"error": f"Too many failed attempts. Try again in {int(wait) + 1} seconds."}
+    return None
+
 
 # CRUD Operations for Users
 
@@ -108,7 +538,7 @@ def signup(username: str, password: str, role: str = 'user', email: str = '') ->
     if not email or '@' not in email:
         raise ValueError("Invalid email address.")
 
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    hashed_password = run_password_job(hash_password, password)
 
     with Session(engine) as session:
         if session.exec(select(User).where(User.username == username.lower())).first():
@@ -122,6 +552,31 @@ def signup(username: str, password: str, role: str = 'user', email: str = '') ->
         session.refresh(user)
         return user
 
+async def asignup(username: str, password: str, role: str = 'user', email: str = '') -> User:
+    """
+    Async twin of signup.
+    """
+    role = role.lower()
+    if role not in ['admin', 'user']:
+        raise ValueError("Invalid role! Role must be either 'admin' or 'user'.")
+
+    if not email or '@' not in email:
+        raise ValueError("Invalid email address.")
+
+    hashed_password = await arun_password_job(hash_password, password)
+
+    async with async_session() as session:
+        if (await session.exec(select(User).where(User.username == username.lower()))).first():
+            raise ValueError("Username already exists!")
+        if (await session.exec(select(User).where(User.email == email))).first():
+            raise ValueError("Email already exists!")
+
+        user = User(username=username, password=hashed_password, role=role, email=email)
+        session.add(user)
+        await session.commit()
+        await session.refresh(user)
+        return user
+
 def signin(username: str, password: str):
     """
     Authenticates a user and returns the User object if successful.
@@ -134,16 +589,51 @@ def signin(username: str, password: str):
     Returns:
         The User object if the login is successful, otherwise None.
     """
+    username = username.lower()
+    throttled = throttled_error(username)
+    if throttled:
+        return throttled
+
     with Session(engine) as session:
-      statement = select(User).where(User.username == username.lower())
+      statement = select(User).where(User.username == username)
       result = session.exec(statement)
       user = result.first()
 
-      if user and bcrypt.checkpw(password.encode('utf-8'), user.password.encode('utf-8')): 
+      if user and run_password_job(verify_password, password, user.password):
+          login_throttle.succeeded(username)
+          if needs_rehash(user.password):
+              user.password = run_password_job(hash_password, password)
+              session.add(user)
+              session.commit()
+              session.refresh(user)
           return user
       else:
-          return {"error":"username or password is invalid"} 
-        
+          login_throttle.failed(username)
+          return {"error":"username or password is invalid"}
+
+async def asignin(username: str, password: str):
+    """
+    Async twin of signin.
+    """
+    username = username.lower()
+    throttled = throttled_error(username)
+    if throttled:
+        return throttled
+
+    async with async_session() as session:
+        user = (await session.exec(select(User).where(User.username == username))).first()
+
+        if user and await arun_password_job(verify_password, password, user.password):
+            login_throttle.succeeded(username)
+            if needs_rehash(user.password):
+                user.password = await arun_password_job(hash_password, password)
+                session.add(user)
+                await session.commit()
+                await session.refresh(user)
+            return user
+    login_throttle.failed(username)
+    return {"error":"username or password is invalid"}
+
 
 def delete_user(user_id: int) -> bool:
     """
@@ -157,8 +647,389 @@ def delete_user(user_id: int) -> bool:
             return True
         return False
 
+async def adelete_user(user_id: int) -> bool:
+    """
+    Async twin of delete_user.
+    """
+    async with async_session() as session:
+        user = (await session.exec(select(User).where(User.id == user_id))).first()
+        if user:
+            await session.delete(user)
+            await session.commit()
+            return True
+        return False
+
+
+# Sessions
+# signin/signup put a signed session token in graph state; clients that sign in outside
+# the chat can pass one in with their input instead (see create_session), which keeps
+# the password out of the conversation. Each turn checks the token's HMAC and expiry
+# with no DB or bcrypt work, and the principal it carries is the current user for the
+# assistant and for tools that take the session from state.
+
+SESSION_SECRET = os.getenv("SESSION_SECRET") or secrets.token_hex(32)
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(8 * 3600)))  # seconds
+
+if not os.getenv("SESSION_SECRET"):
+    print("SESSION_SECRET is not set; sessions won't survive a restart or work across workers.")
+
+
+def b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def sign(payload: str) -> str:
+    return b64encode(hmac.new(SESSION_SECRET.encode(), payload.encode(), hashlib.sha256).digest())
+
+
+def issue_session_token(user: User) -> str:
+    """
+    Returns '<payload>.<signature>' carrying the user's id, username, role and expiry.
+    """
+    claims = {"uid": user.id, "sub": user.username, "role": user.role, "exp": int(time.time()) + SESSION_TTL}
+    payload = b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    return f"{payload}.{sign(payload)}"
+
+
+def verify_session_token(token: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Returns the token's principal if the signature matches and it hasn't expired, else None.
+    """
+    if not token or token.count(".") != 1:
+        return None
+    payload, signature = token.split(".")
+    # As bytes: compare_digest raises TypeError on a str with non-ASCII characters
+    if not hmac.compare_digest(signature.encode(), sign(payload).encode()):
+        return None
+    try:
+        principal = json.loads(b64decode(payload))
+    except ValueError:
+        return None
+    if principal.get("exp", 0) < time.time():
+        return None
+    return principal
+
+
+def create_session(username: str, password: str) -> Optional[str]:
+    """
+    Signs a user in outside the chat and returns a token to pass as `session` in the
+    graph input, or None if the credentials are wrong.
+    """
+    user = signin(username, password)
+    return issue_session_token(user) if isinstance(user, User) else None
+
+
+def session_command(result, tool_call_id: str, name: str):
+    """
+    Turns a successful signin/signup into a state update that stores the session token.
+    Errors are returned unchanged.
+    """
+    if not isinstance(result, User):
+        return result
+    content, artifact = serialize_result(name, result)
+    return Command(update={
+        "session": issue_session_token(result),
+        "messages": [ToolMessage(content=content, artifact=artifact, name=name, tool_call_id=tool_call_id)],
+    })
+
+
+def signin_session(username: str, password: str, tool_call_id: Annotated[str, InjectedToolCallId]):
+    """
+    Authenticates a user and starts their session. Returns the user's profile if
+    successful, otherwise an error.
+    """
+    return session_command(signin(username, password), tool_call_id, "signin")
+
+async def asignin_session(username: str, password: str, tool_call_id: Annotated[str, InjectedToolCallId]):
+    """
+    Async twin of signin_session.
+    """
+    return session_command(await asignin(username, password), tool_call_id, "signin")
+
+
+def signup_role(role: str, session: Optional[str]) -> str:
+    """
+    The role a chat signup may create: only a signed-in admin can create another admin.
+    """
+    principal = verify_session_token(session)
+    return role if principal and principal["role"] == "admin" else "user"
+
+def signup_session(username: str, password: str, tool_call_id: Annotated[str, InjectedToolCallId], role: str = 'user', email: str = '',
+                   session: Annotated[Optional[str], InjectedState("session")] = None):
+    """
+    Registers a new user and starts their session. Only admins may pass role='admin'.
+    """
+    return session_command(signup(username, password, signup_role(role, session), email), tool_call_id, "signup")
+
+async def asignup_session(username: str, password: str, tool_call_id: Annotated[str, InjectedToolCallId], role: str = 'user', email: str = '',
+                          session: Annotated[Optional[str], InjectedState("session")] = None):
+    """
+    Async twin of signup_session.
+    """
+    return session_command(await asignup(username, password, signup_role(role, session), email), tool_call_id, "signup")
+
+
+def current_user(session: Annotated[Optional[str], InjectedState("session")] = None) -> Dict[str, Any]:
+    """
+    Returns the signed-in user's id, username and role, or the Guest role if nobody is signed in.
+    """
+    principal = verify_session_token(session)
+    if not principal:
+        return {"role": "guest"}
+    return {"id": principal["uid"], "username": principal["sub"], "role": principal["role"]}
+
+async def acurrent_user(session: Annotated[Optional[str], InjectedState("session")] = None) -> Dict[str, Any]:
+    """
+    Async twin of current_user.
+    """
+    return current_user(session)
+
+
+def appointment_owner(session: Optional[str]) -> Optional[str]:
+    """
+    The patient whose appointments the caller may see and change: their own username
+    for patients, None (everyone's) for admins. Guests get a ValueError.
+    """
+    principal = verify_session_token(session)
+    if not principal:
+        raise ValueError("Please sign in to see or change appointments.")
+    return None if principal["role"] == "admin" else principal["sub"]
+
+
+def check_patient(session: Optional[str], patient_name: str) -> None:
+    """
+    Raises ValueError unless the caller is an admin or the patient themselves.
+    """
+    owner = appointment_owner(session)
+    if owner is not None and owner != patient_name:
+        raise ValueError("You can only see your own appointments.")
+
+
+# Doctor directory cache
+# Guests read the doctor list constantly while it rarely changes, so get_doctor and
+# get_all_doctors read through an in-process TTL/LRU cache. Writes bump a version
+# number; entries filled under an older version are treated as misses.
+
+DOCTOR_CACHE_TTL = int(os.getenv("DOCTOR_CACHE_TTL", "300"))  # seconds
+DOCTOR_CACHE_MAX_ENTRIES = int(os.getenv("DOCTOR_CACHE_MAX_ENTRIES", "1024"))
+DOCTOR_CACHE_BACKEND = os.getenv("DOCTOR_CACHE_BACKEND", "local")  # 'local' or 'database'
+
+
+class LocalVersionBackend:
+    """
+    Keeps the directory version in this process only.
+    """
+
+    def __init__(self):
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def version(self) -> int:
+        return self._version
+
+    def bump(self) -> int:
+        with self._lock:
+            self._version += 1
+            return self._version
+
+    async def aversion(self) -> int:
+        return self.version()
+
+    async def abump(self) -> int:
+        return self.bump()
+
+
+class CacheVersion(SQLModel, table=True):
+    name: str = Field(primary_key=True)
+    version: int = 0
+
+
+class DatabaseVersionBackend:
+    """
+    Shares the directory version through a row in the database, so a write on one
+    server worker invalidates the caches of all the others. The row is polled at
+    most once every poll_interval seconds.
+    """
+
+    def __init__(self, name: str = "doctors", poll_interval: float = 2.0):
+        self.name = name
+        self.poll_interval = poll_interval
+        self._version = 0
+        self._checked_at = 0.0
+        CacheVersion.__table__.create(engine, checkfirst=True)
+
+    def _stale(self) -> bool:
+        return time.monotonic() - self._checked_at >= self.poll_interval
+
+    def _seen(self, version: int) -> int:
+        self._version = version
+        self._checked_at = time.monotonic()
+        return version
+
+    def version(self) -> int:
+        if self._stale():
+            with Session(engine) as session:
+                row = session.get(CacheVersion, self.name)
+                self._seen(row.version if row else 0)
+        return self._version
+
+    async def aversion(self) -> int:
+        """
+        Async twin of version.
+        """
+        if self._stale():
+            async with async_session() as session:
+                row = await session.get(CacheVersion, self.name)
+                self._seen(row.version if row else 0)
+        return self._version
+
+    def _bump_statement(self):
+        """
+        Increments the shared version in one statement, so concurrent bumps from
+        different workers each count and the first one can't race into a duplicate row.
+        """
+        table = CacheVersion.__table__
+        if engine.dialect.name in ["postgresql", "sqlite"]:
+            insert = (postgresql if engine.dialect.name == "postgresql" else sqlite).insert(table)
+            return (
+                insert.values(name=self.name, version=1)
+                .on_conflict_do_update(index_elements=["name"], set_={"version": table.c.version + 1})
+                .returning(table.c.version)
+            )
+        return update(table).where(table.c.name == self.name).values(version=table.c.version + 1).returning(table.c.version)
+
+    def bump(self) -> int:
+        with Session(engine) as session:
+            version = session.exec(self._bump_statement()).scalar()
+            if version is None:  # other dialects: first bump for this name
+                session.exec(CacheVersion.__table__.insert().values(name=self.name, version=1))
+                version = 1
+            session.commit()
+        return self._seen(version)
+
+    async def abump(self) -> int:
+        """
+        Async twin of bump.
+        """
+        async with async_session() as session:
+            version = (await session.exec(self._bump_statement())).scalar()
+            if version is None:
+                await session.exec(CacheVersion.__table__.insert().values(name=self.name, version=1))
+                version = 1
+            await session.commit()
+        return self._seen(version)
+
+
+def copy_cached(value):
+    """
+    A copy of a cached value for one caller, so changes to the Doctor objects it gets
+    back don't leak into the cache or to other callers.
+    """
+    if isinstance(value, list):
+        return [copy_cached(item) for item in value]
+    if isinstance(value, SQLModel):
+        return type(value).model_validate(value.model_dump())
+    return value
+
+
+class DirectoryCache:
+    """
+    Read-through TTL/LRU cache with version-based invalidation and hit/miss counters.
+    Callers get copies of the cached values.
+    """
+
+    def __init__(self, ttl_seconds: int, max_entries: int, backend=None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.backend = backend or LocalVersionBackend()
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, key, version: int):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic() and entry[1] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[2], version
+            self.misses += 1
+            return False, None, version
+
+    def _store(self, key, value, version) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """
+        Returns the cached value for key, calling loader() on a miss.
+        """
+        found, value, version = self._lookup(key, self.backend.version())
+        if not found:
+            value = loader()
+            self._store(key, value, version)
+        return copy_cached(value)
+
+    async def aget_or_load(self, key, loader):
+        """
+        Async twin of get_or_load; loader is a coroutine function.
+        """
+        found, value, version = self._lookup(key, await self.backend.aversion())
+        if not found:
+            value = await loader()
+            self._store(key, value, version)
+        return copy_cached(value)
+
+    def invalidate(self) -> None:
+        """
+        Drops every entry here and, through the backend, in other workers.
+        """
+        self.backend.bump()
+        with self._lock:
+            self._entries.clear()
+
+    async def ainvalidate(self) -> None:
+        """
+        Async twin of invalidate.
+        """
+        await self.backend.abump()
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns hit/miss counters and the current size.
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._entries),
+            }
+
+
+doctor_cache = DirectoryCache(
+    DOCTOR_CACHE_TTL,
+    DOCTOR_CACHE_MAX_ENTRIES,
+    DatabaseVersionBackend() if DOCTOR_CACHE_BACKEND == "database" else LocalVersionBackend(),
+)
+
 
 # CRUD Operations for Doctors
+# (name, specialty) is unique (ux_doctor_name_specialty), so a duplicate is reported
+# to the caller as a ValueError, which ToolNode hands back to the model.
+
+DUPLICATE_DOCTOR_ERROR = "A doctor with that name and specialty already exists"
 
 def add_doctor(name: str, specialty: str, available: bool) -> Doctor:
     """
@@ -169,17 +1040,50 @@ def add_doctor(name: str, specialty: str, available: bool) -> Doctor:
     with Session(engine) as session:
         doctor = Doctor(name=name, specialty=specialty, available=available)
         session.add(doctor)
-        session.commit()
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            raise ValueError(DUPLICATE_DOCTOR_ERROR)
         session.refresh(doctor)
-        return doctor
+    doctor_cache.invalidate()
+    return doctor
+
+async def aadd_doctor(name: str, specialty: str, available: bool) -> Doctor:
+    """
+    Async twin of add_doctor.
+    """
+    async with async_session() as session:
+        doctor = Doctor(name=name, specialty=specialty, available=available)
+        session.add(doctor)
+        try:
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            raise ValueError(DUPLICATE_DOCTOR_ERROR)
+        await session.refresh(doctor)
+    await doctor_cache.ainvalidate()
+    return doctor
 
 def get_doctor(doctor_id: int) -> Optional[Doctor]:
     """
     Retrieves a doctor's details from the database by their doctor_id.
     """
-    with Session(engine) as session:
-        doctor = session.exec(select(Doctor).where(Doctor.id == doctor_id)).first()
-        return doctor
+    def load() -> Optional[Doctor]:
+        with Session(engine) as session:
+            return session.exec(select(Doctor).where(Doctor.id == doctor_id)).first()
+
+    return doctor_cache.get_or_load(("doctor", doctor_id), load)
+
+async def aget_doctor(doctor_id: int) -> Optional[Doctor]:
+    """
+    Async twin of get_doctor.
+    """
+    async def load() -> Optional[Doctor]:
+        async with async_session() as session:
+            return (await session.exec(select(Doctor).where(Doctor.id == doctor_id))).first()
+
+    return await doctor_cache.aget_or_load(("doctor", doctor_id), load)
 
 def update_doctor(doctor_id: int, name: Optional[str] = None, specialty: Optional[str] = None, available: Optional[bool] = None) -> Optional[Doctor]:
     """
@@ -195,8 +1099,37 @@ def update_doctor(doctor_id: int, name: Optional[str] = None, specialty: Optiona
             if available is not None:
                 doctor.available = available
             session.add(doctor)
-            session.commit()
+            try:
+                session.commit()
+            except IntegrityError:
+                session.rollback()
+                raise ValueError(DUPLICATE_DOCTOR_ERROR)
             session.refresh(doctor)
+            doctor_cache.invalidate()
+            return doctor
+        return None
+
+async def aupdate_doctor(doctor_id: int, name: Optional[str] = None, specialty: Optional[str] = None, available: Optional[bool] = None) -> Optional[Doctor]:
+    """
+    Async twin of update_doctor.
+    """
+    async with async_session() as session:
+        doctor = (await session.exec(select(Doctor).where(Doctor.id == doctor_id))).first()
+        if doctor:
+            if name:
+                doctor.name = name
+            if specialty:
+                doctor.specialty = specialty
+            if available is not None:
+                doctor.available = available
+            session.add(doctor)
+            try:
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+                raise ValueError(DUPLICATE_DOCTOR_ERROR)
+            await session.refresh(doctor)
+            await doctor_cache.ainvalidate()
             return doctor
         return None
 
@@ -207,25 +1140,426 @@ def delete_doctor(doctor_id: int) -> bool:
     with Session(engine) as session:
         doctor = session.exec(select(Doctor).where(Doctor.id == doctor_id)).first()
         if doctor:
+            if session.exec(select(Appointment.id).where(Appointment.doctor_id == doctor_id).limit(1)).first():
+                raise ValueError("Doctor has appointments; cancel or reassign them before deleting")
             session.delete(doctor)
             session.commit()
+            doctor_cache.invalidate()
+            return True
+        return False
+
+async def adelete_doctor(doctor_id: int) -> bool:
+    """
+    Async twin of delete_doctor.
+    """
+    async with async_session() as session:
+        doctor = (await session.exec(select(Doctor).where(Doctor.id == doctor_id))).first()
+        if doctor:
+            if (await session.exec(select(Appointment.id).where(Appointment.doctor_id == doctor_id).limit(1))).first():
+                raise ValueError("Doctor has appointments; cancel or reassign them before deleting")
+            await session.delete(doctor)
+            await session.commit()
+            await doctor_cache.ainvalidate()
             return True
         return False
 
 
-# CRUD Operations for Appointments
+# Doctor schedules and availability
+# A doctor's bookable slots come from their weekly DoctorSchedule blocks minus any
+# ScheduleException. Booked slots are read with one range query on
+# (doctor_id, start_time). Bookings for a doctor are serialised by locking the doctor
+# row, so the overlap check and the insert happen atomically.
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
 
 
-def book_appointment(data: Appointment) -> Optional[Dict[str, Any]]:
+def parse_weekday(value: str) -> int:
     """
-    Booked appointment and return notification_status.
+    Accepts a weekday name (or its first three letters) and returns 0 for Monday to 6 for Sunday.
     """
-    with Session(engine) as session:
+    name = value.strip().lower()
+    for index, weekday in enumerate(WEEKDAYS):
+        if weekday == name or weekday[:3] == name:
+            return index
+    raise ValueError(f"Unknown weekday '{value}'.")
+
+
+def exception_window(exception: ScheduleException) -> tuple:
+    """
+    Start and end of the time an exception blocks.
+    """
+    if exception.starts is None or exception.ends is None:
+        start = datetime.combine(exception.day, clock_time(0), tzinfo=CLINIC_TIMEZONE)
+        return start, start + timedelta(days=1)
+    return (
+        datetime.combine(exception.day, exception.starts, tzinfo=CLINIC_TIMEZONE),
+        datetime.combine(exception.day, exception.ends, tzinfo=CLINIC_TIMEZONE),
+    )
+
+
+def overlaps(start: datetime, end: datetime, windows) -> bool:
+    return any(start < window_end and window_start < end for window_start, window_end in windows)
+
+
+def working_slots(schedules: List[DoctorSchedule], exceptions: List[ScheduleException], day: calendar_date) -> List[tuple]:
+    """
+    Every (start, end) slot the doctor works on the given day, minus exceptions.
+    """
+    blocked = [exception_window(exception) for exception in exceptions if exception.day == day]
+    slots = []
+    for schedule in schedules:
+        if schedule.weekday != day.weekday():
+            continue
+        step = timedelta(minutes=schedule.slot_minutes)
+        start = datetime.combine(day, schedule.opens, tzinfo=CLINIC_TIMEZONE)
+        closes = datetime.combine(day, schedule.closes, tzinfo=CLINIC_TIMEZONE)
+        while start + step <= closes:
+            if not overlaps(start, start + step, blocked):
+                slots.append((start, start + step))
+            start += step
+    return sorted(slots)
+
+
+def fit_slot(schedules: List[DoctorSchedule], exceptions: List[ScheduleException], start: datetime) -> tuple:
+    """
+    Returns the (start, end) of the slot beginning at start. Doctors without a
+    schedule accept any start time with a DEFAULT_SLOT_MINUTES slot.
+    """
+    if not schedules:
+        return start, start + timedelta(minutes=DEFAULT_SLOT_MINUTES)
+    for slot in working_slots(schedules, exceptions, start.date()):
+        if slot[0] == start:
+            return slot
+    raise ValueError("The doctor is not working at that time. Use get_available_slots to find a free slot.")
+
+
+def schedule_queries(doctor_id: int, first_day: calendar_date, last_day: calendar_date) -> tuple:
+    """
+    Statements for a doctor's schedule, exceptions and booked slots between two days (inclusive).
+    """
+    range_start = datetime.combine(first_day, clock_time(0), tzinfo=CLINIC_TIMEZONE)
+    range_end = datetime.combine(last_day + timedelta(days=1), clock_time(0), tzinfo=CLINIC_TIMEZONE)
+    return (
+        select(DoctorSchedule).where(DoctorSchedule.doctor_id == doctor_id),
+        select(ScheduleException).where(
+            ScheduleException.doctor_id == doctor_id,
+            ScheduleException.day >= first_day,
+            ScheduleException.day <= last_day,
+        ),
+        booked_slots_query(doctor_id, range_start, range_end),
+    )
+
+
+def booked_slots_query(doctor_id: int, start: datetime, end: datetime):
+    """
+    Start and end of the doctor's active appointments overlapping [start, end).
+    """
+    return select(Appointment.start_time, Appointment.end_time).where(
+        Appointment.doctor_id == doctor_id,
+        Appointment.start_time < end,
+        Appointment.end_time > start,
+        Appointment.status != "Cancelled",
+    )
+
+
+def lock_doctor(doctor_id: int):
+    """
+    No-op update that takes the doctor's row lock on Postgres (and the write lock
+    on SQLite) until commit, serialising concurrent bookings with that doctor.
+    """
+    return update(Doctor).where(Doctor.id == doctor_id).values(id=Doctor.id)
+
+
+def free_slots(schedules, exceptions, booked, first_day: calendar_date, last_day: calendar_date) -> List[Dict[str, str]]:
+    """
+    Builds the list of open slots from the rows returned by schedule_queries.
+    """
+    taken = [(as_clinic_time(start), as_clinic_time(end)) for start, end in booked]
+    now = utcnow()
+    slots = []
+    day = first_day
+    while day <= last_day:
+        for start, end in working_slots(schedules, exceptions, day):
+            if start > now and not overlaps(start, end, taken):
+                slots.append({"date": start.strftime("%Y-%m-%d"), "time": start.strftime("%H:%M")})
+        day += timedelta(days=1)
+    return slots
+
+
+def availability_range(start_date: str, end_date: Optional[str]) -> tuple:
+    first_day = parse_date(start_date)
+    last_day = parse_date(end_date) if end_date else first_day
+    if first_day is None or last_day is None:
+        raise ValueError("Dates must look like YYYY-MM-DD.")
+    if last_day < first_day or (last_day - first_day).days >= MAX_AVAILABILITY_DAYS:
+        raise ValueError(f"The date range must be ascending and at most {MAX_AVAILABILITY_DAYS} days.")
+    return first_day, last_day
+
+
+def get_available_slots(doctor_id: int, start_date: str, end_date: Optional[str] = None) -> List[Dict[str, str]]:
+    """
+    Lists the doctor's free appointment slots (date and time) from start_date to end_date
+    inclusive; end_date defaults to start_date. Dates are YYYY-MM-DD.
+    """
+    first_day, last_day = availability_range(start_date, end_date)
+    schedule_query, exception_query, booked_query = schedule_queries(doctor_id, first_day, last_day)
+    with Session(engine) as session:
+        schedules = session.exec(schedule_query).all()
+        if not schedules:
+            return []
+        exceptions = session.exec(exception_query).all()
+        booked = session.exec(booked_query).all()
+    return free_slots(schedules, exceptions, booked, first_day, last_day)
+
+async def aget_available_slots(doctor_id: int, start_date: str, end_date: Optional[str] = None) -> List[Dict[str, str]]:
+    """
+    Async twin of get_available_slots.
+    """
+    first_day, last_day = availability_range(start_date, end_date)
+    schedule_query, exception_query, booked_query = schedule_queries(doctor_id, first_day, last_day)
+    async with async_session() as session:
+        schedules = (await session.exec(schedule_query)).all()
+        if not schedules:
+            return []
+        exceptions = (await session.exec(exception_query)).all()
+        booked = (await session.exec(booked_query)).all()
+    return free_slots(schedules, exceptions, booked, first_day, last_day)
+
+
+def schedule_block(doctor_id: int, weekday: str, opens: str, closes: str, slot_minutes: int) -> DoctorSchedule:
+    opens_at, closes_at = parse_clock_time(opens), parse_clock_time(closes)
+    if opens_at is None or closes_at is None or opens_at >= closes_at:
+        raise ValueError("Opening and closing times must look like HH:MM, opening first.")
+    if slot_minutes <= 0:
+        raise ValueError("Slot length must be positive.")
+    return DoctorSchedule(doctor_id=doctor_id, weekday=parse_weekday(weekday), opens=opens_at, closes=closes_at, slot_minutes=slot_minutes)
+
+
+def set_doctor_schedule(doctor_id: int, weekday: str, opens: str, closes: str, slot_minutes: int = DEFAULT_SLOT_MINUTES) -> DoctorSchedule:
+    """
+    Sets a doctor's working hours for one weekday (e.g. 'Monday', '09:00', '17:00'),
+    replacing any hours already set for that day. Admin only.
+    """
+    block = schedule_block(doctor_id, weekday, opens, closes, slot_minutes)
+    with Session(engine) as session:
+        for existing in session.exec(select(DoctorSchedule).where(DoctorSchedule.doctor_id == doctor_id, DoctorSchedule.weekday == block.weekday)).all():
+            session.delete(existing)
+        session.add(block)
+        session.commit()
+        session.refresh(block)
+        return block
+
+async def aset_doctor_schedule(doctor_id: int, weekday: str, opens: str, closes: str, slot_minutes: int = DEFAULT_SLOT_MINUTES) -> DoctorSchedule:
+    """
+    Async twin of set_doctor_schedule.
+    """
+    block = schedule_block(doctor_id, weekday, opens, closes, slot_minutes)
+    async with async_session() as session:
+        for existing in (await session.exec(select(DoctorSchedule).where(DoctorSchedule.doctor_id == doctor_id, DoctorSchedule.weekday == block.weekday))).all():
+            await session.delete(existing)
+        session.add(block)
+        await session.commit()
+        await session.refresh(block)
+        return block
+
+
+def schedule_exception(doctor_id: int, date: str, starts: Optional[str], ends: Optional[str], reason: Optional[str]) -> ScheduleException:
+    day = parse_date(date)
+    if day is None:
+        raise ValueError("Date must look like YYYY-MM-DD.")
+    starts_at = parse_clock_time(starts) if starts else None
+    ends_at = parse_clock_time(ends) if ends else None
+    if (starts_at is None) != (ends_at is None) or (starts_at and starts_at >= ends_at):
+        raise ValueError("Give both start and end times (HH:MM) to block part of a day, or neither to block all of it.")
+    return ScheduleException(doctor_id=doctor_id, day=day, starts=starts_at, ends=ends_at, reason=reason)
+
+
+def add_schedule_exception(doctor_id: int, date: str, starts: Optional[str] = None, ends: Optional[str] = None, reason: Optional[str] = None) -> ScheduleException:
+    """
+    Marks a doctor as unavailable on a date, for the whole day or between starts and ends. Admin only.
+    """
+    exception = schedule_exception(doctor_id, date, starts, ends, reason)
+    with Session(engine) as session:
+        session.add(exception)
+        session.commit()
+        session.refresh(exception)
+        return exception
+
+async def aadd_schedule_exception(doctor_id: int, date: str, starts: Optional[str] = None, ends: Optional[str] = None, reason: Optional[str] = None) -> ScheduleException:
+    """
+    Async twin of add_schedule_exception.
+    """
+    exception = schedule_exception(doctor_id, date, starts, ends, reason)
+    async with async_session() as session:
+        session.add(exception)
+        await session.commit()
+        await session.refresh(exception)
+        return exception
+
+
+# Bulk doctor import
+# Loads a clinic roster from CSV (header: name,specialty,available) or JSONL in batched
+# multi-row upserts keyed on (name, specialty), instead of one add_doctor tool call and
+# one commit per doctor. Invalid rows are skipped and reported by line number.
+
+DOCTOR_IMPORT_BATCH_SIZE = int(os.getenv("DOCTOR_IMPORT_BATCH_SIZE", "1000"))
+DOCTOR_IMPORT_MAX_ERRORS = 100  # Errors listed in the report; the rest are only counted
+
+
+class DoctorImportRow(SQLModel):
+    name: str = Field(min_length=1)
+    specialty: str = Field(min_length=1)
+    available: bool = True
+
+
+def read_import_rows(lines: Iterable[str], format: str) -> Iterator[tuple]:
+    """
+    Yields (line number, raw row) pairs, or (line number, exception) for lines that don't parse.
+    """
+    if format == "csv":
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+    elif format == "jsonl":
+        for line_number, line in enumerate(lines, 1):
+            if line.strip():
+                try:
+                    yield line_number, json.loads(line)
+                except ValueError as e:
+                    yield line_number, e
+    else:
+        raise ValueError("Import format must be 'csv' or 'jsonl'.")
+
+
+def validate_import_row(raw) -> DoctorImportRow:
+    if isinstance(raw, Exception):
+        raise ValueError(f"unreadable row: {raw}")
+    if not isinstance(raw, dict):
+        raise ValueError("each row must be an object with name, specialty and available")
+    fields = {str(key).strip().lower(): value.strip() if isinstance(value, str) else value for key, value in raw.items() if key}
+    if fields.get("available") in ["", None]:
+        fields.pop("available", None)
+    try:
+        return DoctorImportRow.model_validate(fields)
+    except ValidationError as e:
+        raise ValueError("; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()))
+
+
+def doctor_upsert_statement():
+    """
+    Multi-row insert that updates availability when (name, specialty) already exists.
+    """
+    if engine.dialect.name == "postgresql":
+        statement = postgresql.insert(Doctor.__table__)
+    elif engine.dialect.name == "sqlite":
+        statement = sqlite.insert(Doctor.__table__)
+    else:
+        return Doctor.__table__.insert()
+    return statement.on_conflict_do_update(index_elements=["name", "specialty"], set_={"available": statement.excluded.available})
+
+
+def has_doctor_unique_index() -> bool:
+    indexes = inspect(engine).get_indexes(Doctor.__tablename__)
+    return any(index["name"] == "ux_doctor_name_specialty" and index["unique"] for index in indexes)
+
+
+def import_doctors(lines: Iterable[str], format: str = "csv", batch_size: int = DOCTOR_IMPORT_BATCH_SIZE) -> Dict[str, Any]:
+    """
+    Streams doctor rows from lines (an open file or any iterable of text lines), validating
+    each and upserting them one batch per transaction. Returns the number of rows written
+    and the errors for rows that were skipped.
+    """
+    if not has_doctor_unique_index():
+        # The upsert's ON CONFLICT target; without it every batch would fail
+        raise ValueError("Bulk import is disabled until the doctor table has its unique (name, specialty) index.")
+    statement = doctor_upsert_statement()
+    upserted = 0
+    errors: List[Dict[str, Any]] = []
+    error_count = 0
+    batch: Dict[tuple, tuple] = {}
+
+    def record_error(line_number: int, message: str) -> None:
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < DOCTOR_IMPORT_MAX_ERRORS:
+            errors.append({"line": line_number, "error": message})
+
+    def flush() -> None:
+        nonlocal upserted
+        if not batch:
+            return
+        try:
+            with engine.begin() as connection:
+                connection.execute(statement, [row for _, row in batch.values()])
+            upserted += len(batch)
+        except DBAPIError as e:
+            for line_number, _ in batch.values():
+                record_error(line_number, f"batch failed: {e.orig}")
+        batch.clear()
+
+    for line_number, raw in read_import_rows(lines, format):
+        try:
+            row = validate_import_row(raw)
+        except ValueError as e:
+            record_error(line_number, str(e))
+            continue
+        # Later rows win, and one statement can't upsert the same key twice
+        batch[(row.name, row.specialty)] = (line_number, row.model_dump())
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    if upserted:
+        doctor_cache.invalidate()
+    logger.info("Imported %d doctors, skipped %d rows", upserted, error_count)
+    return {"upserted": upserted, "error_count": error_count, "errors": errors}
+
+
+def bulk_add_doctors(data: str, format: str = "csv") -> Dict[str, Any]:
+    """
+    Adds or updates many doctors at once from pasted CSV (with a header line
+    'name,specialty,available') or JSON Lines. Admin only. Convert a pasted roster
+    to CSV and call this once instead of calling add_doctor for each doctor.
+    """
+    return import_doctors(io.StringIO(data), format)
+
+async def abulk_add_doctors(data: str, format: str = "csv") -> Dict[str, Any]:
+    """
+    Async twin of bulk_add_doctors.
+    """
+    return await asyncio.to_thread(bulk_add_doctors, data, format)
+
+
+# CRUD Operations for Appointments
+
+
+def reserve_appointment(data: Appointment, idempotency_key: str) -> Appointment:
+    """
+    Inserts the appointment once per idempotency key and commits, returning the
+    existing row when the key has already been used (e.g. on resume).
+    """
+    with Session(engine) as session:
+        appointment = session.exec(select(Appointment).where(Appointment.idempotency_key == idempotency_key)).first()
+        if appointment:
+            return appointment
+
         # Fetch user details from the User table based on the patient's username
-        user = session.query(User).filter(User.username == data.patient_name).first()
+        user = session.exec(select(User).where(User.username == data.patient_name)).first()
         if not user:
             raise ValueError(f"User with username '{data.patient_name}' not found.")
 
+        start = parse_appointment_start(data.date, data.time)
+        if start is None:
+            raise ValueError("Could not read the appointment date and time; use YYYY-MM-DD and HH:MM.")
+
+        # Hold the doctor's lock from the overlap check until the insert commits
+        if session.exec(lock_doctor(data.doctor_id)).rowcount == 0:
+            raise ValueError("Doctor not found.")
+        schedule_query, exception_query, _ = schedule_queries(data.doctor_id, start.date(), start.date())
+        start, end = fit_slot(session.exec(schedule_query).all(), session.exec(exception_query).all(), start)
+        if session.exec(booked_slots_query(data.doctor_id, start, end)).first():
+            raise ValueError("That slot is already booked. Use get_available_slots to find a free slot.")
+
         # Create and save the appointment in the database
         appointment = Appointment(
             doctor_id=data.doctor_id,
@@ -234,26 +1568,117 @@ def book_appointment(data: Appointment) -> Optional[Dict[str, Any]]:
             date=data.date,
             time=data.time,
             status=data.status or "Booked",
-            send_notification=False  # Default to False initially
+            send_notification=False,  # Default to False initially
+            idempotency_key=idempotency_key,
+            start_time=start,
+            end_time=end,
         )
         session.add(appointment)
-        session.commit()
+        try:
+            session.commit()
+        except IntegrityError:
+            # A concurrent resume of the same booking got there first
+            session.rollback()
+            return session.exec(select(Appointment).where(Appointment.idempotency_key == idempotency_key)).one()
         session.refresh(appointment)
+        return appointment
 
-        # Trigger user confirmation for sending an email notification
-        notification_status = interrupt("Do you want me to send email notification? yes/no").lower()
+async def areserve_appointment(data: Appointment, idempotency_key: str) -> Appointment:
+    """
+    Async twin of reserve_appointment.
+    """
+    async with async_session() as session:
+        appointment = (await session.exec(select(Appointment).where(Appointment.idempotency_key == idempotency_key))).first()
+        if appointment:
+            return appointment
 
-        if notification_status in ["yes", "true"]:
-            # Send the email notification
-            return send_notification(appointment.id, True)
-        else:
-            print("User declined to send email notification.")
-            return {
-                "appointment_id": appointment.id,
-                "status": appointment.status,
-                "send_notification": False,
-                "message":"You email is not send"
-            }
+        user = (await session.exec(select(User).where(User.username == data.patient_name))).first()
+        if not user:
+            raise ValueError(f"User with username '{data.patient_name}' not found.")
+
+        start = parse_appointment_start(data.date, data.time)
+        if start is None:
+            raise ValueError("Could not read the appointment date and time; use YYYY-MM-DD and HH:MM.")
+
+        # Hold the doctor's lock from the overlap check until the insert commits
+        if (await session.exec(lock_doctor(data.doctor_id))).rowcount == 0:
+            raise ValueError("Doctor not found.")
+        schedule_query, exception_query, _ = schedule_queries(data.doctor_id, start.date(), start.date())
+        start, end = fit_slot((await session.exec(schedule_query)).all(), (await session.exec(exception_query)).all(), start)
+        if (await session.exec(booked_slots_query(data.doctor_id, start, end))).first():
+            raise ValueError("That slot is already booked. Use get_available_slots to find a free slot.")
+
+        appointment = Appointment(
+            doctor_id=data.doctor_id,
+            patient_name=user.username,
+            patient_email=user.email,
+            date=data.date,
+            time=data.time,
+            status=data.status or "Booked",
+            send_notification=False,
+            idempotency_key=idempotency_key,
+            start_time=start,
+            end_time=end,
+        )
+        session.add(appointment)
+        try:
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            return (await session.exec(select(Appointment).where(Appointment.idempotency_key == idempotency_key))).one()
+        await session.refresh(appointment)
+        return appointment
+
+def book_appointment(data: Appointment, tool_call_id: Annotated[str, InjectedToolCallId],
+                     session: Annotated[Optional[str], InjectedState("session")] = None) -> Optional[Dict[str, Any]]:
+    """
+    Booked appointment and return notification_status.
+    """
+    principal = verify_session_token(session)
+    if principal and principal["role"] == "user":
+        # Patients always book for themselves
+        data.patient_name = principal["sub"]
+    # The booking is committed and its connection released before waiting on the human.
+    # On resume the tool re-runs from the top; the tool call id keeps the insert idempotent.
+    appointment = reserve_appointment(data, tool_call_id)
+
+    # Trigger user confirmation for sending an email notification
+    notification_status = interrupt("Do you want me to send email notification? yes/no").lower()
+
+    if notification_status in ["yes", "true"]:
+        # Send the email notification
+        return send_notification(appointment.id, True)
+    else:
+        print("User declined to send email notification.")
+        return {
+            "appointment_id": appointment.id,
+            "status": appointment.status,
+            "send_notification": False,
+            "message":"You email is not send"
+        }
+
+async def abook_appointment(data: Appointment, tool_call_id: Annotated[str, InjectedToolCallId],
+                            session: Annotated[Optional[str], InjectedState("session")] = None) -> Optional[Dict[str, Any]]:
+    """
+    Async twin of book_appointment.
+    """
+    principal = verify_session_token(session)
+    if principal and principal["role"] == "user":
+        data.patient_name = principal["sub"]
+    appointment = await areserve_appointment(data, tool_call_id)
+
+    notification_status = interrupt("Do you want me to send email notification? yes/no").lower()
+
+    if notification_status in ["yes", "true"]:
+        return await asend_notification(appointment.id, True)
+    else:
+        print("User declined to send email notification.")
+        return {
+            "appointment_id": appointment.id,
+            "status": appointment.status,
+            "send_notification": False,
+            "message":"You email is not send"
+        }
 
 def send_notification(appointment_id: int, notification_status: bool) -> Optional[Dict[str, Any]]:
     """
@@ -276,16 +1701,55 @@ def send_notification(appointment_id: int, notification_status: bool) -> Optiona
         # Step 3: Update the `send_notification` field based on input
         appointment.send_notification = notification_status
         session.add(appointment)
-        session.commit()
 
-        # Step 4: Handle email notification if confirmed
+        # Step 4: Queue the email notification if confirmed; the outbox worker delivers it
         if notification_status:
-            send_email(
+            enqueue_email(
+                session,
                 f"Appointment Confirmation with {doctor.name}",
                 f"Your appointment with {doctor.name} on {appointment.date} at {appointment.time} is confirmed.",
                 appointment.patient_email,  # Use the updated field
             )
-            print(f"Email notification sent to {appointment.patient_email}")
+        session.commit()
+
+        if notification_status:
+            print(f"Email notification queued for {appointment.patient_email}")
+            return {
+                "appointment_id": appointment.id,
+                "status": appointment.status,
+                "send_notification": appointment.send_notification,
+            }
+        else:
+            print("Email notification skipped as per the user's request.")
+            return None
+
+async def asend_notification(appointment_id: int, notification_status: bool) -> Optional[Dict[str, Any]]:
+    """
+    Async twin of send_notification.
+    """
+    async with async_session() as session:
+        appointment = await session.get(Appointment, appointment_id)
+        if not appointment:
+            raise ValueError("Appointment not found.")
+
+        doctor = await session.get(Doctor, appointment.doctor_id)
+        if not doctor:
+            raise ValueError("Doctor not found.")
+
+        appointment.send_notification = notification_status
+        session.add(appointment)
+
+        if notification_status:
+            enqueue_email(
+                session,
+                f"Appointment Confirmation with {doctor.name}",
+                f"Your appointment with {doctor.name} on {appointment.date} at {appointment.time} is confirmed.",
+                appointment.patient_email,
+            )
+        await session.commit()
+
+        if notification_status:
+            print(f"Email notification queued for {appointment.patient_email}")
             return {
                 "appointment_id": appointment.id,
                 "status": appointment.status,
@@ -296,96 +1760,1026 @@ def send_notification(appointment_id: int, notification_status: bool) -> Optiona
             return None
 
 
-def get_appointments_by_user(id: int) -> list[Appointment]:
+def get_appointments_by_user(id: int, session: Annotated[Optional[str], InjectedState("session")] = None) -> list[Appointment]:
+    """
+    Retrieves all appointments for a specific user or patient.
+    """
+    principal = verify_session_token(session)
+    if appointment_owner(session) is not None and principal["uid"] != id:
+        raise ValueError("You can only see your own appointments.")
+    with Session(engine) as session:
+        appointments = session.exec(
+            select(Appointment)
+            .join(User, User.username == Appointment.patient_name)
+            .where(User.id == id)
+            .order_by(Appointment.start_time, Appointment.id)
+        ).all()
+        return appointments
+
+async def aget_appointments_by_user(id: int, session: Annotated[Optional[str], InjectedState("session")] = None) -> list[Appointment]:
+    """
+    Async twin of get_appointments_by_user.
+    """
+    principal = verify_session_token(session)
+    if appointment_owner(session) is not None and principal["uid"] != id:
+        raise ValueError("You can only see your own appointments.")
+    async with async_session() as session:
+        appointments = (await session.exec(
+            select(Appointment)
+            .join(User, User.username == Appointment.patient_name)
+            .where(User.id == id)
+            .order_by(Appointment.start_time, Appointment.id)
+        )).all()
+        return appointments
+
+def get_appointments_by_patient_name(patient_name: str,doctor_id:int, session: Annotated[Optional[str], InjectedState("session")] = None) -> List[Appointment]:
+    """
+    Retrieves all appointments for a specific user by their patient_name and doctor ID. """
+    check_patient(session, patient_name)
+    with Session(engine) as session:
+        # Query to get the user based on username
+        user = session.exec(select(User).where(User.username == patient_name)).first()
+
+        # If user does not exist, return an empty list
+        if not user:
+            print(f"No user found with username: {patient_name}")
+            return []
+
+
+        appointments = session.exec(
+            select(Appointment)
+            .where(Appointment.patient_name == patient_name, Appointment.doctor_id == doctor_id)
+            .order_by(Appointment.start_time, Appointment.id)
+        ).all()
+
+        return appointments
+
+async def aget_appointments_by_patient_name(patient_name: str,doctor_id:int, session: Annotated[Optional[str], InjectedState("session")] = None) -> List[Appointment]:
+    """
+    Async twin of get_appointments_by_patient_name.
+    """
+    check_patient(session, patient_name)
+    async with async_session() as session:
+        user = (await session.exec(select(User).where(User.username == patient_name))).first()
+        if not user:
+            print(f"No user found with username: {patient_name}")
+            return []
+
+        appointments = (await session.exec(
+            select(Appointment)
+            .where(Appointment.patient_name == patient_name, Appointment.doctor_id == doctor_id)
+            .order_by(Appointment.start_time, Appointment.id)
+        )).all()
+        return appointments
+
+
+
+# Paginated appointment listings
+# Pages are keyset-paginated on (start_time, id), or on id for status listings, and
+# read only the columns below. Each page carries an opaque next_cursor to pass back
+# for the following page, so neither the database nor the context ever holds the
+# whole result set.
+
+APPOINTMENT_PAGE_SIZE = int(os.getenv("APPOINTMENT_PAGE_SIZE", "25"))
+APPOINTMENT_MAX_PAGE_SIZE = int(os.getenv("APPOINTMENT_MAX_PAGE_SIZE", "100"))
+
+APPOINTMENT_LIST_COLUMNS = [
+    Appointment.id,
+    Appointment.doctor_id,
+    Appointment.patient_name,
+    Appointment.date,
+    Appointment.time,
+    Appointment.status,
+    Appointment.start_time,
+]
+
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str, by_time: bool = True) -> tuple:
+    """
+    The (start, id) or, for id-ordered pages, (id,) position a next_cursor points after.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if by_time:
+            start, last_id = values
+            return datetime.fromisoformat(start), int(last_id)
+        (last_id,) = values
+        return (int(last_id),)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor; pass next_cursor from the previous page unchanged.")
+
+
+def date_range_bounds(start_date: str, end_date: str) -> tuple:
+    """
+    Start of start_date and end of end_date (inclusive) in clinic time.
+    """
+    first_day, last_day = parse_date(start_date), parse_date(end_date)
+    if first_day is None or last_day is None:
+        raise ValueError("Dates must look like YYYY-MM-DD.")
+    if last_day < first_day:
+        raise ValueError("end_date must not be before start_date.")
+    return (
+        datetime.combine(first_day, clock_time(0), tzinfo=CLINIC_TIMEZONE),
+        datetime.combine(last_day + timedelta(days=1), clock_time(0), tzinfo=CLINIC_TIMEZONE),
+    )
+
+
+def appointment_page_query(conditions: list, cursor: Optional[str], limit: int, by_time: bool = True):
+    """
+    Builds the select for one page, fetching one extra row to tell whether another page follows.
+    """
+    limit = max(1, min(limit, APPOINTMENT_MAX_PAGE_SIZE))
+    if cursor:
+        if by_time:
+            start, last_id = decode_cursor(cursor)
+            conditions = conditions + [or_(
+                Appointment.start_time > start,
+                and_(Appointment.start_time == start, Appointment.id > last_id),
+            )]
+        else:
+            conditions = conditions + [Appointment.id > decode_cursor(cursor, by_time=False)[0]]
+    order = [Appointment.start_time, Appointment.id] if by_time else [Appointment.id]
+    return select(*APPOINTMENT_LIST_COLUMNS).where(*conditions).order_by(*order).limit(limit + 1), limit
+
+
+def appointment_page(rows, limit: int, by_time: bool = True) -> Dict[str, Any]:
+    """
+    Turns the fetched rows into {"appointments": [...], "next_cursor": ...}.
+    """
+    more = len(rows) > limit
+    rows = rows[:limit]
+    appointments = []
+    for row in rows:
+        appointment = dict(row._mapping)
+        start = appointment.pop("start_time")
+        appointment["start"] = as_clinic_time(start).isoformat() if start else None
+        appointments.append(appointment)
+    next_cursor = None
+    if more:
+        last = appointments[-1]
+        next_cursor = encode_cursor([last["start"], last["id"]] if by_time else [last["id"]])
+    return {"appointments": appointments, "next_cursor": next_cursor}
+
+
+def list_appointments_by_doctor(doctor_id: int, start_date: str, end_date: str, cursor: Optional[str] = None, limit: int = APPOINTMENT_PAGE_SIZE) -> Dict[str, Any]:
+    """
+    Lists a doctor's appointments between start_date and end_date (YYYY-MM-DD, inclusive)
+    in time order, one page at a time. Pass next_cursor back as cursor for the next page.
+    """
+    range_start, range_end = date_range_bounds(start_date, end_date)
+    statement, limit = appointment_page_query(
+        [Appointment.doctor_id == doctor_id, Appointment.start_time >= range_start, Appointment.start_time < range_end],
+        cursor, limit,
+    )
+    with Session(engine) as session:
+        return appointment_page(session.exec(statement).all(), limit)
+
+async def alist_appointments_by_doctor(doctor_id: int, start_date: str, end_date: str, cursor: Optional[str] = None, limit: int = APPOINTMENT_PAGE_SIZE) -> Dict[str, Any]:
+    """
+    Async twin of list_appointments_by_doctor.
+    """
+    range_start, range_end = date_range_bounds(start_date, end_date)
+    statement, limit = appointment_page_query(
+        [Appointment.doctor_id == doctor_id, Appointment.start_time >= range_start, Appointment.start_time < range_end],
+        cursor, limit,
+    )
+    async with async_session() as session:
+        return appointment_page((await session.exec(statement)).all(), limit)
+
+
+def list_appointments_by_patient(patient_name: str, start_date: str, end_date: str, cursor: Optional[str] = None, limit: int = APPOINTMENT_PAGE_SIZE,
+                                 session: Annotated[Optional[str], InjectedState("session")] = None) -> Dict[str, Any]:
+    """
+    Lists a patient's appointments between start_date and end_date (YYYY-MM-DD, inclusive)
+    in time order, one page at a time. Pass next_cursor back as cursor for the next page.
+    """
+    check_patient(session, patient_name)
+    range_start, range_end = date_range_bounds(start_date, end_date)
+    statement, limit = appointment_page_query(
+        [Appointment.patient_name == patient_name, Appointment.start_time >= range_start, Appointment.start_time < range_end],
+        cursor, limit,
+    )
+    with Session(engine) as session:
+        return appointment_page(session.exec(statement).all(), limit)
+
+async def alist_appointments_by_patient(patient_name: str, start_date: str, end_date: str, cursor: Optional[str] = None, limit: int = APPOINTMENT_PAGE_SIZE,
+                                        session: Annotated[Optional[str], InjectedState("session")] = None) -> Dict[str, Any]:
+    """
+    Async twin of list_appointments_by_patient.
+    """
+    check_patient(session, patient_name)
+    range_start, range_end = date_range_bounds(start_date, end_date)
+    statement, limit = appointment_page_query(
+        [Appointment.patient_name == patient_name, Appointment.start_time >= range_start, Appointment.start_time < range_end],
+        cursor, limit,
+    )
+    async with async_session() as session:
+        return appointment_page((await session.exec(statement)).all(), limit)
+
+
+def list_appointments_by_status(status: str, cursor: Optional[str] = None, limit: int = APPOINTMENT_PAGE_SIZE) -> Dict[str, Any]:
+    """
+    Lists appointments with the given status (e.g. 'Booked', 'Cancelled'), oldest first,
+    one page at a time. Pass next_cursor back as cursor for the next page. Admin only.
+    """
+    statement, limit = appointment_page_query([Appointment.status == status], cursor, limit, by_time=False)
+    with Session(engine) as session:
+        return appointment_page(session.exec(statement).all(), limit, by_time=False)
+
+async def alist_appointments_by_status(status: str, cursor: Optional[str] = None, limit: int = APPOINTMENT_PAGE_SIZE) -> Dict[str, Any]:
+    """
+    Async twin of list_appointments_by_status.
+    """
+    statement, limit = appointment_page_query([Appointment.status == status], cursor, limit, by_time=False)
+    async with async_session() as session:
+        return appointment_page((await session.exec(statement)).all(), limit, by_time=False)
+
+
+def owned_appointment_query(appointment_id: int, owner: Optional[str]):
+    statement = select(Appointment).where(Appointment.id == appointment_id)
+    return statement.where(Appointment.patient_name == owner) if owner is not None else statement
+
+def update_appointment(appointment_id: int, status: str, session: Annotated[Optional[str], InjectedState("session")] = None) -> Optional[Appointment]:
+    """
+    Updates the status of an existing appointment (e.g., 'Completed'). Patients can
+    only update their own appointments.
+    """
+    owner = appointment_owner(session)
+    with Session(engine) as session:
+        appointment = session.exec(owned_appointment_query(appointment_id, owner)).first()
+        if appointment:
+            appointment.status = status
+            session.add(appointment)
+            session.commit()
+            session.refresh(appointment)
+        return appointment
+
+async def aupdate_appointment(appointment_id: int, status: str, session: Annotated[Optional[str], InjectedState("session")] = None) -> Optional[Appointment]:
+    """
+    Async twin of update_appointment.
+    """
+    owner = appointment_owner(session)
+    async with async_session() as session:
+        appointment = (await session.exec(owned_appointment_query(appointment_id, owner))).first()
+        if appointment:
+            appointment.status = status
+            session.add(appointment)
+            await session.commit()
+            await session.refresh(appointment)
+        return appointment
+
+def delete_appointment(appointment_id: int) -> bool:
+    """
+    Deletes an appointment from the database by appointment ID.
+    """
+    with Session(engine) as session:
+        appointment = session.exec(select(Appointment).where(Appointment.id == appointment_id)).first()
+        if appointment:
+            session.delete(appointment)
+            session.commit()
+            return True
+        return False
+
+async def adelete_appointment(appointment_id: int) -> bool:
+    """
+    Async twin of delete_appointment.
+    """
+    async with async_session() as session:
+        appointment = (await session.exec(select(Appointment).where(Appointment.id == appointment_id))).first()
+        if appointment:
+            await session.delete(appointment)
+            await session.commit()
+            return True
+        return False
+
+
+# Email Sending Function
+
+# studio3/doctor_appointment.py keeps a copy of the SMTP and outbox code below,
+# since each app is deployed on its own. Change the copy with it.
+# SMTP settings, shared by send_email and the outbox worker
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
+SMTP_SSL = os.getenv("SMTP_SSL", "true").lower() in ["1", "true", "yes"]
+
+# Email outbox worker settings
+EMAIL_OUTBOX_WORKER = os.getenv("EMAIL_OUTBOX_WORKER", "thread")  # 'thread' runs it in this process, 'off' leaves it to a separate process
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "2"))  # seconds
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "30"))  # seconds, doubled per attempt
+OUTBOX_SEND_LEASE = float(os.getenv("OUTBOX_SEND_LEASE", "600"))  # seconds a claimed batch is reserved for its worker
+
+
+def build_email(subject: str, body: str, to_email: str) -> EmailMessage:
+    """
+    Builds the EmailMessage sent from MAIL_USERNAME.
+    """
+    msg = EmailMessage()
+    msg.set_content(body)
+    msg['Subject'] = subject
+    msg['From'] = MAIL_USERNAME
+    msg['To'] = to_email
+    return msg
+
+
+def connect_smtp(host: str = None, port: int = None, use_ssl: bool = None) -> smtplib.SMTP:
+    """
+    Opens and logs in an SMTP connection using the SMTP_* settings.
+    """
+    host = host or SMTP_HOST
+    port = port or SMTP_PORT
+    use_ssl = SMTP_SSL if use_ssl is None else use_ssl
+    server = smtplib.SMTP_SSL(host, port, timeout=30) if use_ssl else smtplib.SMTP(host, port, timeout=30)
+    server.login(MAIL_USERNAME, MAIL_PASSWORD)
+    return server
+
+
+# SMTP connection pool settings
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
+SMTP_MAX_MESSAGES_PER_CONNECTION = int(os.getenv("SMTP_MAX_MESSAGES_PER_CONNECTION", "100"))
+SMTP_KEEPALIVE_INTERVAL = float(os.getenv("SMTP_KEEPALIVE_INTERVAL", "60"))  # seconds between NOOPs
+SMTP_MAX_IDLE = float(os.getenv("SMTP_MAX_IDLE", "300"))  # seconds before an unused session is closed
+
+
+class PooledSMTP:
+    """
+    A logged-in SMTP session plus the bookkeeping the pool needs.
+    """
+
+    def __init__(self, server: smtplib.SMTP):
+        self.server = server
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+    def alive(self) -> bool:
+        try:
+            return self.server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close(self) -> None:
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+
+class SMTPPool:
+    """
+    Keeps up to `size` logged-in SMTP sessions for reuse. Idle sessions get a NOOP
+    keepalive and are closed after SMTP_MAX_IDLE; a session is retired after
+    max_messages sends and replaced when it fails.
+    """
+
+    def __init__(self, size: int = SMTP_POOL_SIZE, max_messages: int = SMTP_MAX_MESSAGES_PER_CONNECTION,
+                 keepalive_interval: float = SMTP_KEEPALIVE_INTERVAL, max_idle: float = SMTP_MAX_IDLE,
+                 host: str = None, port: int = None, use_ssl: bool = None):
+        self.size = size
+        self.max_messages = max_messages
+        self.keepalive_interval = keepalive_interval
+        self.max_idle = max_idle
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.connects = 0
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle: List[PooledSMTP] = []
+        self._lock = threading.Lock()
+        self._keepalive: Optional[threading.Thread] = None
+        self._closed = threading.Event()
+
+    def _checkout(self) -> PooledSMTP:
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        if connection is not None:
+            if time.monotonic() - connection.last_used < self.keepalive_interval or connection.alive():
+                return connection
+            connection.close()
+        connection = PooledSMTP(connect_smtp(self.host, self.port, self.use_ssl))
+        with self._lock:
+            self.connects += 1
+            if self._keepalive is None:
+                self._keepalive = threading.Thread(target=self._keepalive_loop, name="smtp-keepalive", daemon=True)
+                self._keepalive.start()
+        return connection
+
+    def _checkin(self, connection: PooledSMTP) -> None:
+        connection.last_used = time.monotonic()
+        if connection.sent >= self.max_messages or self._closed.is_set():
+            connection.close()
+            return
+        with self._lock:
+            self._idle.append(connection)
+
+    def _keepalive_loop(self) -> None:
+        while not self._closed.wait(self.keepalive_interval):
+            with self._lock:
+                idle, self._idle = self._idle, []
+            keep = []
+            for connection in idle:
+                if time.monotonic() - connection.last_used > self.max_idle or not connection.alive():
+                    connection.close()
+                else:
+                    keep.append(connection)
+            with self._lock:
+                self._idle.extend(keep)
+
+    def send(self, msg: EmailMessage) -> None:
+        """
+        Sends one message, reconnecting once if the pooled session has gone away.
+        """
+        for attempt in range(2):
+            self._slots.acquire()
+            connection = None
+            try:
+                connection = self._checkout()
+                connection.server.send_message(msg)
+                connection.sent += 1
+                self._checkin(connection)
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError):
+                # Only a broken session is dropped and retried. Other SMTPExceptions (which
+                # subclass OSError) are server replies, e.g. a refused recipient, and the
+                # session is still good.
+                if connection is not None:
+                    connection.close()
+                if attempt:
+                    raise
+            except Exception:
+                if connection is not None:
+                    self._checkin(connection)
+                raise
+            finally:
+                self._slots.release()
+
+    def send_many(self, messages: List[EmailMessage]) -> List[Optional[Exception]]:
+        """
+        Sends messages over up to `size` sessions at once. Returns one entry per
+        message: None if it was sent, otherwise the exception it failed with.
+        """
+        def send_one(msg: EmailMessage) -> Optional[Exception]:
+            try:
+                self.send(msg)
+                return None
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            return list(executor.map(send_one, messages))
+
+    def close(self) -> None:
+        self._closed.set()
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"connects": self.connects, "idle": len(self._idle), "size": self.size}
+
+
+smtp_pool = SMTPPool()
+
+
+def send_many(emails: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+    """
+    Sends a batch of emails (dicts with subject, body and to_email) over the
+    pooled SMTP sessions, e.g. for reminder or cancellation blasts.
+    """
+    messages = [build_email(item["subject"], item["body"], item["to_email"]) for item in emails]
+    results = smtp_pool.send_many(messages)
+    return [
+        {"to_email": item["to_email"], "sent": error is None, "error": str(error) if error else None}
+        for item, error in zip(emails, results)
+    ]
+
+
+def enqueue_email(session, subject: str, body: str, to_email: str) -> EmailOutbox:
+    """
+    Adds an email to the outbox in the caller's session, so it is only queued
+    if the caller's transaction commits.
+    """
+    queued = EmailOutbox(to_email=to_email, subject=subject, body=body)
+    session.add(queued)
+    return queued
+
+
+class OutboxWorker:
+    """
+    Drains the email outbox in batches over the pooled SMTP sessions,
+    retrying failed sends with exponential backoff.
+    """
+
+    def __init__(self, pool: Optional[SMTPPool] = None,
+                 batch_size: int = OUTBOX_BATCH_SIZE, max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+                 poll_interval: float = OUTBOX_POLL_INTERVAL, backoff_base: float = OUTBOX_BACKOFF_BASE):
+        self.pool = pool or smtp_pool
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.backoff_base = backoff_base
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def claim_batch(self) -> list:
+        """
+        Marks up to batch_size due emails as 'sending' under a lease of OUTBOX_SEND_LEASE
+        seconds and commits straight away, so no row lock or transaction is held while
+        mailing. Claims whose worker died before recording an outcome come due again
+        when the lease runs out.
+        """
+        now = utcnow()
+        due = and_(EmailOutbox.status.in_(["pending", "sending"]), EmailOutbox.next_attempt_at <= now)
+        with Session(engine) as session:
+            ids = session.exec(
+                select(EmailOutbox.id)
+                .where(due)
+                .order_by(EmailOutbox.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)  # several workers can drain side by side
+            ).all()
+            if not ids:
+                return []
+            # Re-checking `due` makes a worker that lost the race (SQLite has no SKIP LOCKED) claim nothing
+            claimed = session.exec(
+                update(EmailOutbox)
+                .where(EmailOutbox.id.in_(ids), due)
+                .values(status="sending", next_attempt_at=now + timedelta(seconds=OUTBOX_SEND_LEASE))
+                .returning(EmailOutbox.id, EmailOutbox.to_email, EmailOutbox.subject, EmailOutbox.body)
+            ).all()
+            session.commit()
+            return claimed
+
+    def drain_once(self) -> int:
+        """
+        Sends one batch of due emails and returns how many were attempted.
+        """
+        batch = self.claim_batch()
+        if not batch:
+            return 0
+        results = self.pool.send_many([build_email(queued.subject, queued.body, queued.to_email) for queued in batch])
+        errors = {queued.id: error for queued, error in zip(batch, results)}
+        with Session(engine) as session:
+            for queued in session.exec(select(EmailOutbox).where(EmailOutbox.id.in_(list(errors)))).all():
+                error = errors[queued.id]
+                if error is None:
+                    queued.status = "sent"
+                    queued.sent_at = utcnow()
+                    print(f"Email sent successfully to {queued.to_email}")
+                else:
+                    queued.attempts += 1
+                    queued.last_error = str(error)
+                    if queued.attempts >= self.max_attempts:
+                        queued.status = "failed"
+                        print(f"Giving up on email to {queued.to_email}: {error}")
+                    else:
+                        queued.status = "pending"
+                        queued.next_attempt_at = utcnow() + timedelta(seconds=self.backoff_base * 2 ** (queued.attempts - 1))
+                        print(f"Failed to send email to {queued.to_email}, will retry: {error}")
+                session.add(queued)
+            session.commit()
+        return len(batch)
+
+    def run(self) -> None:
+        """
+        Drains the outbox until stop() is called.
+        """
+        while not self._stop.is_set():
+            try:
+                sent = self.drain_once()
+            except Exception as e:
+                print(f"Outbox worker error: {e}")
+                sent = 0
+            if not sent:
+                self._stop.wait(self.poll_interval)
+
+    def start(self) -> "OutboxWorker":
+        self._thread = threading.Thread(target=self.run, name="email-outbox", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def send_email(subject: str, body: str, to_email: str):
+    """
+    Sends an email right away over a pooled SMTP session.
+    Tools queue mail with enqueue_email instead.
+    """
+    msg = build_email(subject, body, to_email)
+
+    try:
+        smtp_pool.send(msg)
+        print(f"Email sent successfully to {to_email}")
+    except Exception as e:
+        print(f"Failed to send email to {to_email}: {e}")
+
+
+outbox_worker: Optional[OutboxWorker] = OutboxWorker().start() if EMAIL_OUTBOX_WORKER == "thread" else None
+
+
+# Appointment maintenance
+# Set-based status transitions and cleanup. Each runs as UPDATE/DELETE ... WHERE id IN
+# (SELECT id ... LIMIT chunk_size), one short transaction per chunk, so row locks are
+# held briefly even on a large appointment table. MaintenanceRunner repeats the
+# routine jobs every MAINTENANCE_INTERVAL seconds.
+
+MAINTENANCE_WORKER = os.getenv("MAINTENANCE_WORKER", "off")  # 'thread' runs it in this process
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", "3600"))  # seconds
+MAINTENANCE_CHUNK_SIZE = int(os.getenv("MAINTENANCE_CHUNK_SIZE", "500"))
+PURGE_CANCELLED_AFTER_DAYS = int(os.getenv("PURGE_CANCELLED_AFTER_DAYS", "90"))
+
+
+def in_chunks(build_statement, conditions: list, chunk_size: int = MAINTENANCE_CHUNK_SIZE) -> int:
+    """
+    Runs build_statement(ids) over the appointments matching conditions, chunk_size rows
+    per transaction, until none are left. Returns the total number of rows affected.
+    """
+    total = 0
+    while True:
+        ids = select(Appointment.id).where(*conditions).order_by(Appointment.id).limit(chunk_size).scalar_subquery()
+        with engine.begin() as connection:
+            affected = connection.execute(build_statement(Appointment.id.in_(ids))).rowcount
+        total += affected
+        if affected < chunk_size:
+            return total
+
+
+def complete_past_appointments(chunk_size: int = MAINTENANCE_CHUNK_SIZE) -> int:
+    """
+    Marks every 'Booked' appointment that has already ended as 'Completed'.
+    """
+    completed = in_chunks(
+        lambda chunk: update(Appointment).where(chunk).values(status="Completed"),
+        [Appointment.status == "Booked", Appointment.end_time < datetime.now(CLINIC_TIMEZONE)],
+        chunk_size,
+    )
+    logger.info("Marked %d past appointments as completed", completed)
+    return completed
+
+
+def purge_cancelled_appointments(older_than_days: int = PURGE_CANCELLED_AFTER_DAYS, chunk_size: int = MAINTENANCE_CHUNK_SIZE) -> int:
+    """
+    Deletes 'Cancelled' appointments that started more than older_than_days ago.
+    """
+    purged = in_chunks(
+        lambda chunk: Appointment.__table__.delete().where(chunk),
+        [Appointment.status == "Cancelled", Appointment.start_time < datetime.now(CLINIC_TIMEZONE) - timedelta(days=older_than_days)],
+        chunk_size,
+    )
+    logger.info("Purged %d cancelled appointments", purged)
+    return purged
+
+
+def cancel_day_statement(doctor_id: int, date: str):
+    day = parse_date(date)
+    if day is None:
+        raise ValueError("Date must look like YYYY-MM-DD.")
+    day_start = datetime.combine(day, clock_time(0), tzinfo=CLINIC_TIMEZONE)
+    return (
+        update(Appointment)
+        .where(
+            Appointment.doctor_id == doctor_id,
+            Appointment.status == "Booked",
+            Appointment.start_time >= day_start,
+            Appointment.start_time < day_start + timedelta(days=1),
+        )
+        .values(status="Cancelled")
+        .returning(Appointment.patient_email, Appointment.date, Appointment.time)
+    )
+
+
+def enqueue_cancellations(session, doctor: Doctor, cancelled) -> None:
+    for patient_email, date, appointment_time in cancelled:
+        enqueue_email(
+            session,
+            f"Appointment with {doctor.name} cancelled",
+            f"Your appointment with {doctor.name} on {date} at {appointment_time} has been cancelled. Please book another slot.",
+            patient_email,
+        )
+
+
+def cancel_doctor_day(doctor_id: int, date: str, notify_patients: bool = False) -> Dict[str, Any]:
+    """
+    Cancels all of a doctor's booked appointments on a date (YYYY-MM-DD) in one step.
+    Set notify_patients to also email the affected patients. Admin only.
+    """
+    statement = cancel_day_statement(doctor_id, date)
+    with Session(engine) as session:
+        doctor = session.get(Doctor, doctor_id)
+        if not doctor:
+            raise ValueError("Doctor not found.")
+        cancelled = session.execute(statement).all()
+        if notify_patients:
+            enqueue_cancellations(session, doctor, cancelled)
+        session.commit()
+    logger.info("Cancelled %d appointments for doctor %d on %s", len(cancelled), doctor_id, date)
+    return {"doctor_id": doctor_id, "date": date, "cancelled": len(cancelled), "notified": len(cancelled) if notify_patients else 0}
+
+async def acancel_doctor_day(doctor_id: int, date: str, notify_patients: bool = False) -> Dict[str, Any]:
+    """
+    Async twin of cancel_doctor_day.
+    """
+    statement = cancel_day_statement(doctor_id, date)
+    async with async_session() as session:
+        doctor = await session.get(Doctor, doctor_id)
+        if not doctor:
+            raise ValueError("Doctor not found.")
+        cancelled = (await session.exec(statement)).all()
+        if notify_patients:
+            enqueue_cancellations(session, doctor, cancelled)
+        await session.commit()
+    logger.info("Cancelled %d appointments for doctor %d on %s", len(cancelled), doctor_id, date)
+    return {"doctor_id": doctor_id, "date": date, "cancelled": len(cancelled), "notified": len(cancelled) if notify_patients else 0}
+
+
+class MaintenanceRunner:
+    """
+    Runs the routine appointment jobs every interval seconds until stopped.
+    """
+
+    def __init__(self, interval: float = MAINTENANCE_INTERVAL, chunk_size: int = MAINTENANCE_CHUNK_SIZE,
+                 purge_after_days: int = PURGE_CANCELLED_AFTER_DAYS):
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.purge_after_days = purge_after_days
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_once(self) -> Dict[str, int]:
+        return {
+            "completed": complete_past_appointments(self.chunk_size),
+            "purged": purge_cancelled_appointments(self.purge_after_days, self.chunk_size),
+        }
+
+    def run(self) -> None:
+        """
+        Runs the jobs until stop() is called.
+        """
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Maintenance run failed")
+            self._stop.wait(self.interval)
+
+    def start(self) -> "MaintenanceRunner":
+        self._thread = threading.Thread(target=self.run, name="appointment-maintenance", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+maintenance_runner: Optional[MaintenanceRunner] = MaintenanceRunner().start() if MAINTENANCE_WORKER == "thread" else None
+
+def get_all_doctors() -> list[Doctor]:
     """
-    Retrieves all appointments for a specific user or patient.
+    Retrieves all doctors from the database.
     """
-    with Session(engine) as session:
-        appointments = session.exec(select(Appointment).where(Appointment.id == id)).all()
-        return appointments
+    def load() -> list[Doctor]:
+        with Session(engine) as session:
+            return session.exec(select(Doctor)).all()
+
+    return doctor_cache.get_or_load(("all_doctors",), load)
 
-def get_appointments_by_patient_name(patient_name: str,doctor_id:int) -> List[Appointment]:
+async def aget_all_doctors() -> list[Doctor]:
     """
-    Retrieves all appointments for a specific user by their patient_name and doctor ID. """
-    with Session(engine) as session:
-        # Query to get the user based on username
-        user = session.exec(select(User).where(User.patient_name == patient_name)).first()
+    Async twin of get_all_doctors.
+    """
+    async def load() -> list[Doctor]:
+        async with async_session() as session:
+            return (await session.exec(select(Doctor))).all()
+
+    return await doctor_cache.aget_or_load(("all_doctors",), load)
+
+
+# Doctor search
+# search_doctors answers "a heart doctor" or a misspelt name with the top matches only,
+# instead of the model scanning get_all_doctors. Postgres searches a GIN tsvector index
+# over name + specialty, ranked with pg_trgm name similarity when that extension is
+# available; SQLite searches an FTS5 table kept in sync by triggers. Lay terms are
+# expanded to specialty stems and unknown words are corrected against the indexed vocabulary.
+
+DOCTOR_SEARCH_LIMIT = int(os.getenv("DOCTOR_SEARCH_LIMIT", "5"))
+DOCTOR_SEARCH_MAX_LIMIT = 25
+
+SPECIALTY_SYNONYMS = {
+    "heart": ["cardio"], "cardiac": ["cardio"], "chest": ["cardio", "pulmo"],
+    "skin": ["derma"], "rash": ["derma"], "acne": ["derma"],
+    "child": ["pediatric", "paediatric"], "children": ["pediatric", "paediatric"], "kid": ["pediatric", "paediatric"], "baby": ["pediatric", "paediatric"],
+    "bone": ["ortho"], "joint": ["ortho"], "fracture": ["ortho"], "back": ["ortho"],
+    "brain": ["neuro"], "nerve": ["neuro"], "headache": ["neuro"], "migraine": ["neuro"],
+    "eye": ["ophthalm", "optom"], "vision": ["ophthalm", "optom"],
+    "teeth": ["dent"], "tooth": ["dent"], "dental": ["dent"],
+    "women": ["gyn", "obstet"], "pregnancy": ["obstet", "gyn"],
+    "ear": ["ent", "otolaryng"], "nose": ["ent", "otolaryng"], "throat": ["ent", "otolaryng"],
+    "mental": ["psych"], "anxiety": ["psych"], "depression": ["psych"],
+    "stomach": ["gastro"], "digestion": ["gastro"], "liver": ["hepat", "gastro"],
+    "kidney": ["nephro", "urolog"], "urine": ["urolog"],
+    "lung": ["pulmo"], "breathing": ["pulmo"], "asthma": ["pulmo"],
+    "cancer": ["onco"], "tumor": ["onco"],
+    "diabetes": ["endocrin"], "thyroid": ["endocrin"], "hormone": ["endocrin"],
+    "fever": ["general", "family"], "flu": ["general", "family"], "checkup": ["general", "family"],
+}
+
+SEARCH_STOP_WORDS = {"a", "an", "the", "for", "of", "and", "my", "me", "i", "need", "want", "find", "with",
+                     "doctor", "doctors", "dr", "specialist", "someone", "who", "treats", "good"}
+
+SEARCH_DOCUMENT = "to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(specialty, ''))"
+
+
+def setup_doctor_search() -> str:
+    """
+    Creates the search indexes for this database and returns the backend in use:
+    'postgres+trgm', 'postgres', 'fts5' or 'like'.
+    """
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as connection:
+            connection.execute(text(f"CREATE INDEX IF NOT EXISTS ix_doctor_search ON doctor USING gin ({SEARCH_DOCUMENT})"))
+        try:
+            with engine.begin() as connection:
+                connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                connection.execute(text("CREATE INDEX IF NOT EXISTS ix_doctor_name_trgm ON doctor USING gin (lower(name) gin_trgm_ops)"))
+            return "postgres+trgm"
+        except DBAPIError as e:
+            print(f"pg_trgm unavailable, doctor search falls back to full-text only: {e.orig}")
+            return "postgres"
+    if engine.dialect.name == "sqlite":
+        try:
+            with engine.begin() as connection:
+                exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'doctor_fts'")).first()
+                connection.execute(text(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS doctor_fts USING fts5(name, specialty, content='doctor', content_rowid='id')"
+                ))
+                connection.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS doctor_fts_vocab USING fts5vocab(doctor_fts, 'row')"))
+                connection.execute(text(
+                    "CREATE TRIGGER IF NOT EXISTS doctor_fts_insert AFTER INSERT ON doctor BEGIN "
+                    "INSERT INTO doctor_fts(rowid, name, specialty) VALUES (new.id, new.name, new.specialty); END"
+                ))
+                connection.execute(text(
+                    "CREATE TRIGGER IF NOT EXISTS doctor_fts_delete AFTER DELETE ON doctor BEGIN "
+                    "INSERT INTO doctor_fts(doctor_fts, rowid, name, specialty) VALUES ('delete', old.id, old.name, old.specialty); END"
+                ))
+                connection.execute(text(
+                    "CREATE TRIGGER IF NOT EXISTS doctor_fts_update AFTER UPDATE ON doctor BEGIN "
+                    "INSERT INTO doctor_fts(doctor_fts, rowid, name, specialty) VALUES ('delete', old.id, old.name, old.specialty); "
+                    "INSERT INTO doctor_fts(rowid, name, specialty) VALUES (new.id, new.name, new.specialty); END"
+                ))
+                if not exists:
+                    connection.execute(text("INSERT INTO doctor_fts(doctor_fts) VALUES ('rebuild')"))
+            return "fts5"
+        except DBAPIError as e:
+            print(f"FTS5 unavailable, doctor search falls back to LIKE: {e.orig}")
+    return "like"
+
+
+doctor_search_backend = setup_doctor_search()
+
+
+def search_terms(query: str) -> List[str]:
+    """
+    Lower-cased query words without stop words, followed by their specialty stems.
+    """
+    words = [word for word in re.findall(r"[a-z0-9]+", query.lower()) if word not in SEARCH_STOP_WORDS]
+    terms = list(words)
+    for word in words:
+        for synonym in SPECIALTY_SYNONYMS.get(word, []) + SPECIALTY_SYNONYMS.get(word.rstrip("s"), []):
+            if synonym not in terms:
+                terms.append(synonym)
+    return terms
 
-        # If user does not exist, return an empty list
-        if not user:
 
-            return print(f"No user found with username: {username}")
+def correct_terms(terms: List[str], vocabulary: List[str]) -> List[str]:
+    """
+    Adds the closest indexed words for any term that isn't a prefix of one (i.e. likely misspelt).
+    """
+    corrected = list(terms)
+    for term in terms:
+        if not any(word.startswith(term) for word in vocabulary):
+            for match in difflib.get_close_matches(term, vocabulary, n=2, cutoff=0.7):
+                if match not in corrected:
+                    corrected.append(match)
+    return corrected
 
 
-        appointments = session.exec(select(Appointment).where(Appointment.doctor_id == doctor_id)).all()
+def vocabulary_query():
+    if doctor_search_backend == "fts5":
+        return text("SELECT term FROM doctor_fts_vocab")
+    return text("SELECT name, specialty FROM doctor")
 
-        return appointments
 
+def vocabulary_words(rows) -> List[str]:
+    words = set()
+    for row in rows:
+        for value in row:
+            words.update(re.findall(r"[a-z0-9]+", (value or "").lower()))
+    return sorted(words)
 
 
-def update_appointment(appointment_id: int, status: str) -> Optional[Appointment]:
+def doctor_search_query(terms: List[str], query: str, limit: int) -> tuple:
     """
-    Updates the status of an existing appointment (e.g., 'Completed').
+    Builds the ranked top-k search statement and its parameters for the current backend.
     """
-    with Session(engine) as session:
-        appointment = session.exec(select(Appointment).where(Appointment.id == appointment_id)).first()
-        if appointment:
-            appointment.status = status
-            session.add(appointment)
-            session.commit()
-            session.refresh(appointment)
-        return appointment
+    if doctor_search_backend.startswith("postgres"):
+        params = {"tsquery": " | ".join(f"{term}:*" for term in terms), "query": query.lower(), "limit": limit}
+        score = f"ts_rank({SEARCH_DOCUMENT}, to_tsquery('simple', :tsquery))"
+        match = f"{SEARCH_DOCUMENT} @@ to_tsquery('simple', :tsquery)"
+        if doctor_search_backend == "postgres+trgm":
+            score += " + word_similarity(:query, lower(name))"
+            match += " OR :query <% lower(name)"
+        statement = f"SELECT id, name, specialty, available FROM doctor WHERE {match} ORDER BY {score} DESC, id LIMIT :limit"
+    elif doctor_search_backend == "fts5":
+        params = {"match": " OR ".join(f'"{term}"*' for term in terms), "limit": limit}
+        statement = (
+            "SELECT doctor.id, doctor.name, doctor.specialty, doctor.available FROM doctor_fts "
+            "JOIN doctor ON doctor.id = doctor_fts.rowid WHERE doctor_fts MATCH :match "
+            "ORDER BY bm25(doctor_fts), doctor.id LIMIT :limit"
+        )
+    else:
+        params = {f"term{index}": f"%{term}%" for index, term in enumerate(terms)}
+        params["limit"] = limit
+        match = " OR ".join(f"lower(name) LIKE :term{index} OR lower(specialty) LIKE :term{index}" for index in range(len(terms)))
+        statement = f"SELECT id, name, specialty, available FROM doctor WHERE {match} ORDER BY id LIMIT :limit"
+    return text(statement), params
 
-def delete_appointment(appointment_id: int) -> bool:
+
+def search_doctors(query: str, limit: int = DOCTOR_SEARCH_LIMIT) -> list[Doctor]:
     """
-    Deletes an appointment from the database by appointment ID.
+    Finds the doctors best matching a name, specialty or complaint (e.g. 'heart doctor',
+    'dermatologist', 'Dr Jhon'), best match first. Use this instead of get_all_doctors
+    when the user is looking for someone specific.
     """
-    with Session(engine) as session:
-        appointment = session.exec(select(Appointment).where(Appointment.id == appointment_id)).first()
-        if appointment:
-            session.delete(appointment)
-            session.commit()
-            return True
-        return False
+    terms = search_terms(query)
+    if not terms:
+        return []
+    limit = max(1, min(limit, DOCTOR_SEARCH_MAX_LIMIT))
 
+    def load_vocabulary() -> List[str]:
+        with Session(engine) as session:
+            return vocabulary_words(session.execute(vocabulary_query()).all())
 
-# Email Sending Function
+    def load() -> list[Doctor]:
+        statement, params = doctor_search_query(correct_terms(terms, doctor_cache.get_or_load(("doctor_vocabulary",), load_vocabulary)), query, limit)
+        with Session(engine) as session:
+            return [Doctor(**row._mapping) for row in session.execute(statement, params).all()]
 
-def send_email(subject: str, body: str, to_email: str):
-    """
-    Sends an email using the smtplib library and Gmail's SMTP server.
-    """
-    msg = EmailMessage()
-    msg.set_content(body)
-    msg['Subject'] = subject
-    msg['From'] = MAIL_USERNAME
-    msg['To'] = to_email
+    return doctor_cache.get_or_load(("search", tuple(terms), limit), load)
 
-    try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-            server.login(MAIL_USERNAME, MAIL_PASSWORD)
-            server.send_message(msg)
-        print(f"Email sent successfully to {to_email}")
-    except Exception as e:
-        print(f"Failed to send email to {to_email}: {e}")
-def get_all_doctors() -> list[Doctor]:
+
+async def asearch_doctors(query: str, limit: int = DOCTOR_SEARCH_LIMIT) -> list[Doctor]:
     """
-    Retrieves all doctors from the database.
+    Async twin of search_doctors.
     """
-    with Session(engine) as session:
-        doctors = session.exec(select(Doctor)).all()
-        return doctors
+    terms = search_terms(query)
+    if not terms:
+        return []
+    limit = max(1, min(limit, DOCTOR_SEARCH_MAX_LIMIT))
+
+    async def load_vocabulary() -> List[str]:
+        async with async_session() as session:
+            return vocabulary_words((await session.exec(vocabulary_query())).all())
+
+    async def load() -> list[Doctor]:
+        vocabulary = await doctor_cache.aget_or_load(("doctor_vocabulary",), load_vocabulary)
+        statement, params = doctor_search_query(correct_terms(terms, vocabulary), query, limit)
+        async with async_session() as session:
+            return [Doctor(**row._mapping) for row in (await session.exec(statement, params=params)).all()]
+
+    return await doctor_cache.aget_or_load(("search", tuple(terms), limit), load)
 
 
 
 # CRUD Operations for Appointments
 
-def get_appointment(appointment_id: int) -> Optional[Appointment]:
+def get_appointment(appointment_id: int, session: Annotated[Optional[str], InjectedState("session")] = None) -> Optional[Appointment]:
     """
-    Retrieves a specific appointment by its ID.
+    Retrieves a specific appointment by its ID. Patients only see their own.
     """
+    owner = appointment_owner(session)
     with Session(engine) as session:
-        appointment = session.exec(select(Appointment).where(Appointment.id == appointment_id)).first()
+        appointment = session.exec(owned_appointment_query(appointment_id, owner)).first()
+        return appointment
+
+async def aget_appointment(appointment_id: int, session: Annotated[Optional[str], InjectedState("session")] = None) -> Optional[Appointment]:
+    """
+    Async twin of get_appointment.
+    """
+    owner = appointment_owner(session)
+    async with async_session() as session:
+        appointment = (await session.exec(owned_appointment_query(appointment_id, owner))).first()
         return appointment
 
 
@@ -403,6 +2797,16 @@ def get_user(user_id: int) -> Optional[User]:
             print(f"No user found with id: {user_id}")
         return user
 
+async def aget_user(user_id: int) -> Optional[User]:
+    """
+    Async twin of get_user.
+    """
+    async with async_session() as session:
+        user = (await session.exec(select(User).where(User.id == user_id))).first()
+        if not user:
+            print(f"No user found with id: {user_id}")
+        return user
+
 def get_user_by_username(username: str) -> Optional[User]:
     """
     Retrieves a user by their username.
@@ -413,6 +2817,16 @@ def get_user_by_username(username: str) -> Optional[User]:
             print(f"No user found with name: {username}")
         return user
 
+async def aget_user_by_username(username: str) -> Optional[User]:
+    """
+    Async twin of get_user_by_username.
+    """
+    async with async_session() as session:
+        user = (await session.exec(select(User).where(User.username == username))).first()
+        if not user:
+            print(f"No user found with name: {username}")
+        return user
+
 def get_all_users() -> List[User]:
     """
     Retrieves a list of all users or function to retrieve a list of all users.
@@ -426,33 +2840,301 @@ def get_all_users() -> List[User]:
             print("No users found")
         return users
 
+async def aget_all_users() -> List[User]:
+    """
+    Async twin of get_all_users.
+    """
+    async with async_session() as session:
+        users = (await session.exec(select(User))).all()
+        if not users:
+            print("No users found")
+        return users
+
 #==============================
 
+# Upper bound on tool calls from a single assistant turn that run at the same time.
+# Each call still opens its own Session, so this also caps DB connections per turn.
+TOOL_MAX_CONCURRENCY = int(os.getenv("TOOL_MAX_CONCURRENCY", "8"))
+
+# One semaphore per tools-node run, keyed by its checkpoint namespace ("tools:<task id>").
+# Entries drop out once the run's last call finishes, so conversations never share one.
+_tool_semaphores: "weakref.WeakValueDictionary[str, asyncio.Semaphore]" = weakref.WeakValueDictionary()
+
+
+def bounded(coroutine):
+    """
+    Wraps a tool coroutine so at most TOOL_MAX_CONCURRENCY calls from the same
+    assistant turn run at once. Calls made outside a graph run are not limited.
+    """
+    @functools.wraps(coroutine)
+    async def wrapper(*args, **kwargs):
+        try:
+            turn = get_config()["metadata"]["checkpoint_ns"]
+        except (RuntimeError, KeyError):
+            return await coroutine(*args, **kwargs)
+        semaphore = _tool_semaphores.get(turn)
+        if semaphore is None:
+            semaphore = _tool_semaphores[turn] = asyncio.Semaphore(TOOL_MAX_CONCURRENCY)
+        async with semaphore:
+            return await coroutine(*args, **kwargs)
+    return wrapper
+
+
+# Tool result serialization
+# ToolNode would otherwise stringify whole SQLModel objects (password hashes included)
+# into ToolMessages that are resent on every later turn. Results are instead rendered
+# as compact JSON with a fixed set of fields per model, and lists longer than
+# TOOL_RESULT_MAX_ITEMS are cut short with a continuation token for more_results.
+# The cut-off items ride along as the ToolMessage's artifact, which is checkpointed
+# with the conversation but never sent to the model, so more_results works in any
+# worker and only within the conversation that produced the token. Paged results
+# (those with a next_cursor) are left to their cursor and never cut short.
+TOOL_RESULT_MAX_ITEMS = int(os.getenv("TOOL_RESULT_MAX_ITEMS", "25"))
+
+TOOL_RESULT_FIELDS = {
+    User: ["id", "username", "role", "email"],
+    Doctor: ["id", "name", "specialty", "available"],
+    Appointment: ["id", "doctor_id", "patient_name", "date", "time", "status", "send_notification"],
+}
+
+
+def compact(value, continuations: Dict[str, list], truncate_lists: bool = True):
+    """
+    Reduces a tool result to plain JSON-ready data with only the fields the assistant
+    needs, moving the tail of any long list into continuations.
+    """
+    if isinstance(value, SQLModel):
+        fields = TOOL_RESULT_FIELDS.get(type(value))
+        data = value.model_dump(mode="json", include=set(fields) if fields else None)
+        return {field: data.get(field) for field in fields} if fields else data
+    if isinstance(value, dict):
+        paged = "next_cursor" in value
+        return {key: compact(item, continuations, truncate_lists and not paged) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [compact(item, continuations) for item in value]
+        return truncate(items, continuations) if truncate_lists else items
+    if isinstance(value, (datetime, calendar_date, clock_time)):
+        return value.isoformat()
+    return value
+
+
+def truncate(items: list, continuations: Dict[str, list]):
+    """
+    Returns short lists unchanged and long ones as {"items", "remaining", "continuation"}.
+    """
+    if len(items) <= TOOL_RESULT_MAX_ITEMS:
+        return items
+    token = secrets.token_urlsafe(8)
+    continuations[token] = items[TOOL_RESULT_MAX_ITEMS:]
+    return {"items": items[:TOOL_RESULT_MAX_ITEMS], "remaining": len(items) - TOOL_RESULT_MAX_ITEMS, "continuation": token}
+
+
+def serialize_result(name: str, value) -> Tuple[Any, Optional[Dict[str, list]]]:
+    """
+    Renders a tool result as compact JSON and logs its approximate token count.
+    Returns it with the items cut from long lists, keyed by continuation token, to
+    store as the ToolMessage artifact. Strings and LangGraph objects such as Command
+    are passed through untouched.
+    """
+    if isinstance(value, (str, Command)):
+        return value, None
+    continuations: Dict[str, list] = {}
+    content = json.dumps(compact(value, continuations), ensure_ascii=False, separators=(",", ":"), default=str)
+    print(f"Tool result {name}: ~{count_tokens_approximately([ToolMessage(content=content, tool_call_id=name)])} tokens")
+    return content, continuations or None
+
+
+def more_results(continuation: str, messages: Annotated[list, InjectedState("messages")] = None) -> Any:
+    """
+    Returns the next items of a truncated list, given the continuation token from an earlier tool result.
+    """
+    for message in reversed(messages or []):
+        if isinstance(message, ToolMessage) and isinstance(message.artifact, dict) and continuation in message.artifact:
+            return message.artifact[continuation]
+    raise ValueError("Continuation token is unknown or has expired; run the original query again.")
+
+async def amore_results(continuation: str, messages: Annotated[list, InjectedState("messages")] = None) -> Any:
+    """
+    Async twin of more_results.
+    """
+    return more_results(continuation, messages)
+
+
+def serialized(func, name: str):
+    """
+    Wraps a tool function (sync or async) so its result goes through serialize_result.
+    """
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            return serialize_result(name, await func(*args, **kwargs))
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return serialize_result(name, func(*args, **kwargs))
+    return wrapper
+
+
+def make_tool(func, coroutine, name: Optional[str] = None) -> StructuredTool:
+    """
+    Builds a tool from a sync function and its async twin, named after the function unless name is given.
+    """
+    name = name or func.__name__
+    return StructuredTool.from_function(
+        func=serialized(func, name), coroutine=bounded(serialized(coroutine, name)), name=name, response_format="content_and_artifact",
+    )
+
+
 # Define the tools for CRUD operations
+# Each tool carries its sync function and its async twin; ToolNode runs the
+# coroutine when the graph is driven asynchronously (as under the LangGraph server).
+# Independent tool calls from one AIMessage fan out concurrently: gathered on the
+# event loop in async mode, on a thread pool in sync mode, both capped at
+# TOOL_MAX_CONCURRENCY.
 tools = [
-    signup,
-    signin,
-    delete_user,
-    add_doctor,
-    get_doctor,
-    update_doctor,
-    delete_doctor,
-    get_all_doctors,          # Newly added function to get all doctors
-    book_appointment,
+    make_tool(signup_session, asignup_session, name="signup"),
+    make_tool(signin_session, asignin_session, name="signin"),
+    make_tool(current_user, acurrent_user),
+    make_tool(delete_user, adelete_user),
+    make_tool(add_doctor, aadd_doctor),
+    make_tool(bulk_add_doctors, abulk_add_doctors),
+    make_tool(get_doctor, aget_doctor),
+    make_tool(update_doctor, aupdate_doctor),
+    make_tool(delete_doctor, adelete_doctor),
+    make_tool(get_all_doctors, aget_all_doctors),          # Newly added function to get all doctors
+    make_tool(search_doctors, asearch_doctors),
+    make_tool(get_available_slots, aget_available_slots),
+    make_tool(set_doctor_schedule, aset_doctor_schedule),
+    make_tool(add_schedule_exception, aadd_schedule_exception),
+    make_tool(book_appointment, abook_appointment),
     # send_notification,
-    get_appointments_by_user,
-    get_appointment,          # Newly added function to get a specific appointment
-    update_appointment,
-    delete_appointment,
+    make_tool(get_appointments_by_user, aget_appointments_by_user),
+    make_tool(get_appointment, aget_appointment),          # Newly added function to get a specific appointment
+    make_tool(update_appointment, aupdate_appointment),
+    make_tool(delete_appointment, adelete_appointment),
+    make_tool(cancel_doctor_day, acancel_doctor_day),
     # send_email,
-    get_appointments_by_patient_name
+    make_tool(get_appointments_by_patient_name, aget_appointments_by_patient_name),
+    make_tool(list_appointments_by_doctor, alist_appointments_by_doctor),
+    make_tool(list_appointments_by_patient, alist_appointments_by_patient),
+    make_tool(list_appointments_by_status, alist_appointments_by_status),
+    make_tool(more_results, amore_results),
 ]
 
+# Tools each role may call. The assistant is bound to only these, and any other
+# call is rejected before it reaches ToolNode.
+GUEST_TOOLS = ["signup", "signin", "current_user", "get_all_doctors", "get_doctor", "search_doctors", "more_results"]
+PATIENT_TOOLS = GUEST_TOOLS + [
+    "get_available_slots", "book_appointment", "get_appointments_by_user", "get_appointment",
+    "update_appointment", "get_appointments_by_patient_name", "list_appointments_by_patient",
+]
+ROLE_TOOLS = {
+    "guest": GUEST_TOOLS,
+    "user": PATIENT_TOOLS,
+    "admin": [tool.name for tool in tools],
+}
+
+
+def tools_for_role(role: str) -> list:
+    return [tool for tool in tools if tool.name in ROLE_TOOLS[role]]
+
 
 # LLM
-llm: ChatGoogleGenerativeAI = ChatGoogleGenerativeAI(model="gemini-1.5-flash")
+# Models are named "provider:model" and chosen per node, so the history summary can
+# run on a cheaper model than the assistant. The "fake" provider is the scripted local
+# model from fakes.py for offline runs; its model name is "default" or the path of a
+# JSON script in fakes.FAKE_LLM_SCRIPT's format. A run can also pass a model in as
+# config["configurable"]["chat_model"], which the assistant and the summary then use.
+LLM_MODEL = os.getenv("LLM_MODEL", "google:gemini-1.5-flash")
+ASSISTANT_MODEL = os.getenv("ASSISTANT_MODEL", LLM_MODEL)
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", LLM_MODEL)
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))  # seconds per request
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BACKOFF = float(os.getenv("LLM_RETRY_BACKOFF", "1"))  # seconds, doubled per retry
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0"))  # seconds per scripted reply
+
+LLM_RETRYABLE_ERRORS = (ModelRateLimitError, ModelAPIError, ModelConnectionError, ModelTimeoutError, TimeoutError, ConnectionError)
+
+def google_chat_model(model: str) -> BaseChatModel:
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    # Retries are done by call_llm/stream_response so they also cover streaming
+    return ChatGoogleGenerativeAI(model=model, timeout=LLM_TIMEOUT, max_retries=0)
+
+
+def fake_chat_model(model: str) -> BaseChatModel:
+    from fakes import FAKE_LLM_SCRIPT, ScriptedChatModel
+
+    if model == "default":
+        script = FAKE_LLM_SCRIPT
+    else:
+        with open(model) as f:
+            script = json.load(f)
+    return ScriptedChatModel(script=script, latency=FAKE_LLM_LATENCY)
+
+
+LLM_PROVIDERS = {
+    "google": google_chat_model,
+    "fake": fake_chat_model,
+}
+
+
+def chat_model(spec: str) -> BaseChatModel:
+    """
+    Builds the chat model named by a "provider:model" spec.
+    """
+    provider, _, model = spec.partition(":")
+    if provider not in LLM_PROVIDERS:
+        raise ValueError(f"Unknown LLM provider '{provider}'. Choose from: {', '.join(LLM_PROVIDERS)}")
+    return LLM_PROVIDERS[provider](model)
 
-llm_with_tools = llm.bind_tools(tools)
+
+def llm_retry_delay(attempt: int, error: Exception) -> float:
+    """
+    Seconds to wait before retrying a failed model call, with jitter. Re-raises
+    the error if it isn't transient or LLM_MAX_RETRIES retries are spent.
+    """
+    if attempt >= LLM_MAX_RETRIES or not isinstance(error, LLM_RETRYABLE_ERRORS):
+        raise error
+    delay = LLM_RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.0)
+    print(f"Model call failed ({error!r}), retrying in {delay:.1f}s")
+    return delay
+
+
+def call_llm(model, messages: List, **kwargs):
+    """
+    Invokes the model, retrying transient failures with exponential backoff.
+    """
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            return model.invoke(messages, **kwargs)
+        except Exception as e:
+            time.sleep(llm_retry_delay(attempt, e))
+
+
+async def acall_llm(model, messages: List, **kwargs):
+    """
+    Async twin of call_llm.
+    """
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            return await model.ainvoke(messages, **kwargs)
+        except Exception as e:
+            await asyncio.sleep(llm_retry_delay(attempt, e))
+
+
+llm: BaseChatModel = chat_model(ASSISTANT_MODEL)
+summary_llm: BaseChatModel = chat_model(SUMMARY_MODEL) if SUMMARY_MODEL != ASSISTANT_MODEL else llm
+
+
+def configured_model(config: Optional[RunnableConfig]) -> Optional[BaseChatModel]:
+    """
+    The chat model passed in as config["configurable"]["chat_model"] for this run, if any.
+    """
+    return ((config or {}).get("configurable") or {}).get("chat_model")
+
+role_llms = {role: llm.bind_tools(tools_for_role(role)) for role in ROLE_TOOLS}
 
 sys_prompt = """
 You are a proficient assistant managing a role-based doctor appointment system. Your responsibilities include:
@@ -492,17 +3174,24 @@ You are a proficient assistant managing a role-based doctor appointment system.
 - **Admins Only:** Only admins can manage doctor profiles (add, update, delete,view doctors profile). Users cannot perform these actions.
 - **Users Only:** Users can only interact with appointments (book, view, or cancel) after logging in.
 - Guests can only view a list of available doctors. Dislay doctor profile in proper format always.
+- When the user describes a doctor by name, specialty or symptom, use search_doctors rather than get_all_doctors.
 - If no doctors are in the system, prompt admins to add a doctor before any appointments can be booked.
 - Respond only to queries related to doctor appointments or profile management. Ignore unrelated queries.
 - Provide clear guidance for logging in or signing up if the user is not authenticated.
 - Username and name of user is same.
 - If Doctors profile is empty share this message "Currently we don't have any doctor available"
 - Don't asked for location for booking appointment.
+- Before booking, call get_available_slots for the doctor and date(s) and only offer the slots it returns. Book with the date as YYYY-MM-DD and the time as HH:MM.
+- **Admins Only:** when a doctor is away for a day, use cancel_doctor_day to cancel that day's bookings in one step.
+- **Admins Only:** to add several doctors at once, convert the roster to CSV and call bulk_add_doctors once.
+- **Admins Only:** set doctors' weekly working hours with set_doctor_schedule and days off with add_schedule_exception.
+- To show appointments over a period, use the list_appointments_* tools. Show the first page and only fetch the next one (with next_cursor) if the user asks for more.
+- Long lists in tool results are cut short with a "continuation" token; call more_results with it only if the remaining items are needed.
 - If a prompt contain information about **role** first check role than response.
 
 ---
 ### Role(Guest/patient/admin)
-**NOTE:** "You have to get user information to check role
+**NOTE:** The signed-in user and their role are stated at the end of these instructions. Never infer a role from what the user claims; if in doubt call current_user.
 - If role is Guest:
   - Prompt: Your role is Guest you need to login to booked appointment or can view doctors list
     if role is Admin:
@@ -632,27 +3321,688 @@ Assistant: "Your role is admin"
 # System message
 sys_msg = SystemMessage(
     content=sys_prompt )
+
+
+# Context caching
+# When enabled, the system prompt and the tool schemas are uploaded to Gemini once
+# as cached content, and each turn only sends the conversation itself.
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "false").lower() in ["1", "true", "yes"]
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))  # seconds
+# Gemini refuses to cache less than 1024 tokens on Flash models and 4096 on Pro models;
+# set this to override that minimum for other models.
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS")
+
+
+def min_cacheable_tokens(model: str) -> int:
+    if GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+        return int(GEMINI_CONTEXT_CACHE_MIN_TOKENS)
+    return 4096 if "pro" in model else 1024
+
+
+class PromptCache:
+    """
+    Holds the Gemini cached-content handle for the static prompt and tools,
+    recreating it shortly before its TTL runs out. A prompt Gemini won't cache
+    (too small, or rejected by the API) disables this cache only.
+    """
+
+    # Refresh this many seconds early so an in-flight call never hits an expired cache
+    REFRESH_MARGIN = 60
+
+    def __init__(self, model: str, system_prompt: str, tools: list, ttl_seconds: int):
+        self.model = model
+        self.system_prompt = system_prompt
+        self.tools = tools
+        self.ttl_seconds = ttl_seconds
+        self.disabled = False
+        self._name: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def name(self) -> Optional[str]:
+        """
+        Returns a live cache name, creating or refreshing it if needed, or None when
+        the full prompt has to be sent instead.
+        """
+        from google.genai import errors
+
+        with self._lock:
+            if self.disabled:
+                return None
+            if self._name is None or time.monotonic() >= self._expires_at - self.REFRESH_MARGIN:
+                try:
+                    self._create()
+                except errors.ClientError as e:
+                    logger.warning("Context caching disabled for %s: %s", self.model, e)
+                    self.disabled = True
+                    return None
+                except errors.ServerError as e:
+                    # Transient; try again on a later turn
+                    logger.warning("Could not create the Gemini context cache, sending the full prompt: %s", e)
+                    return None
+            return self._name
+
+    def _declarations(self) -> list:
+        from langchain_google_genai._function_utils import convert_to_genai_function_declarations
+
+        return convert_to_genai_function_declarations(self.tools)
+
+    def token_count(self) -> int:
+        """
+        Approximate size of the prompt and tool schemas to be cached.
+        """
+        from google import genai
+
+        tools = "\n".join(tool.model_dump_json(exclude_none=True) for tool in self._declarations())
+        return genai.Client().models.count_tokens(model=self.model, contents=f"{self.system_prompt}\n{tools}").total_tokens
+
+    def _create(self) -> None:
+        from google import genai
+        from google.genai import types
+
+        tokens = self.token_count()
+        minimum = min_cacheable_tokens(self.model)
+        if tokens < minimum:
+            logger.info("Context caching disabled for %s: the prompt is %d tokens, under the %d-token minimum", self.model, tokens, minimum)
+            self.disabled = True
+            return
+        cache = genai.Client().caches.create(
+            model=self.model,
+            config=types.CreateCachedContentConfig(
+                display_name="doctor-appointment-system-prompt",
+                system_instruction=self.system_prompt,
+                tools=self._declarations(),
+                ttl=f"{self.ttl_seconds}s",
+            ),
+        )
+        self._name = cache.name
+        self._expires_at = time.monotonic() + self.ttl_seconds
+        logger.info("Created Gemini context cache %s (ttl %ss)", cache.name, self.ttl_seconds)
+
+
+# One cache per role, since each role is bound to a different tool subset
+prompt_caches: Optional[Dict[str, PromptCache]] = (
+    {role: PromptCache(llm.model, sys_prompt, tools_for_role(role), GEMINI_CONTEXT_CACHE_TTL) for role in ROLE_TOOLS}
+    if GEMINI_CONTEXT_CACHE and ASSISTANT_MODEL.startswith("google:") else None
+)
+
+
+# State
+class State(MessagesState):
+    summary: str  # Rolling summary of messages trimmed from the history
+    session: str  # Signed session token set by signin/signup or passed in by the client
+
+
+# History windowing
+# Once the history grows past HISTORY_TOKEN_BUDGET, the oldest turns are folded into
+# the rolling summary and removed from state (and therefore from the checkpoint).
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "4000"))
+
+def trim_history(state: State, config: RunnableConfig):
+    """
+    Keeps the newest turns within HISTORY_TOKEN_BUDGET and summarizes the rest.
+
+    Cuts only happen at a HumanMessage, so an AIMessage is never separated from
+    the ToolMessages answering its tool calls, and the current turn is always kept.
+    """
+    messages = state["messages"]
+    token_counts = [count_tokens_approximately([message]) for message in messages]
+    if sum(token_counts) <= HISTORY_TOKEN_BUDGET:
+        return {}
+
+    boundaries = [i for i, message in enumerate(messages) if isinstance(message, HumanMessage) and i > 0]
+    if not boundaries:
+        return {}
+
+    # Earliest boundary whose tail fits the budget, else the start of the current turn
+    cut = boundaries[-1]
+    for i in boundaries:
+        if sum(token_counts[i:]) <= HISTORY_TOKEN_BUDGET:
+            cut = i
+            break
+    trimmed = messages[:cut]
+
+    summary = state.get("summary", "")
+    if summary:
+        summary_message = (
+            f"This is summary of the conversation to date: {summary}\n\n"
+            "Extend the summary by taking into account the new messages above:"
+        )
+    else:
+        summary_message = "Create a summary of the conversation above:"
+    # nostream keeps the summary out of stream_mode="messages", where it would look like a reply
+    response = call_llm(configured_model(config) or summary_llm, trimmed + [HumanMessage(content=summary_message)], config={"tags": ["nostream"]})
+
+    return {
+        "summary": response.content,
+        "messages": [RemoveMessage(id=message.id) for message in trimmed],
+    }
+
+
+def history_context(state: State) -> str:
+    """
+    Builds the note added to the prompt: the summary standing in for trimmed
+    history, if any, and who is signed in according to the session token.
+    """
+    parts = []
+    if state.get("summary"):
+        parts.append(f"Summary of the earlier conversation: {state['summary']}")
+    principal = verify_session_token(state.get("session"))
+    if principal:
+        parts.append(f"Signed-in user: {principal['sub']} (id {principal['uid']}), role: {principal['role']}.")
+    elif state.get("session"):
+        parts.append("The user's session has expired; they are a Guest until they sign in again.")
+    else:
+        parts.append("Nobody is signed in; the user is a Guest.")
+    return "\n\n".join(parts)
+
+
+# Streaming
+# The assistant streams its reply instead of waiting for the whole message. Text chunks
+# reach clients as they arrive through stream_mode="messages" (LangChain's token
+# callbacks) and as {"token": ...} events on stream_mode="custom"; tool-call chunks
+# are only merged into the final message, which the graph state gets in one piece.
+
+ASSISTANT_STREAMING = os.getenv("ASSISTANT_STREAMING", "true").lower() in ["1", "true", "yes"]
+
+
+def chunk_text(chunk) -> str:
+    if isinstance(chunk.content, str):
+        return chunk.content
+    return "".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in chunk.content)
+
+
+def merge_chunks(merged, chunk, writer):
+    text = chunk_text(chunk)
+    if text:
+        writer({"token": text})
+    return chunk if merged is None else merged + chunk
+
+
+def stream_response(model, messages: List, **kwargs):
+    """
+    Streams the model's reply, passing text through to the stream writer, and
+    returns the complete message with its tool calls assembled.
+    """
+    if not ASSISTANT_STREAMING:
+        return call_llm(model, messages, **kwargs)
+    writer = get_stream_writer()
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        merged = None
+        try:
+            for chunk in model.stream(messages, **kwargs):
+                merged = merge_chunks(merged, chunk, writer)
+            break
+        except Exception as e:
+            if merged is not None:
+                raise  # text already went out to the client; a retry would repeat it
+            time.sleep(llm_retry_delay(attempt, e))
+    return message_chunk_to_message(merged) if merged is not None else call_llm(model, messages, **kwargs)
+
+
+async def astream_response(model, messages: List, **kwargs):
+    """
+    Async twin of stream_response.
+    """
+    if not ASSISTANT_STREAMING:
+        return await acall_llm(model, messages, **kwargs)
+    writer = get_stream_writer()
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        merged = None
+        try:
+            async for chunk in model.astream(messages, **kwargs):
+                merged = merge_chunks(merged, chunk, writer)
+            break
+        except Exception as e:
+            if merged is not None:
+                raise  # text already went out to the client; a retry would repeat it
+            await asyncio.sleep(llm_retry_delay(attempt, e))
+    return message_chunk_to_message(merged) if merged is not None else await acall_llm(model, messages, **kwargs)
+
+
 # Node
 
 
-def assistant(state: MessagesState):
-    return {"messages": [llm_with_tools.invoke([sys_msg] + state["messages"])]}
+def role_of(state: State) -> str:
+    """
+    The caller's role from the session token: 'guest', 'user' or 'admin'.
+    """
+    principal = verify_session_token(state.get("session"))
+    if principal and principal["role"] in ROLE_TOOLS:
+        return principal["role"]
+    return "guest"
+
+
+def assistant_request(state: State, config: Optional[RunnableConfig] = None) -> Tuple[Any, List, Dict[str, Any]]:
+    """
+    The model, messages and call options for this turn: the role's tool-bound
+    model, or the context-cached prompt when caching is on. A model passed in
+    through the run's config replaces both.
+    """
+    context = history_context(state)
+    role = role_of(state)
+    system_message = SystemMessage(content=f"{sys_prompt}\n\n{context}") if context else sys_msg
+    override = configured_model(config)
+    if override is not None:
+        return override.bind_tools(tools_for_role(role)), [system_message] + state["messages"], {}
+    cached_content = prompt_caches[role].name() if prompt_caches is not None else None
+    if cached_content:
+        # The system instruction lives in the cache, so the context note goes in as a message
+        messages = ([HumanMessage(content=context)] if context else []) + state["messages"]
+        return llm, messages, {"cached_content": cached_content}
+    return role_llms[role], [system_message] + state["messages"], {}
+
+
+def assistant(state: State, config: RunnableConfig):
+    model, messages, kwargs = assistant_request(state, config)
+    response = stream_response(model, messages, **kwargs)
+    remember_answer(state, response)
+    return {"messages": [response]}
+
+
+async def aassistant(state: State, config: RunnableConfig):
+    """
+    Async twin of assistant.
+    """
+    model, messages, kwargs = assistant_request(state, config)
+    response = await astream_response(model, messages, **kwargs)
+    remember_answer(state, response)
+    return {"messages": [response]}
+
+
+def remember_answer(state: State, response) -> None:
+    """
+    Stores a final text answer to a guest's opening question in the response cache.
+    """
+    if getattr(response, "tool_calls", None) or not isinstance(response.content, str) or not response.content:
+        return
+    question = cacheable_question(state)
+    if question:
+        response_cache.store(question, response.content)
+
+
+def route_tool_calls(state: State) -> str:
+    """
+    Sends the assistant's tool calls to ToolNode only if the caller's role permits
+    every one of them; otherwise to reject_tool_calls. Ends the turn when there are none.
+    """
+    tool_calls = getattr(state["messages"][-1], "tool_calls", None)
+    if not tool_calls:
+        return END
+    allowed = ROLE_TOOLS[role_of(state)]
+    if all(tool_call["name"] in allowed for tool_call in tool_calls):
+        return "tools"
+    return "reject_tool_calls"
+
+
+def reject_tool_calls(state: State):
+    """
+    Answers every tool call of the last message without running any of them.
+    """
+    role = role_of(state)
+    allowed = ROLE_TOOLS[role]
+    messages = []
+    for tool_call in state["messages"][-1].tool_calls:
+        if tool_call["name"] in allowed:
+            content = "Not run because another tool call in the same step was not permitted."
+        else:
+            content = f"Permission denied: the {role} role may not use {tool_call['name']}."
+            print(f"Rejected {tool_call['name']} for role {role}")
+        messages.append(ToolMessage(content=content, name=tool_call["name"], tool_call_id=tool_call["id"], status="error"))
+    return {"messages": messages}
+
+
+# Intent fast path
+# Short, common requests ("show me the doctors", "what is my role", "show my
+# appointments") are recognised by regex, or optionally by a small local embedding
+# model, and answered straight from the tool function with a templated reply.
+# That skips both Gemini calls (pick the tool, then phrase the result). Anything
+# else, or anything the caller's role can't do, falls through to the assistant.
+
+INTENT_EMBEDDING_MODEL = os.getenv("INTENT_EMBEDDING_MODEL", "")  # e.g. 'all-MiniLM-L6-v2'; empty disables
+INTENT_EMBEDDING_THRESHOLD = float(os.getenv("INTENT_EMBEDDING_THRESHOLD", "0.8"))
+FAST_PATH_MAX_CHARS = 80  # Longer messages usually carry more than one request
+
+INTENT_PATTERNS = {
+    "list_doctors": re.compile(
+        r"^(please )?((show|list|display|get|view|see)( me)?( all)?( the| your| available| all)* doctors?( list)?"
+        r"|(who|which|what) (are )?(the |your )?(available )?doctors?( are)?( available)?"
+        r"|(list of |all )?(the )?doctors?( list)?)( please)?[.!?]*$",
+        re.IGNORECASE,
+    ),
+    "my_role": re.compile(
+        r"^(what('?s| is) my role|who am i|my role|am i (an? )?(admin|patient|user|guest)|am i (logged|signed) in)[.!?]*$",
+        re.IGNORECASE,
+    ),
+    "my_appointments": re.compile(
+        r"^((please )?(show|list|view|see|get)( me)? my( upcoming)? appointments?|my appointments?"
+        r"|what are my( upcoming)? appointments?|do i have any appointments?)( please)?[.!?]*$",
+        re.IGNORECASE,
+    ),
+}
+
+INTENT_EXAMPLES = {
+    "list_doctors": ["show me the doctors", "which doctors do you have", "list all doctors"],
+    "my_role": ["what is my role", "who am i logged in as", "am i an admin"],
+    "my_appointments": ["show my appointments", "when are my appointments", "what bookings do i have"],
+}
+
+
+class EmbeddingIntentMatcher:
+    """
+    Matches a message to the nearest INTENT_EXAMPLES entry with a local
+    sentence-transformers model, if that package is installed.
+    """
+
+    def __init__(self, model_name: str, threshold: float):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name)
+        self.threshold = threshold
+        self.intents = [intent for intent, examples in INTENT_EXAMPLES.items() for _ in examples]
+        self.examples = self.model.encode([example for examples in INTENT_EXAMPLES.values() for example in examples], normalize_embeddings=True)
+
+    def match(self, text: str) -> Optional[str]:
+        scores = self.examples @ self.model.encode([text], normalize_embeddings=True)[0]
+        best = int(scores.argmax())
+        return self.intents[best] if scores[best] >= self.threshold else None
+
+
+intent_matcher: Optional[EmbeddingIntentMatcher] = None
+if INTENT_EMBEDDING_MODEL:
+    try:
+        intent_matcher = EmbeddingIntentMatcher(INTENT_EMBEDDING_MODEL, INTENT_EMBEDDING_THRESHOLD)
+    except Exception as e:
+        print(f"Intent embeddings disabled: {e}")
+
+
+def classify_intent(text: str) -> Optional[str]:
+    text = " ".join(text.split())
+    if not text or len(text) > FAST_PATH_MAX_CHARS:
+        return None
+    for intent, pattern in INTENT_PATTERNS.items():
+        if pattern.match(text):
+            return intent
+    return intent_matcher.match(text) if intent_matcher else None
+
+
+def render_doctors(doctors: list) -> str:
+    if not doctors:
+        return "Currently we don't have any doctor available"
+    lines = [f"- {doctor.name} ({doctor.specialty}), ID {doctor.id}" for doctor in doctors[:TOOL_RESULT_MAX_ITEMS]]
+    if len(doctors) > TOOL_RESULT_MAX_ITEMS:
+        lines.append(f"...and {len(doctors) - TOOL_RESULT_MAX_ITEMS} more. Ask me to search by name or specialty.")
+    return "Here are our doctors:\n" + "\n".join(lines)
+
+
+def render_role(user: Dict[str, Any]) -> str:
+    if user["role"] == "admin":
+        return f"You are signed in as {user['username']}, an admin. You can add doctors and have full management access."
+    if user["role"] == "user":
+        return f"You are signed in as {user['username']}, a patient. You can book appointments and view doctor information."
+    return "Your role is Guest. You need to log in to book an appointment, or you can view the doctors list."
+
+
+def upcoming_appointments(patient_name: str, limit: int = APPOINTMENT_PAGE_SIZE) -> Dict[str, Any]:
+    """
+    First page of a patient's booked appointments that haven't started yet, soonest first.
+    """
+    statement, limit = appointment_page_query(
+        [Appointment.patient_name == patient_name, Appointment.status == "Booked", Appointment.start_time >= datetime.now(CLINIC_TIMEZONE)],
+        None, limit,
+    )
+    with Session(engine) as session:
+        return appointment_page(session.exec(statement).all(), limit)
+
+
+def render_appointments(appointments: list) -> str:
+    if not appointments:
+        return "You have no upcoming appointments."
+    lines = []
+    for appointment in appointments:
+        doctor = get_doctor(appointment["doctor_id"])
+        with_doctor = doctor.name if doctor else f"doctor {appointment['doctor_id']}"
+        lines.append(f"- {appointment['date']} at {appointment['time']} with {with_doctor}, ID {appointment['id']}")
+    return "Your upcoming appointments:\n" + "\n".join(lines)
+
+
+def fast_path(state: State):
+    """
+    Answers a recognised intent in the latest human message directly; otherwise does nothing.
+    """
+    message = state["messages"][-1]
+    if not isinstance(message, HumanMessage) or not isinstance(message.content, str):
+        return {}
+    intent = classify_intent(message.content)
+    role = role_of(state)
+    if intent == "list_doctors":
+        reply = render_doctors(get_all_doctors())
+    elif intent == "my_role":
+        reply = render_role(current_user(state.get("session")))
+    elif intent == "my_appointments" and role == "user":
+        page = upcoming_appointments(verify_session_token(state.get("session"))["sub"])
+        if page["next_cursor"]:
+            return {}  # More than a page: the assistant pages through them with the listing tools
+        reply = render_appointments(page["appointments"])
+    else:
+        question = cacheable_question(state)
+        reply = response_cache.lookup(question) if question else None
+        if reply is None:
+            return {}
+        intent = "cached guest answer"
+    print(f"Fast path answered intent {intent}")
+    return {"messages": [AIMessage(content=reply)]}
+
+
+def route_fast_path(state: State) -> str:
+    return END if isinstance(state["messages"][-1], AIMessage) else "assistant"
+
+
+# Guest response cache
+# The opening question of a guest conversation ("which cardiologists do you have") is
+# asked over and over with small wording changes. Answers to it are cached under the
+# doctor-directory version, so any doctor write (which bumps the version) empties the
+# cache, and looked up by similarity over stop-word-stripped word and character-trigram
+# features through a small inverted index. Only turns that used nothing but the
+# read-only directory tools are cached.
+
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "512"))
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.85"))  # cosine similarity
+
+CACHEABLE_TOOLS = ["get_all_doctors", "get_doctor", "search_doctors", "more_results"]
+
+QUERY_STOP_WORDS = {
+    "which", "what", "who", "do", "does", "you", "have", "has", "a", "an", "the", "is", "are", "i", "can",
+    "how", "me", "please", "any", "there", "your", "of", "for", "to", "in", "we", "my", "it", "could",
+    "would", "tell", "about", "list", "show", "available",
+}
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(word for word in re.findall(r"[a-z0-9]+", text.lower()) if word not in QUERY_STOP_WORDS)
+
+
+def query_vector(normalized: str) -> Dict[str, float]:
+    """
+    Unit-length sparse vector of word (weighted double) and character-trigram features.
+    """
+    features: Dict[str, float] = {f"w:{word}": 2.0 for word in normalized.split()}
+    padded = f" {normalized} "
+    for i in range(len(padded) - 2):
+        features[padded[i:i + 3]] = features.get(padded[i:i + 3], 0.0) + 1.0
+    length = sum(weight * weight for weight in features.values()) ** 0.5 or 1.0
+    return {feature: weight / length for feature, weight in features.items()}
+
+
+class SemanticResponseCache:
+    """
+    LRU cache of answers, looked up by exact normalized text and then by cosine
+    similarity over the entries sharing at least one feature with the query.
+    """
+
+    def __init__(self, max_entries: int, threshold: float, backend):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()  # normalized text -> (vector, answer)
+        self._postings: Dict[str, set] = {}  # feature -> normalized texts having it
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _check_version(self) -> None:
+        version = self.backend.version()
+        if version != self._version:
+            self._entries.clear()
+            self._postings.clear()
+            self._version = version
+
+    def _remove(self, key: str) -> None:
+        vector, _ = self._entries.pop(key)
+        for feature in vector:
+            keys = self._postings.get(feature)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[feature]
+
+    def lookup(self, text: str) -> Optional[str]:
+        normalized = normalize_query(text)
+        if not normalized:
+            return None
+        with self._lock:
+            self._check_version()
+            key = normalized if normalized in self._entries else None
+            if key is None:
+                vector = query_vector(normalized)
+                candidates = set()
+                for feature in vector:
+                    candidates.update(self._postings.get(feature, ()))
+                best_score = 0.0
+                for candidate in candidates:
+                    candidate_vector = self._entries[candidate][0]
+                    score = sum(weight * candidate_vector.get(feature, 0.0) for feature, weight in vector.items())
+                    if score > best_score:
+                        key, best_score = candidate, score
+                if best_score < self.threshold:
+                    key = None
+            if key is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][1]
+
+    def store(self, text: str, answer: str) -> None:
+        normalized = normalize_query(text)
+        if not normalized:
+            return
+        vector = query_vector(normalized)
+        with self._lock:
+            self._check_version()
+            if normalized in self._entries:
+                self._remove(normalized)
+            self._entries[normalized] = (vector, answer)
+            for feature in vector:
+                self._postings.setdefault(feature, set()).add(normalized)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0, "entries": len(self._entries)}
+
+
+response_cache = SemanticResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_THRESHOLD, doctor_cache.backend)
+
+
+def cacheable_question(state: State) -> Optional[str]:
+    """
+    The guest's question if this turn's answer may be shared with other guests: the
+    conversation's first message, with only directory lookups run to answer it.
+    """
+    if role_of(state) != "guest" or state.get("summary"):
+        return None
+    questions = [message for message in state["messages"] if isinstance(message, HumanMessage)]
+    if len(questions) != 1 or not isinstance(questions[0].content, str):
+        return None
+    if any(isinstance(message, ToolMessage) and message.name not in CACHEABLE_TOOLS for message in state["messages"]):
+        return None
+    return questions[0].content
+
+
+def tool_error(error: ValueError) -> str:
+    """
+    Turns a tool's ValueError (a rejected booking, a bad id, a permission check) into
+    the ToolMessage the model sees, so it can recover instead of the run failing.
+    """
+    return f"Error: {error}"
 
 
 # Build graph
-builder: StateGraph = StateGraph(MessagesState)
-builder.add_node("assistant", assistant)
-builder.add_node("tools", ToolNode(tools))
-builder.add_edge(START, "assistant")
+builder: StateGraph = StateGraph(State)
+builder.add_node("trim_history", trim_history)
+builder.add_node("fast_path", fast_path)
+builder.add_node("assistant", RunnableLambda(assistant, afunc=aassistant, name="assistant"))
+builder.add_node("tools", ToolNode(tools, handle_tool_errors=tool_error).with_config(max_concurrency=TOOL_MAX_CONCURRENCY))
+builder.add_node("reject_tool_calls", reject_tool_calls)
+builder.add_edge(START, "trim_history")
+builder.add_edge("trim_history", "fast_path")
+builder.add_conditional_edges("fast_path", route_fast_path, ["assistant", END])
 builder.add_conditional_edges(
     "assistant",
-    # If the latest message (result) from assistant is a tool call -> tools_condition routes to tools
-    # If the latest message (result) from assistant is a not a tool call -> tools_condition routes to END
-    tools_condition,
+    # If the latest message (result) from assistant is a permitted tool call -> routes to tools
+    # If it calls a tool the caller's role may not use -> routes to reject_tool_calls
+    # If the latest message (result) from assistant is a not a tool call -> routes to END
+    route_tool_calls,
+    ["tools", "reject_tool_calls", END],
 )
-builder.add_edge("tools", "assistant")
+builder.add_edge("tools", "trim_history")
+builder.add_edge("reject_tool_calls", "trim_history")
 memory = MemorySaver()
 
  
 # Compile graph
 graph: CompiledStateGraph = builder.compile(checkpointer=memory)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Doctor appointment system maintenance commands.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("outbox-worker", help="Drain the email outbox in the foreground.")
+    backfill = commands.add_parser("backfill-start-times", help="Parse legacy date/time strings into Appointment.start_time.")
+    backfill.add_argument("--batch-size", type=int, default=500)
+    maintenance = commands.add_parser("maintenance", help="Complete past appointments and purge old cancelled ones.")
+    maintenance.add_argument("--once", action="store_true", help="Run the jobs once instead of every MAINTENANCE_INTERVAL seconds.")
+    doctor_import = commands.add_parser("import-doctors", help="Bulk upsert doctors from a CSV or JSONL file.")
+    doctor_import.add_argument("path")
+    doctor_import.add_argument("--format", choices=["csv", "jsonl"], help="Defaults to the file extension.")
+    doctor_import.add_argument("--batch-size", type=int, default=DOCTOR_IMPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    if args.command == "outbox-worker":
+        if outbox_worker is not None:
+            outbox_worker.stop()
+        OutboxWorker().run()
+    elif args.command == "backfill-start-times":
+        result = backfill_appointment_start_times(args.batch_size)
+        print(f"Updated {result['updated']} rows; could not parse {len(result['unparsed'])}: {result['unparsed']}")
+    elif args.command == "maintenance":
+        if maintenance_runner is not None:
+            maintenance_runner.stop()
+        if args.once:
+            MaintenanceRunner().run_once()
+        else:
+            MaintenanceRunner().run()
+    elif args.command == "import-doctors":
+        import_format = args.format or ("jsonl" if args.path.endswith((".jsonl", ".ndjson")) else "csv")
+        with open(args.path, newline="", encoding="utf-8") as source:
+            result = import_doctors(source, import_format, args.batch_size)
+        for error in result["errors"]:
+            print(f"line {error['line']}: {error['error']}")
@@ -0,0 +1,221 @@
+import argparse
+import email
+import email.policy
+import json
+import re
+import socketserver
+import threading
+import time
+import uuid
+from email.message import EmailMessage
+from typing import Any, Dict, Iterator, List, Optional
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# Local stand-ins for the LLM and Gmail, used by the "fake" model provider, the
+# tests and the load benchmark (bench.py). Nothing here touches doctor_appointment,
+# so importing it has no side effects.
+
+
+# Scripted chat model
+# Each rule matches the latest user message (case-insensitive regex). Its steps are
+# rounds of tool calls made one after another, and its reply closes the turn. Strings
+# in args and reply are formatted with the regex's named groups; reply also gets
+# {result}, the content of the last tool result. The first matching rule wins.
+FAKE_LLM_SCRIPT = [
+    {
+        "match": r"sign ?up as (?P<username>\w+) with password (?P<password>\S+) and email (?P<email>\S+)",
+        "steps": [[{"name": "signup", "args": {"username": "{username}", "password": "{password}", "email": "{email}"}}]],
+        "reply": "Welcome, {username}! Your account is ready.",
+    },
+    {
+        "match": r"sign ?in as (?P<username>\w+) with password (?P<password>\S+)",
+        "steps": [[{"name": "signin", "args": {"username": "{username}", "password": "{password}"}}]],
+        "reply": "You are signed in as {username}.",
+    },
+    {
+        "match": r"find (?:me )?an? (?P<query>[\w ]+)",
+        "steps": [[{"name": "search_doctors", "args": {"query": "{query}"}}]],
+        "reply": "These doctors match: {result}",
+    },
+    {
+        "match": r"book doctor (?P<doctor_id>\d+) for (?P<patient>\w+) \((?P<email>\S+)\) on (?P<date>\S+) at (?P<time>[\d:]+)",
+        "steps": [[{"name": "book_appointment", "args": {"data": {
+            "doctor_id": "{doctor_id}", "patient_name": "{patient}", "patient_email": "{email}", "date": "{date}", "time": "{time}",
+        }}}]],
+        "reply": "Your appointment is booked: {result}",
+    },
+    {
+        "match": r"cancel appointment (?P<appointment_id>\d+)",
+        "steps": [[{"name": "update_appointment", "args": {"appointment_id": "{appointment_id}", "status": "Cancelled"}}]],
+        "reply": "Appointment {appointment_id} is cancelled.",
+    },
+    {
+        "match": r"summary",
+        "reply": "The user asked about doctors and appointments.",
+    },
+    {
+        "match": r"doctors",
+        "steps": [[{"name": "get_all_doctors", "args": {}}]],
+        "reply": "Here are our doctors: {result}",
+    },
+    {
+        "match": r"",
+        "reply": "I can help you find a doctor or book an appointment.",
+    },
+]
+
+
+def fill_template(value, fields: Dict[str, str]):
+    if isinstance(value, str):
+        placeholder = re.fullmatch(r"\{(\w+)\}", value)
+        if placeholder and str(fields.get(placeholder.group(1), "")).isdigit():
+            return int(fields[placeholder.group(1)])  # ids go to the tools as ints
+        return value.format(**fields)
+    if isinstance(value, dict):
+        return {key: fill_template(item, fields) for key, item in value.items()}
+    if isinstance(value, list):
+        return [fill_template(item, fields) for item in value]
+    return value
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Deterministic stand-in chat model that follows a rule script: the same
+    conversation always gets the same tool calls and replies. Tool call ids are
+    fresh uuids on every turn, since booking uses them as idempotency keys. Streams its replies
+    word by word like a real provider.
+    """
+
+    script: List[Dict[str, Any]]
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def bind_tools(self, tools, **kwargs):
+        return self  # the script decides which tools get called
+
+    def respond(self, messages: List) -> AIMessage:
+        turn_start = max((i for i, message in enumerate(messages) if isinstance(message, HumanMessage)), default=0)
+        question = messages[turn_start].content if messages else ""
+        for rule in self.script:
+            found = re.search(rule["match"], question if isinstance(question, str) else str(question), re.IGNORECASE)
+            if found:
+                break
+        else:
+            return AIMessage(content="")
+        fields = {key: (value or "").strip() for key, value in found.groupdict().items()}
+        turn = messages[turn_start + 1:]
+        step = sum(1 for message in turn if getattr(message, "tool_calls", None))
+        steps = rule.get("steps", [])
+        if step < len(steps):
+            return AIMessage(content="", tool_calls=[
+                {"name": call["name"], "args": fill_template(call["args"], fields), "id": f"call_{uuid.uuid4().hex}"}
+                for call in steps[step]
+            ])
+        results = [message.content for message in turn if isinstance(message, ToolMessage)]
+        return AIMessage(content=fill_template(rule.get("reply", ""), {**fields, "result": results[-1] if results else ""}))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self.latency:
+            time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self.respond(messages))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        if self.latency:
+            time.sleep(self.latency)
+        message = self.respond(messages)
+        for word in re.findall(r"\S+\s*", message.content):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word))
+            if run_manager:
+                run_manager.on_llm_new_token(word, chunk=chunk)
+            yield chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[
+            {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": i}
+            for i, call in enumerate(message.tool_calls)
+        ]))
+
+
+# Local SMTP sink
+class LocalSMTPSink(socketserver.ThreadingTCPServer):
+    """
+    Minimal plain-text SMTP server that accepts any login and keeps the
+    messages it receives in memory. A stand-in for Gmail in tests and benchmarks.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), _SMTPSinkHandler)
+        self.messages: List[EmailMessage] = []
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> "LocalSMTPSink":
+        self._thread = threading.Thread(target=self.serve_forever, name="smtp-sink", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class _SMTPSinkHandler(socketserver.StreamRequestHandler):
+
+    def _reply(self, line: str) -> None:
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self) -> None:
+        self._reply("220 localhost SMTP sink ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line.decode(errors="replace").strip().split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self._reply("250-localhost")
+                self._reply("250 AUTH PLAIN LOGIN")
+            elif verb == "HELO":
+                self._reply("250 localhost")
+            elif verb == "AUTH":
+                self._reply("235 Authentication successful")
+            elif verb in ["MAIL", "RCPT", "RSET", "NOOP"]:
+                self._reply("250 OK")
+            elif verb == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                for data_line in self.rfile:
+                    if data_line in [b".\r\n", b".\n"]:
+                        break
+                    lines.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                self.server.messages.append(email.message_from_bytes(b"".join(lines), policy=email.policy.default))
+                self._reply("250 OK: queued")
+            elif verb == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("502 Command not implemented")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local SMTP stand-in that prints what it receives.")
+    parser.add_argument("--port", type=int, default=1025)
+    args = parser.parse_args()
+
+    sink = LocalSMTPSink(port=args.port).start()
+    print(f"SMTP sink listening on 127.0.0.1:{sink.port} (use SMTP_SSL=false)")
+    seen = 0
+    while True:
+        time.sleep(1)
+        for message in sink.messages[seen:]:
+            print(f"To: {message['To']} | Subject: {message['Subject']}")
+        seen = len(sink.messages)
@@ -0,0 +1,29 @@
+import os
+from typing import Optional
+
+import bcrypt
+
+# bcrypt helpers for the password hashing pool in doctor_appointment.
+# With PASSWORD_HASH_EXECUTOR=process, the worker processes import the functions
+# submitted to them by module name. They live here, away from doctor_appointment's
+# import-time engines, schema upgrade and graph, so a worker only loads bcrypt.
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+
+def hash_password(password: str, rounds: Optional[int] = None) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds or BCRYPT_ROUNDS)).decode('utf-8')
+
+
+def verify_password(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+def needs_rehash(hashed: str) -> bool:
+    """
+    True when the hash was made with a different work factor than BCRYPT_ROUNDS.
+    """
+    try:
+        return int(hashed.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
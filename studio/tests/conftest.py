@@ -0,0 +1,82 @@
+import os
+import sys
+import tempfile
+
+# doctor_appointment reads its settings and creates its tables at import time, so the
+# test environment has to be in place before the first import.
+_database = os.path.join(tempfile.mkdtemp(prefix="doctor-appointment-tests-"), "test.db")
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{_database}",
+    "DB_URL": f"sqlite:///{_database}",
+    "MAIL_USERNAME": "clinic@example.com",
+    "MAIL_PASSWORD": "unused",
+    "GOOGLE_API_KEY": "unused",
+    "LLM_MODEL": "fake:default",
+    "EMAIL_OUTBOX_WORKER": "off",
+    "MAINTENANCE_WORKER": "off",
+    "SESSION_SECRET": "test-secret",
+    "BCRYPT_ROUNDS": "4",
+    "CLINIC_TIMEZONE": "America/New_York",  # a non-UTC clinic, so naive/aware mix-ups show
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import secrets
+
+import pytest
+
+import doctor_appointment as app
+from fakes import LocalSMTPSink, ScriptedChatModel
+
+
+@pytest.fixture
+def unique():
+    """
+    A fresh suffix for usernames, doctor names and thread ids; tests share one database.
+    """
+    return secrets.token_hex(4)
+
+
+@pytest.fixture
+def patient(unique):
+    username = f"patient_{unique}"
+    app.signup(username, "password1", "user", f"{username}@example.com")
+    return username, app.create_session(username, "password1")
+
+
+@pytest.fixture
+def other_patient(unique):
+    username = f"other_{unique}"
+    app.signup(username, "password1", "user", f"{username}@example.com")
+    return username, app.create_session(username, "password1")
+
+
+@pytest.fixture
+def admin(unique):
+    username = f"admin_{unique}"
+    app.signup(username, "password1", "admin", f"{username}@example.com")
+    return username, app.create_session(username, "password1")
+
+
+@pytest.fixture
+def doctor(unique):
+    return app.add_doctor(f"Dr. Test {unique}", "Cardiologist", True)
+
+
+@pytest.fixture
+def scripted(monkeypatch):
+    """
+    Replaces the assistant's model for every role with a ScriptedChatModel following the given rules.
+    """
+    def use(rules):
+        model = ScriptedChatModel(script=rules)
+        for role in app.ROLE_TOOLS:
+            monkeypatch.setitem(app.role_llms, role, model)
+        return model
+    return use
+
+
+@pytest.fixture
+def smtp_sink():
+    sink = LocalSMTPSink().start()
+    yield sink
+    sink.stop()
@@ -0,0 +1,19 @@
+import doctor_appointment as app
+from bench import LoadBenchmark, compare_benchmarks
+
+
+def test_load_benchmark_smoke_run(smtp_sink):
+    model_before, role_llms_before = app.llm, dict(app.role_llms)
+    report = LoadBenchmark(patients=2, admins=1, guests=2, concurrency=2, model="fake:default", sink=smtp_sink).run()
+    assert report["turns"]
+    assert report["errors"] == 0
+    assert report["emails"] == {"expected": 2, "delivered": 2}
+    assert "assistant" in report["nodes"]
+    assert report["db"]["total"] > 0
+    # the benchmark model only reaches the graph through its config
+    assert app.llm is model_before
+    assert app.role_llms == role_llms_before
+
+
+    lines = compare_benchmarks(report, report)
+    assert lines[0].startswith("turns/s:") and lines[-1].startswith("queries/turn:")
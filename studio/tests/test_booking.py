@@ -0,0 +1,174 @@
+import asyncio
+import functools
+
+import pytest
+from langchain_core.messages import HumanMessage, ToolMessage
+from langgraph.types import Command
+
+import doctor_appointment as app
+
+
+def appointment(doctor, patient_name, day="2031-05-06", time="10:00"):
+    return app.Appointment(doctor_id=doctor.id, patient_name=patient_name, patient_email=f"{patient_name}@example.com", date=day, time=time)
+
+
+def test_reserve_is_idempotent_per_key(doctor, patient, unique):
+    first = app.reserve_appointment(appointment(doctor, patient[0]), f"key-{unique}")
+    again = app.reserve_appointment(appointment(doctor, patient[0]), f"key-{unique}")
+    assert again.id == first.id
+
+
+def test_booking_resume_does_not_duplicate(doctor, patient, scripted, unique):
+    username, session = patient
+    scripted([{
+        "match": r"book",
+        "steps": [[{"name": "book_appointment", "args": {"data": {
+            "doctor_id": doctor.id, "patient_name": username, "patient_email": f"{username}@example.com",
+            "date": "2031-05-07", "time": "11:00",
+        }}}]],
+        "reply": "{result}",
+    }])
+    config = {"configurable": {"thread_id": f"resume-{unique}"}}
+
+    paused = app.graph.invoke({"messages": [HumanMessage(content="book it")], "session": session}, config)
+    assert paused["__interrupt__"]
+    app.graph.invoke(Command(resume="no"), config)
+
+    assert len(app.get_appointments_by_patient_name(username, doctor.id, session=session)) == 1
+
+
+def test_overlapping_booking_is_rejected(doctor, patient, other_patient, unique):
+    app.reserve_appointment(appointment(doctor, patient[0]), f"a-{unique}")
+    with pytest.raises(ValueError, match="already booked"):
+        app.reserve_appointment(appointment(doctor, other_patient[0], time="10:15"), f"b-{unique}")
+
+
+def test_booking_outside_schedule_is_rejected(doctor, patient, unique):
+    app.set_doctor_schedule(doctor.id, "tuesday", "09:00", "12:00", 30)  # 2031-05-06 is a Tuesday
+    with pytest.raises(ValueError, match="not working"):
+        app.reserve_appointment(appointment(doctor, patient[0], time="14:00"), f"c-{unique}")
+
+
+def test_rejected_booking_reaches_the_model(doctor, patient, other_patient, scripted, unique):
+    username, session = patient
+    app.reserve_appointment(appointment(doctor, other_patient[0]), f"taken-{unique}")
+    scripted([{
+        "match": r"book",
+        "steps": [[{"name": "book_appointment", "args": {"data": {
+            "doctor_id": doctor.id, "patient_name": username, "patient_email": f"{username}@example.com",
+            "date": "2031-05-06", "time": "10:00",
+        }}}]],
+        "reply": "{result}",
+    }])
+
+    result = app.graph.invoke(
+        {"messages": [HumanMessage(content="book it")], "session": session},
+        {"configurable": {"thread_id": f"overlap-{unique}"}},
+    )
+
+    tool_message = next(message for message in result["messages"] if isinstance(message, ToolMessage))
+    assert tool_message.status == "error"
+    assert "get_available_slots" in tool_message.content
+    assert "get_available_slots" in result["messages"][-1].content
+
+
+def test_free_slots_skip_booked_ones(doctor, patient, unique):
+    app.set_doctor_schedule(doctor.id, "wednesday", "09:00", "10:00", 30)  # 2031-05-07 is a Wednesday
+    app.reserve_appointment(appointment(doctor, patient[0], day="2031-05-07", time="09:00"), f"d-{unique}")
+    slots = app.get_available_slots(doctor.id, "2031-05-07", "2031-05-07")
+    assert slots == [{"date": "2031-05-07", "time": "09:30"}]
+
+
+def test_my_appointments_lists_only_upcoming_bookings(doctor, patient, unique):
+    username, session = patient
+    upcoming = app.reserve_appointment(appointment(doctor, username), f"up-{unique}")
+    cancelled = app.reserve_appointment(appointment(doctor, username, time="11:00"), f"cancel-{unique}")
+    app.update_appointment(cancelled.id, "Cancelled", session=session)
+    past = app.reserve_appointment(appointment(doctor, username, time="12:00"), f"past-{unique}")
+    with app.Session(app.engine) as db:
+        row = db.get(app.Appointment, past.id)
+        row.start_time = app.utcnow() - app.timedelta(days=1)
+        db.add(row)
+        db.commit()
+
+    result = app.graph.invoke(
+        {"messages": [HumanMessage(content="show my appointments")], "session": session},
+        {"configurable": {"thread_id": f"mine-{unique}"}},
+    )
+
+    reply = result["messages"][-1].content
+    assert reply.startswith("Your upcoming appointments:")
+    assert f"ID {upcoming.id}" in reply
+    assert f"ID {cancelled.id}" not in reply and f"ID {past.id}" not in reply
+
+
+def test_my_appointments_hands_long_lists_to_the_assistant(doctor, patient, scripted, unique, monkeypatch):
+    username, session = patient
+    for hour in ["09:00", "10:00"]:
+        app.reserve_appointment(appointment(doctor, username, time=hour), f"{hour}-{unique}")
+    monkeypatch.setattr(app, "upcoming_appointments", functools.partial(app.upcoming_appointments, limit=1))
+    scripted([{"match": r"appointments", "reply": "from the assistant"}])
+
+    result = app.graph.invoke(
+        {"messages": [HumanMessage(content="show my appointments")], "session": session},
+        {"configurable": {"thread_id": f"many-{unique}"}},
+    )
+
+    assert result["messages"][-1].content == "from the assistant"
+
+
+def test_async_graph_books_through_the_async_tools(doctor, patient, scripted, unique):
+    username, session = patient
+    scripted([{
+        "match": r"book",
+        "steps": [[{"name": "book_appointment", "args": {"data": {
+            "doctor_id": doctor.id, "patient_name": username, "patient_email": f"{username}@example.com",
+            "date": "2031-05-08", "time": "09:00",
+        }}}]],
+        "reply": "{result}",
+    }])
+    config = {"configurable": {"thread_id": f"async-{unique}"}}
+
+    async def book():
+        await app.graph.ainvoke({"messages": [HumanMessage(content="book it")], "session": session}, config)
+        return await app.graph.ainvoke(Command(resume="yes"), config)
+
+    asyncio.run(book())
+    booked = asyncio.run(app.aget_appointments_by_patient_name(username, doctor.id, session=session))
+    assert [(a.date, a.time) for a in booked] == [("2031-05-08", "09:00")]
+    assert len(app.get_appointments_by_patient_name(username, doctor.id, session=session)) == 1
+
+
+def test_appointment_pages_follow_the_cursor(doctor, patient, unique):
+    booked = [
+        app.reserve_appointment(appointment(doctor, patient[0], day="2031-06-03", time=hour), f"{hour}-{unique}").id
+        for hour in ["15:00", "09:00", "11:00", "10:00", "16:00"]
+    ]
+
+    def walk(list_page):
+        seen, cursor = [], None
+        while True:
+            page = list_page(cursor)
+            assert len(page["appointments"]) <= 2
+            seen += [row["id"] for row in page["appointments"]]
+            cursor = page["next_cursor"]
+            if not cursor:
+                return seen
+
+    in_time_order = [booked[i] for i in (1, 3, 2, 0, 4)]
+    assert walk(lambda cursor: app.list_appointments_by_doctor(doctor.id, "2031-06-03", "2031-06-03", cursor, limit=2)) == in_time_order
+    assert walk(lambda cursor: asyncio.run(app.alist_appointments_by_doctor(doctor.id, "2031-06-03", "2031-06-03", cursor, limit=2))) == in_time_order
+    by_status = walk(lambda cursor: app.list_appointments_by_status("Booked", cursor, limit=2))
+    assert by_status == sorted(by_status) and set(booked) <= set(by_status)
+
+
+@pytest.mark.parametrize("cursor", ["not a cursor!", "é", app.encode_cursor(["2031-06-03"]), app.encode_cursor([1, 2]), app.encode_cursor({"id": 1})])
+def test_bad_cursor_is_a_tool_error(doctor, cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        app.list_appointments_by_doctor(doctor.id, "2031-06-03", "2031-06-03", cursor)
+
+
+@pytest.mark.parametrize("cursor", ["not a cursor!", app.encode_cursor(["x"]), app.encode_cursor([1, 2])])
+def test_bad_id_cursor_is_a_tool_error(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        app.list_appointments_by_status("Booked", cursor)
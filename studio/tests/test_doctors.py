@@ -0,0 +1,130 @@
+import asyncio
+import io
+
+import pytest
+from langchain_core.messages import HumanMessage, ToolMessage
+from sqlalchemy import text
+from sqlmodel import Session, create_engine, select
+
+import doctor_appointment as app
+
+
+def test_duplicate_doctor_is_rejected(doctor):
+    with pytest.raises(ValueError, match="already exists"):
+        app.add_doctor(doctor.name, doctor.specialty, True)
+    with pytest.raises(ValueError, match="already exists"):
+        asyncio.run(app.aadd_doctor(doctor.name, doctor.specialty, True))
+
+
+def test_renaming_onto_an_existing_doctor_is_rejected(doctor, unique):
+    other = app.add_doctor(f"Dr. Other {unique}", doctor.specialty, True)
+    with pytest.raises(ValueError, match="already exists"):
+        app.update_doctor(other.id, name=doctor.name)
+    with pytest.raises(ValueError, match="already exists"):
+        asyncio.run(app.aupdate_doctor(other.id, name=doctor.name))
+    assert app.update_doctor(other.id, available=False).name == f"Dr. Other {unique}"
+
+
+def test_duplicate_doctor_reaches_the_model(doctor, admin, scripted, unique):
+    scripted([{
+        "match": r"add",
+        "steps": [[{"name": "add_doctor", "args": {"name": doctor.name, "specialty": doctor.specialty, "available": True}}]],
+        "reply": "{result}",
+    }])
+
+    result = app.graph.invoke(
+        {"messages": [HumanMessage(content="add the doctor")], "session": admin[1]},
+        {"configurable": {"thread_id": f"duplicate-{unique}"}},
+    )
+
+    tool_message = next(message for message in result["messages"] if isinstance(message, ToolMessage))
+    assert tool_message.status == "error"
+    assert "already exists" in tool_message.content
+
+
+def test_import_upserts_and_reports_bad_rows(unique):
+    roster = "\n".join([
+        "name,specialty,available",
+        f"Dr. Import {unique},Dermatologist,true",
+        f"Dr. Import {unique},Neurologist,false",
+        ",Dermatologist,true",
+    ])
+    result = app.import_doctors(io.StringIO(roster))
+    assert (result["upserted"], result["error_count"]) == (2, 1)
+    assert result["errors"][0]["line"] == 4
+
+    again = app.import_doctors(io.StringIO(f'{{"name": "Dr. Import {unique}", "specialty": "Neurologist", "available": true}}\n'), "jsonl")
+    assert again["upserted"] == 1
+    with Session(app.engine) as session:
+        rows = session.exec(select(app.Doctor.specialty, app.Doctor.available).where(app.Doctor.name == f"Dr. Import {unique}")).all()
+    assert sorted(rows) == [("Dermatologist", "1"), ("Neurologist", "1")]
+
+
+def test_duplicates_block_the_upgrade_and_the_import(monkeypatch, tmp_path):
+    legacy = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with legacy.begin() as connection:
+        connection.execute(text("CREATE TABLE doctor (id INTEGER PRIMARY KEY, name VARCHAR, specialty VARCHAR, available VARCHAR)"))
+        connection.execute(text("INSERT INTO doctor (name, specialty, available) VALUES ('Dr. Twin', 'GP', '1'), ('Dr. Twin', 'GP', '1')"))
+    monkeypatch.setattr(app, "engine", legacy)
+
+    with pytest.raises(RuntimeError, match="ux_doctor_name_specialty"):
+        app.upgrade_schema()
+    with pytest.raises(ValueError, match="disabled"):
+        app.import_doctors(io.StringIO("name,specialty,available\nDr. New,GP,true\n"))
+
+
+def test_cached_doctors_are_copies(doctor):
+    first = app.get_doctor(doctor.id)
+    first.name = "Changed by one caller"
+    assert app.get_doctor(doctor.id).name == doctor.name
+    assert asyncio.run(app.aget_doctor(doctor.id)).name == doctor.name
+
+
+def test_async_writes_bump_the_shared_version_without_blocking(monkeypatch, unique):
+    backend = app.DatabaseVersionBackend(name=f"async-{unique}", poll_interval=0)
+    monkeypatch.setattr(app.doctor_cache, "backend", backend)
+    monkeypatch.setattr(backend, "bump", None)  # the async twins must not take the sync path
+
+    async def add_three():
+        await asyncio.gather(*(app.aadd_doctor(f"Dr. Async {unique} {i}", "GP", True) for i in range(3)))
+    asyncio.run(add_three())
+
+    assert asyncio.run(backend.aversion()) == 3
+
+
+def test_every_tool_has_an_async_twin():
+    assert all(tool.coroutine is not None for tool in app.tools)
+
+
+def test_async_doctor_twins_match_the_sync_tools(doctor, unique):
+    created = asyncio.run(app.aadd_doctor(f"Dr. Async {unique}", "Dermatologist", True))
+    assert app.get_doctor(created.id).model_dump() == created.model_dump()
+    assert asyncio.run(app.aget_doctor(doctor.id)).model_dump() == app.get_doctor(doctor.id).model_dump()
+    assert {d.id for d in asyncio.run(app.aget_all_doctors())} == {d.id for d in app.get_all_doctors()}
+
+    updated = asyncio.run(app.aupdate_doctor(created.id, available=False))
+    assert app.get_doctor(created.id).available == updated.available != created.available
+    with pytest.raises(ValueError, match="already exists"):
+        asyncio.run(app.aupdate_doctor(created.id, name=doctor.name, specialty=doctor.specialty))
+    assert asyncio.run(app.adelete_doctor(created.id)) is True
+    assert app.get_doctor(created.id) is None
+    assert asyncio.run(app.adelete_doctor(created.id)) is False
+
+
+def test_search_finds_doctors_by_name_specialty_and_typo(unique):
+    assert app.doctor_search_backend == "fts5"
+    found = app.add_doctor(f"Dr. Quillfeather {unique}", "Dermatologist", True)
+
+    def ids(query):
+        sync = [d.id for d in app.search_doctors(query, limit=25)]
+        assert [d.id for d in asyncio.run(app.asearch_doctors(query, limit=25))] == sync
+        return sync
+
+    assert ids("quillfeather")[0] == found.id
+    assert found.id in ids("a skin doctor")
+    assert ids("Dr Quilfeathr")[0] == found.id  # misspelt: corrected against the index vocabulary
+    assert ids("the doctor") == []
+
+    app.update_doctor(found.id, name=f"Dr. Ravensworth {unique}")
+    assert ids("ravensworth")[0] == found.id
+    assert found.id not in ids("quillfeather")
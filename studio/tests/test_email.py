@@ -0,0 +1,90 @@
+import smtplib
+import socket
+
+import pytest
+from sqlmodel import Session
+
+import doctor_appointment as app
+
+
+def queue(subject):
+    with Session(app.engine) as session:
+        queued = app.enqueue_email(session, subject, "body", "patient@example.com")
+        session.commit()
+        return queued.id
+
+
+def outbox_row(id):
+    with Session(app.engine) as session:
+        return session.get(app.EmailOutbox, id)
+
+
+def closed_port():
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        return listener.getsockname()[1]
+
+
+def test_outbox_delivers_to_the_sink(smtp_sink, unique):
+    id = queue(f"Confirmation {unique}")
+    worker = app.OutboxWorker(pool=app.SMTPPool(host="127.0.0.1", port=smtp_sink.port, use_ssl=False))
+    assert worker.drain_once() >= 1
+    assert outbox_row(id).status == "sent"
+    assert f"Confirmation {unique}" in [msg["Subject"] for msg in smtp_sink.messages]
+
+
+def test_failed_send_is_retried_later(unique):
+    id = queue(f"Retry {unique}")
+    worker = app.OutboxWorker(pool=app.SMTPPool(host="127.0.0.1", port=closed_port(), use_ssl=False))
+    worker.drain_once()
+    row = outbox_row(id)
+    assert (row.status, row.attempts) == ("pending", 1)
+    assert row.next_attempt_at > app.utcnow()
+    assert worker.drain_once() == 0  # backing off
+
+
+class CheckingPool:
+    """
+    Records each queued row's status as other sessions see it while the send is under way.
+    """
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.seen = []
+
+    def send_many(self, messages):
+        self.seen = [outbox_row(id).status for id in self.ids]
+        return [None] * len(messages)
+
+
+def test_claimed_emails_are_committed_before_sending(unique):
+    id = queue(f"Lease {unique}")
+    pool = CheckingPool([id])
+    app.OutboxWorker(pool=pool).drain_once()
+    assert pool.seen == ["sending"]
+    assert outbox_row(id).status == "sent"
+
+
+def test_claimed_emails_are_not_claimed_twice(unique):
+    id = queue(f"Claim {unique}")
+    first = app.OutboxWorker().claim_batch()
+    assert id in [queued.id for queued in first]
+    assert id not in [queued.id for queued in app.OutboxWorker().claim_batch()]
+
+
+def test_refused_recipient_keeps_the_connection(smtp_sink, monkeypatch):
+    pool = app.SMTPPool(size=1, host="127.0.0.1", port=smtp_sink.port, use_ssl=False)
+    msg = app.build_email("Hello", "body", "patient@example.com")
+    pool.send(msg)
+
+    def refuse(self, *args, **kwargs):
+        raise smtplib.SMTPRecipientsRefused({"patient@example.com": (550, b"No such user")})
+    with monkeypatch.context() as patch:
+        patch.setattr(smtplib.SMTP, "send_message", refuse)
+        with pytest.raises(smtplib.SMTPRecipientsRefused):
+            pool.send(msg)
+    pool.send(msg)
+
+    assert pool.connects == 1
+    assert len(smtp_sink.messages) == 2
+    pool.close()
@@ -0,0 +1,228 @@
+import asyncio
+import json
+import threading
+
+from google.genai import errors
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.tools import StructuredTool
+from langgraph.graph import END, START, MessagesState, StateGraph
+from langgraph.prebuilt import ToolNode
+
+import doctor_appointment as app
+from fakes import ScriptedChatModel
+
+
+def test_tool_calls_are_bounded_per_turn(monkeypatch):
+    monkeypatch.setattr(app, "TOOL_MAX_CONCURRENCY", 2)
+    running = 0
+    peak = 0
+
+    async def slow(x: int) -> int:
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        return x
+
+    tool = StructuredTool.from_function(func=lambda x: x, coroutine=app.bounded(slow), name="slow", description="Waits.")
+    builder = StateGraph(MessagesState)
+    builder.add_node("tools", ToolNode([tool]))
+    builder.add_edge(START, "tools")
+    builder.add_edge("tools", END)
+    graph = builder.compile()
+    turn = AIMessage(content="", tool_calls=[{"name": "slow", "args": {"x": i}, "id": str(i)} for i in range(6)])
+
+    asyncio.run(graph.ainvoke({"messages": [turn]}))
+    assert peak == 2
+
+    # Two conversations at once each get their own limit
+    peak = 0
+    async def two_conversations():
+        await asyncio.gather(graph.ainvoke({"messages": [turn]}), graph.ainvoke({"messages": [turn]}))
+    asyncio.run(two_conversations())
+    assert peak == 4
+
+    # Outside a graph run the wrapper is a no-op
+    assert asyncio.run(app.bounded(slow)(3)) == 3
+
+
+def test_concurrent_version_bumps_all_count(unique):
+    backend = app.DatabaseVersionBackend(name=f"test-{unique}", poll_interval=0)
+
+    def bump_ten():
+        for _ in range(10):
+            backend.bump()
+    threads = [threading.Thread(target=bump_ten) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert backend.version() == 80
+
+
+def test_doctor_names_are_rendered_as_stored(doctor):
+    assert f"- {doctor.name} (Cardiologist)" in app.render_doctors([doctor])
+    assert "Dr. Dr." not in app.render_doctors([doctor])
+
+
+def test_summary_is_not_streamed(monkeypatch, unique):
+    monkeypatch.setattr(app, "HISTORY_TOKEN_BUDGET", 60)
+    config = {"configurable": {"thread_id": f"summary-{unique}"}}
+    nodes = set()
+    for question in ["hello there, how are things at the clinic", "tell me something about the clinic please", "thanks a lot"]:
+        for message, metadata in app.graph.stream({"messages": [HumanMessage(content=question)]}, config, stream_mode="messages"):
+            if message.content:
+                nodes.add(metadata["langgraph_node"])
+    assert app.graph.get_state(config).values.get("summary")
+    assert "trim_history" not in nodes
+
+
+def test_scripted_tool_call_ids_are_unique_across_turns():
+    model = ScriptedChatModel(script=[{"match": r"twice", "steps": [[
+        {"name": "get_doctor", "args": {"doctor_id": 1}},
+        {"name": "get_doctor", "args": {"doctor_id": 2}},
+    ]]}])
+    first = model.respond([HumanMessage(content="twice")])
+    second = model.respond([HumanMessage(content="twice"), first, HumanMessage(content="twice")])
+    ids = [call["id"] for call in first.tool_calls + second.tool_calls]
+    assert len(ids) == len(set(ids)) == 4
+
+
+class StubPromptCache(app.PromptCache):
+    """
+    A PromptCache that hands out names (or raises the given API error) instead of calling Gemini.
+    """
+    def __init__(self, error=None):
+        super().__init__("gemini-2.5-flash", "prompt", [], 3600)
+        self.error = error
+        self.created = 0
+
+    def _create(self):
+        if self.error:
+            raise self.error
+        self.created += 1
+        self._name = f"cachedContents/{self.created}"
+        self._expires_at = app.time.monotonic() + self.ttl_seconds
+
+
+def test_cached_prompt_is_used_when_caching_is_on(monkeypatch):
+    monkeypatch.setattr(app, "prompt_caches", {role: StubPromptCache() for role in app.ROLE_TOOLS})
+    model, messages, kwargs = app.assistant_request({"messages": [HumanMessage(content="hi")]})
+    assert model is app.llm
+    assert kwargs == {"cached_content": "cachedContents/1"}
+    assert not any(isinstance(message, SystemMessage) for message in messages)
+    # reused on the next turn rather than created again
+    assert app.assistant_request({"messages": [HumanMessage(content="again")]})[2] == kwargs
+
+
+def test_prompt_under_the_minimum_is_not_cached(monkeypatch):
+    monkeypatch.setattr(app.PromptCache, "token_count", lambda self: 100)
+    cache = app.PromptCache("gemini-2.5-flash", "prompt", [], 3600)
+    assert cache.name() is None
+    assert cache.disabled
+
+
+def test_rejected_cache_falls_back_for_that_role_only(monkeypatch, admin):
+    rejected = StubPromptCache(error=errors.ClientError(400, {"error": {"message": "too small"}}))
+    caches = {role: StubPromptCache() for role in app.ROLE_TOOLS}
+    caches["guest"] = rejected
+    monkeypatch.setattr(app, "prompt_caches", caches)
+    model, messages, kwargs = app.assistant_request({"messages": [HumanMessage(content="hi")]})
+    assert kwargs == {} and isinstance(messages[0], SystemMessage)
+    assert rejected.disabled
+    _, token = admin
+    assert app.assistant_request({"messages": [HumanMessage(content="hi")], "session": token})[2] == {"cached_content": "cachedContents/1"}
+
+
+def test_more_results_pages_through_the_conversation_state(monkeypatch):
+    monkeypatch.setattr(app, "TOOL_RESULT_MAX_ITEMS", 2)
+
+    def numbers() -> list:
+        """Lists five numbers."""
+        return list(range(5))
+
+    async def anumbers() -> list:
+        return numbers()
+
+    more = next(tool for tool in app.tools if tool.name == "more_results")
+    builder = StateGraph(MessagesState)
+    builder.add_node("tools", ToolNode([app.make_tool(numbers, anumbers), more], handle_tool_errors=app.tool_error))
+    builder.add_edge(START, "tools")
+    builder.add_edge("tools", END)
+    graph = builder.compile()
+
+    def call(history, name, args, call_id):
+        turn = AIMessage(content="", tool_calls=[{"name": name, "args": args, "id": call_id}])
+        messages = graph.invoke({"messages": history + [turn]})["messages"]
+        return messages, messages[-1]
+
+    history, first = call([], "numbers", {}, "1")
+    page = json.loads(first.content)
+    assert page["items"] == [0, 1] and page["remaining"] == 3
+    history, second = call(history, "more_results", {"continuation": page["continuation"]}, "2")
+    page = json.loads(second.content)
+    assert page["items"] == [2, 3] and page["remaining"] == 1
+    _, third = call(history, "more_results", {"continuation": page["continuation"]}, "3")
+    assert json.loads(third.content) == [4]
+
+    # The remainder lives in this conversation's messages, not in the process
+    _, elsewhere = call([], "more_results", {"continuation": page["continuation"]}, "4")
+    assert elsewhere.status == "error"
+
+
+
+def test_tool_results_keep_only_the_listed_fields(patient):
+    user = app.get_user_by_username(patient[0])
+    content, artifact = app.serialize_result("current_user", user)
+    assert json.loads(content) == {"id": user.id, "username": patient[0], "role": "user", "email": f"{patient[0]}@example.com"}
+    assert artifact is None
+    assert app.serialize_result("signin", "Invalid credentials") == ("Invalid credentials", None)
+
+
+def test_long_lists_are_cut_once(monkeypatch):
+    monkeypatch.setattr(app, "TOOL_RESULT_MAX_ITEMS", 3)
+    content, artifact = app.serialize_result("numbers", {"numbers": list(range(5))})
+    page = json.loads(content)["numbers"]
+    assert page["items"] == [0, 1, 2] and page["remaining"] == 2
+    assert artifact == {page["continuation"]: [3, 4]}
+
+    # A page with its own cursor is left whole
+    paged = {"appointments": [{"id": i} for i in range(5)], "next_cursor": "abc"}
+    content, artifact = app.serialize_result("list_appointments_by_doctor", paged)
+    assert json.loads(content) == paged and artifact is None
+
+
+def ask(question, thread, session=None):
+    state = {"messages": [HumanMessage(content=question)]}
+    if session:
+        state["session"] = session
+    return app.graph.invoke(state, {"configurable": {"thread_id": thread}})["messages"][-1].content
+
+
+def test_guest_answers_are_reused_for_similar_questions(scripted, unique):
+    scripted([{"match": r"cardiolog", "steps": [[{"name": "search_doctors", "args": {"query": "cardiologist"}}]], "reply": f"first {unique}"}])
+    assert ask(f"Which cardiologists do you have {unique}?", f"guest-a-{unique}") == f"first {unique}"
+
+    scripted([{"match": r"", "reply": "from the model"}])
+    assert ask(f"which cardiologists do you have, {unique}", f"guest-b-{unique}") == f"first {unique}"
+    assert ask(f"when does the clinic open {unique}", f"guest-c-{unique}") == "from the model"
+
+    app.add_doctor(f"Dr. Heart {unique}", "Cardiologist", True)  # a directory write empties the cache
+    assert ask(f"Which cardiologists do you have {unique}?", f"guest-d-{unique}") == "from the model"
+
+
+def test_patient_answers_are_not_shared(scripted, patient, other_patient, unique):
+    scripted([{"match": r"", "reply": f"for {patient[0]} only"}])
+    assert ask(f"which dermatologists are free {unique}", f"patient-{unique}", patient[1]) == f"for {patient[0]} only"
+
+    scripted([{"match": r"", "reply": "from the model"}])
+    assert ask(f"which dermatologists are free {unique}", f"other-{unique}", other_patient[1]) == "from the model"
+    assert ask(f"which dermatologists are free {unique}", f"guest-{unique}") == "from the model"
+
+    # and a patient never gets a guest's cached answer
+    scripted([{"match": r"", "reply": "for guests"}])
+    assert ask(f"which neurologists are there {unique}", f"guest-n-{unique}") == "for guests"
+    scripted([{"match": r"", "reply": "from the model"}])
+    assert ask(f"which neurologists are there {unique}", f"patient-n-{unique}", patient[1]) == "from the model"
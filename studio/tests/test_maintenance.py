@@ -0,0 +1,87 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlmodel import Session, func, select
+
+import doctor_appointment as app
+
+
+def add_appointment(doctor, status, start, minutes=60, email="patient@example.com"):
+    with Session(app.engine) as session:
+        appointment = app.Appointment(
+            doctor_id=doctor.id, patient_name="patient", patient_email=email,
+            date=start.strftime("%Y-%m-%d"), time=start.strftime("%H:%M"),
+            start_time=start, end_time=start + timedelta(minutes=minutes), status=status,
+        )
+        session.add(appointment)
+        session.commit()
+        return appointment.id
+
+
+def status_of(id):
+    with Session(app.engine) as session:
+        appointment = session.get(app.Appointment, id)
+        return appointment.status if appointment else None
+
+
+def test_only_ended_appointments_are_completed(doctor):
+    # Times are stored as clinic wall-clock time; the clinic here is behind UTC, so
+    # comparing against UTC would complete appointments that are still going on.
+    now = datetime.now(app.CLINIC_TIMEZONE).replace(tzinfo=None)
+    ongoing = add_appointment(doctor, "Booked", now - timedelta(minutes=30))
+    upcoming = add_appointment(doctor, "Booked", now + timedelta(hours=1))
+    ended = add_appointment(doctor, "Booked", now - timedelta(hours=2))
+
+    app.complete_past_appointments()
+
+    assert [status_of(id) for id in [ongoing, upcoming, ended]] == ["Booked", "Booked", "Completed"]
+
+
+def test_old_cancellations_are_purged(doctor):
+    now = datetime.now(app.CLINIC_TIMEZONE).replace(tzinfo=None)
+    old = add_appointment(doctor, "Cancelled", now - timedelta(days=app.PURGE_CANCELLED_AFTER_DAYS + 1))
+    recent = add_appointment(doctor, "Cancelled", now - timedelta(days=app.PURGE_CANCELLED_AFTER_DAYS - 1))
+
+    app.purge_cancelled_appointments(chunk_size=1)
+
+    assert status_of(old) is None
+    assert status_of(recent) == "Cancelled"
+
+
+def queued_for(email):
+    with Session(app.engine) as session:
+        return session.exec(select(func.count()).select_from(app.EmailOutbox).where(app.EmailOutbox.to_email == email)).one()
+
+
+def test_cancelling_a_day_only_emails_patients_when_asked(doctor, unique):
+    quiet, told = f"quiet_{unique}@example.com", f"told_{unique}@example.com"
+    add_appointment(doctor, "Booked", datetime(2031, 5, 6, 10), email=quiet)
+    add_appointment(doctor, "Booked", datetime(2031, 5, 7, 10), email=told)
+
+    assert app.cancel_doctor_day(doctor.id, "2031-05-06")["cancelled"] == 1
+    result = asyncio.run(app.acancel_doctor_day(doctor.id, "2031-05-07", notify_patients=True))
+
+    assert (result["cancelled"], result["notified"]) == (1, 1)
+    assert (queued_for(quiet), queued_for(told)) == (0, 1)
+
+
+def test_backfill_parses_legacy_date_and_time_strings(doctor):
+    legacy = [("2031-07-01", "09:30"), ("02/07/2031", "2:30 PM"), ("someday", "noon")]
+    ids = []
+    with Session(app.engine) as session:
+        for date, clock in legacy:
+            appointment = app.Appointment(doctor_id=doctor.id, patient_name="legacy", patient_email="legacy@example.com", date=date, time=clock)
+            session.add(appointment)
+            session.commit()
+            ids.append(appointment.id)
+
+    result = app.backfill_appointment_start_times(batch_size=1)
+
+    assert result["unparsed"][-1] == ids[2] and ids[0] not in result["unparsed"]
+    with Session(app.engine) as session:
+        rows = [session.get(app.Appointment, id) for id in ids]
+    expected = [datetime(2031, 7, 1, 9, 30, tzinfo=app.CLINIC_TIMEZONE), datetime(2031, 7, 2, 14, 30, tzinfo=app.CLINIC_TIMEZONE)]
+    assert [app.as_clinic_time(row.start_time) for row in rows[:2]] == expected
+    assert [app.as_clinic_time(row.end_time) - app.as_clinic_time(row.start_time) for row in rows[:2]] == [timedelta(minutes=app.DEFAULT_SLOT_MINUTES)] * 2
+    assert rows[2].start_time is None
+    assert app.backfill_appointment_start_times()["updated"] == 0
@@ -0,0 +1,116 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+from langchain_core.messages import AIMessage
+
+import doctor_appointment as app
+
+
+def test_login_throttle_is_bounded():
+    throttle = app.LoginThrottle(max_failures=3, window=60, max_usernames=100)
+    for i in range(1000):
+        throttle.failed(f"user{i}")
+    assert len(throttle._failures) == 100
+    for _ in range(3):
+        throttle.failed("bob")
+    assert throttle.retry_after("bob") > 0
+    assert throttle.retry_after("user0") == 0
+
+
+def test_login_throttle_drops_expired_usernames():
+    throttle = app.LoginThrottle(max_failures=3, window=0.05)
+    for i in range(10):
+        throttle.failed(f"user{i}")
+    time.sleep(0.1)
+    throttle.failed("bob")
+    assert list(throttle._failures) == ["bob"]
+
+
+def test_session_token_round_trip(patient):
+    username, session = patient
+    assert app.verify_session_token(session)["sub"] == username
+    assert app.current_user(session)["role"] == "user"
+
+
+def test_tampered_or_expired_token_is_rejected(patient, monkeypatch):
+    username, session = patient
+    payload, signature = session.split(".")
+    assert app.verify_session_token(f"{payload}x.{signature}") is None
+    assert app.verify_session_token(f"{payload}.{signature[:-1]}é") is None
+    assert app.role_of({"session": f"{payload}.é"}) == "guest"
+    later = time.time() + app.SESSION_TTL + 1
+    monkeypatch.setattr(app.time, "time", lambda: later)
+    assert app.verify_session_token(session) is None
+    assert app.current_user(session) == {"role": "guest"}
+
+
+def principal_of(command):
+    return app.verify_session_token(command.update["session"])
+
+
+def test_chat_signup_cannot_create_an_admin(unique, patient):
+    guest = app.signup_session(f"guest_{unique}", "password1", "call-1", role="admin", email=f"guest_{unique}@example.com")
+    assert principal_of(guest)["role"] == "user"
+    signed_in = app.signup_session(f"user_{unique}", "password1", "call-2", role="admin", email=f"user_{unique}@example.com",
+                                   session=patient[1])
+    assert principal_of(signed_in)["role"] == "user"
+
+
+def test_admin_can_create_an_admin(unique, admin):
+    created = app.signup_session(f"second_admin_{unique}", "password1", "call-1", role="admin", email=f"second_admin_{unique}@example.com",
+                               session=admin[1])
+    assert principal_of(created)["role"] == "admin"
+
+
+def test_guest_tool_calls_are_rejected():
+    state = {"messages": [AIMessage(content="", tool_calls=[
+        {"name": "get_all_doctors", "args": {}, "id": "call-1"},
+        {"name": "book_appointment", "args": {}, "id": "call-2"},
+    ])]}
+    assert app.route_tool_calls(state) == "reject_tool_calls"
+    allowed, denied = app.reject_tool_calls(state)["messages"]
+    assert allowed.content.startswith("Not run")
+    assert "guest role may not use book_appointment" in denied.content
+
+
+def test_patient_tool_calls_are_routed(patient):
+    state = {"session": patient[1], "messages": [AIMessage(content="", tool_calls=[
+        {"name": "book_appointment", "args": {}, "id": "call-1"},
+    ])]}
+    assert app.route_tool_calls(state) == "tools"
+
+
+def test_patients_only_see_their_own_appointments(doctor, patient, other_patient, admin, unique):
+    booked = app.reserve_appointment(app.Appointment(
+        doctor_id=doctor.id, patient_name=patient[0], patient_email="p@example.com", date="2031-06-03", time="10:00",
+    ), f"own-{unique}")
+
+    assert app.get_appointment(booked.id, session=other_patient[1]) is None
+    assert app.update_appointment(booked.id, "Cancelled", session=other_patient[1]) is None
+    with pytest.raises(ValueError, match="your own"):
+        app.get_appointments_by_patient_name(patient[0], doctor.id, session=other_patient[1])
+    with pytest.raises(ValueError, match="your own"):
+        app.list_appointments_by_patient(patient[0], "2031-06-01", "2031-06-30", session=other_patient[1])
+    with pytest.raises(ValueError, match="sign in"):
+        app.get_appointment(booked.id)
+
+    assert app.get_appointment(booked.id, session=patient[1]).id == booked.id
+    assert app.get_appointment(booked.id, session=admin[1]).id == booked.id
+    assert app.update_appointment(booked.id, "Cancelled", session=patient[1]).status == "Cancelled"
+
+
+def test_process_pool_workers_only_load_the_hashing_module():
+    assert (app.hash_password.__module__, app.verify_password.__module__) == ("passwords", "passwords")
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        hashed = pool.submit(app.hash_password, "password1", 4).result()
+    assert app.verify_password("password1", hashed)
+
+    # What a fresh worker imports to run a job
+    probe = "import sys, passwords; print(sorted({'doctor_appointment', 'sqlalchemy', 'langgraph'} & set(sys.modules)))"
+    loaded = subprocess.run([sys.executable, "-c", probe], cwd=os.path.dirname(app.__file__), capture_output=True, text=True, check=True)
+    assert loaded.stdout.strip() == "[]"
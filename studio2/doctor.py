@@ -1,4 +1,6 @@
 import os
+import threading
+import time
 from typing import Optional, Annotated, List, Dict, Any
 from typing_extensions import TypedDict
 # from typing import TypedDict
@@ -15,6 +17,7 @@ from langgraph.graph import MessagesState, StateGraph, START
 from langgraph.prebuilt import tools_condition, ToolNode
 from langgraph.graph.state import CompiledStateGraph
 from sqlmodel import SQLModel, Field, Session, create_engine, select, Column, String
+from sqlalchemy import make_url, event
 import bcrypt
 from email.message import EmailMessage
 import smtplib
@@ -54,7 +57,110 @@ llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash", api_key=GOOGLE_API_KEY)
 
 
 
-engine = create_engine(DATABASE_URL)
+# Each studio app is deployed on its own (its own langgraph.json and requirements), so
+# this block is a copy of the one in studio/doctor_appointment.py. Change them together.
+# Connection pool settings for the domain database. Neon closes idle connections, so
+# connections are pre-pinged and recycled before the server drops them.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "300"))  # seconds
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+
+
+def create_db_engine(database_url):
+    """
+    Creates the SQLAlchemy engine with pool sizing, pre-ping, recycle and
+    statement timeout taken from the environment.
+    """
+    url = make_url(database_url)
+    kwargs = {"pool_pre_ping": True, "pool_recycle": DB_POOL_RECYCLE}
+    if url.get_backend_name() != "sqlite":
+        kwargs.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+
+    new_engine = create_engine(url, **kwargs)
+
+    if url.get_backend_name() in ("postgres", "postgresql") and DB_STATEMENT_TIMEOUT_MS:
+        # Set per connection rather than via the `options` startup parameter,
+        # which Neon's pooled (PgBouncer) endpoints reject.
+        @event.listens_for(new_engine, "connect")
+        def set_statement_timeout(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"SET statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+            cursor.close()
+            dbapi_connection.commit()
+
+    return new_engine
+
+
+class PoolMetrics:
+    """
+    Counts pool checkouts, new connections, invalidations and executed statements
+    (by SQL verb), and how long connections stay checked out.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.held_seconds_total = 0.0
+        self.held_seconds_max = 0.0
+        self.queries: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+        event.listen(engine, "invalidate", self._on_invalidate)
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checked_out_at"] = time.monotonic()
+        with self._lock:
+            self.checkouts += 1
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop("checked_out_at", None)
+        with self._lock:
+            self.checkins += 1
+            if checked_out_at is not None:
+                held = time.monotonic() - checked_out_at
+                self.held_seconds_total += held
+                self.held_seconds_max = max(self.held_seconds_max, held)
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+    def _on_execute(self, connection, cursor, statement, parameters, context, executemany):
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        with self._lock:
+            self.queries[verb] = self.queries.get(verb, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the counters plus the pool's own status line.
+        """
+        with self._lock:
+            return {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checked_out": self.checkouts - self.checkins,
+                "invalidations": self.invalidations,
+                "queries": dict(self.queries),
+                "held_seconds_avg": self.held_seconds_total / self.checkins if self.checkins else 0.0,
+                "held_seconds_max": self.held_seconds_max,
+                "pool": self.engine.pool.status(),
+            }
+
+
+engine = create_db_engine(DATABASE_URL)
+engine_metrics = PoolMetrics(engine)
 
 
 
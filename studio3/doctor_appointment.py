@@ -1,7 +1,8 @@
 from typing import Optional, Annotated, List, Dict, Any
 from typing_extensions import TypedDict
 # from typing import TypedDict
-from langgraph.types import Command, interrupt
+from langgraph.types import Command
+from langgraph.config import get_config
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from langgraph.graph.message import add_messages
 from langgraph.graph import MessagesState, StateGraph, START
@@ -11,23 +12,29 @@ import bcrypt
 from email.message import EmailMessage
 import smtplib
 import os
+import asyncio
+import logging
+import threading
+import time
+import functools
+import weakref
+from datetime import datetime, timedelta, timezone
+import email
+import email.policy
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.tools import StructuredTool
 from langchain_google_genai import ChatGoogleGenerativeAI
 from psycopg_pool import ConnectionPool
 from langgraph.checkpoint.postgres import PostgresSaver
-import sqlite3
 
 from sqlmodel import SQLModel, Field, Session, create_engine, select, Column, String
-# Define the path for the SQLite database in Google Drive
-db_path = "/local_database.db"
-
-# Ensure the directory exists
-if not os.path.exists(os.path.dirname(db_path)):
-    os.makedirs(os.path.dirname(db_path))
-
-conn = sqlite3.connect(db_path, check_same_thread=False)
-from langgraph.checkpoint.sqlite import SqliteSaver
-memory: SqliteSaver = SqliteSaver(conn)
-
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import make_url, event, inspect, text, DateTime, Index, update, bindparam, and_
+from sqlalchemy.schema import AddConstraint
+from zoneinfo import ZoneInfo
+from sqlalchemy.pool import NullPool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 MAIL_USERNAME = os.environ['MAIL_USERNAME']
 MAIL_PASSWORD = os.environ['MAIL_PASSWORD']
 
@@ -40,18 +47,216 @@ import os
 DATABASE_URL = os.environ['DATABASE_URL']
 MEMORY_DATABASE = os.environ['DB_URL']
 
+# Background jobs and admin commands report progress here
+logger = logging.getLogger(__name__)
+
+# Run the checkpointer and the CRUD tools on one psycopg pool instead of a checkpointer
+# pool plus separate SQLAlchemy pools. Only takes effect when DB_URL (checkpoints) and
+# DATABASE_URL name the same database, so turning it on never moves the checkpoints.
+SHARED_DB_POOL = os.getenv("SHARED_DB_POOL", "false").lower() in ["1", "true", "yes"]
+
+# Connection pool for efficient database access
+connection_kwargs = {"autocommit": True, "prepare_threshold": 0}
+
+
+
+# Each studio app is deployed on its own (its own langgraph.json and requirements), so
+# this block is a copy of the one in studio/doctor_appointment.py. Change them together.
+# Connection pool settings for the domain database. Neon closes idle connections, so
+# connections are pre-pinged and recycled before the server drops them.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "300"))  # seconds
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+
+
+def create_db_engine(database_url, is_async: bool = False):
+    """
+    Creates the SQLAlchemy engine with pool sizing, pre-ping, recycle and
+    statement timeout taken from the environment.
+    """
+    url = make_url(database_url)
+    kwargs = {"pool_pre_ping": True, "pool_recycle": DB_POOL_RECYCLE}
+    if url.get_backend_name() != "sqlite":
+        kwargs.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+
+    new_engine = create_async_engine(url, **kwargs) if is_async else create_engine(url, **kwargs)
+
+    if url.get_backend_name() in ("postgres", "postgresql") and DB_STATEMENT_TIMEOUT_MS:
+        # Set per connection rather than via the `options` startup parameter,
+        # which Neon's pooled (PgBouncer) endpoints reject.
+        @event.listens_for(new_engine.sync_engine if is_async else new_engine, "connect")
+        def set_statement_timeout(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"SET statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+            cursor.close()
+            dbapi_connection.commit()
+
+    return new_engine
+
+
+class PoolMetrics:
+    """
+    Counts pool checkouts, new connections, invalidations and executed statements
+    (by SQL verb), and how long connections stay checked out.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.held_seconds_total = 0.0
+        self.held_seconds_max = 0.0
+        self.queries: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+        event.listen(engine, "invalidate", self._on_invalidate)
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checked_out_at"] = time.monotonic()
+        with self._lock:
+            self.checkouts += 1
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop("checked_out_at", None)
+        with self._lock:
+            self.checkins += 1
+            if checked_out_at is not None:
+                held = time.monotonic() - checked_out_at
+                self.held_seconds_total += held
+                self.held_seconds_max = max(self.held_seconds_max, held)
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+    def _on_execute(self, connection, cursor, statement, parameters, context, executemany):
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        with self._lock:
+            self.queries[verb] = self.queries.get(verb, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns the counters plus the pool's own status line.
+        """
+        with self._lock:
+            return {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checked_out": self.checkouts - self.checkins,
+                "invalidations": self.invalidations,
+                "queries": dict(self.queries),
+                "held_seconds_avg": self.held_seconds_total / self.checkins if self.checkins else 0.0,
+                "held_seconds_max": self.held_seconds_max,
+                "pool": self.engine.pool.status(),
+            }
+
+
+class SharedPool:
+    """
+    One psycopg pool serving both the PostgresSaver checkpointer and the
+    SQLAlchemy engine of the CRUD tools, sized by DB_POOL_SIZE/DB_MAX_OVERFLOW
+    and health-checked on every checkout.
+    """
+
+    def __init__(self, database_url):
+        conninfo = make_url(database_url).set(drivername="postgresql").render_as_string(hide_password=False)
+        self.pool = ConnectionPool(
+            conninfo=conninfo,
+            min_size=DB_POOL_SIZE,
+            max_size=DB_POOL_SIZE + DB_MAX_OVERFLOW,
+            timeout=DB_POOL_TIMEOUT,
+            max_lifetime=DB_POOL_RECYCLE,
+            kwargs=connection_kwargs,
+            configure=self._configure,
+            reset=self._reset,
+            check=ConnectionPool.check_connection,
+            close_returns=True,  # SQLAlchemy's close() hands the connection back
+            open=True,
+        )
+
+    def _configure(self, connection) -> None:
+        if DB_STATEMENT_TIMEOUT_MS:
+            connection.execute(f"SET statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+
+    def _reset(self, connection) -> None:
+        connection.autocommit = True  # what the checkpointer expects
 
+    def connect(self):
+        """
+        SQLAlchemy `creator`: borrows a connection in transactional mode.
+        """
+        connection = self.pool.getconn()
+        connection.autocommit = False
+        return connection
 
-engine = create_engine(DATABASE_URL)
+    def create_engine(self):
+        # NullPool: the psycopg pool does the pooling, SQLAlchemy just borrows
+        return create_engine("postgresql+psycopg://", creator=self.connect, poolclass=NullPool)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns psycopg_pool's counters (requests, waits, errors, sizes).
+        """
+        return self.pool.get_stats()
+
+
+def same_database(first_url: str, second_url: str) -> bool:
+    first, second = make_url(first_url), make_url(second_url)
+    return (first.host, first.port, first.database, first.username, first.query.get("host")) == (
+        second.host, second.port, second.database, second.username, second.query.get("host"))
+
+
+if SHARED_DB_POOL and not same_database(MEMORY_DATABASE, DATABASE_URL):
+    print(
+        "SHARED_DB_POOL ignored: DB_URL and DATABASE_URL are different databases, and sharing one pool "
+        "would move the checkpointer to DATABASE_URL and lose existing threads. Point both at the same "
+        "database (after copying the checkpoint tables over) to share the pool."
+    )
+shared_pool: Optional[SharedPool] = SharedPool(DATABASE_URL) if SHARED_DB_POOL and same_database(MEMORY_DATABASE, DATABASE_URL) else None
+
+engine = shared_pool.create_engine() if shared_pool else create_db_engine(DATABASE_URL)
+engine_metrics = PoolMetrics(engine)
+
+
+def async_database_url(database_url: str):
+    """
+    Maps the sync DATABASE_URL onto the matching async driver
+    (psycopg 3 for Postgres/Neon, aiosqlite for local SQLite).
+    """
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if backend in ("postgres", "postgresql"):
+        return url.set(drivername="postgresql+psycopg")
+    if backend == "sqlite":
+        return url.set(drivername="sqlite+aiosqlite")
+    return url
+
+
+# Async engine used by the tool coroutines, so DB round-trips don't hold a worker thread.
+# With SHARED_DB_POOL there is no second pool: tools run their sync twin on a thread instead.
+if shared_pool:
+    async_engine = async_engine_metrics = async_session = None
+else:
+    async_engine = create_db_engine(async_database_url(DATABASE_URL), is_async=True)
+    async_engine_metrics = PoolMetrics(async_engine.sync_engine)
+    async_session = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
 # Set up the database connection (SQLite stored in Google Drive)
 # engine = setup_database()
 
 
-# Connection pool for efficient database access
-connection_kwargs = {"autocommit": True, "prepare_threshold": 0}
-
 # Create a persistent connection pool
-pool = ConnectionPool(conninfo=MEMORY_DATABASE, max_size=20, kwargs=connection_kwargs)
+pool = shared_pool.pool if shared_pool else ConnectionPool(conninfo=MEMORY_DATABASE, max_size=20, kwargs=connection_kwargs)
 
 # Initialize PostgresSaver checkpointer
 checkpointer = PostgresSaver(pool)
@@ -80,14 +285,71 @@ class Doctor(SQLModel, table=True):
 
 # SQLModel Schema for Appointment
 class Appointment(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_appointment_doctor_id_start_time", "doctor_id", "start_time"),
+        Index("ix_appointment_patient_name_start_time", "patient_name", "start_time"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)  # Appointment ID
-    doctor_id: int  # Foreign key to Doctor
+    doctor_id: int = Field(foreign_key="doctor.id", ondelete="RESTRICT")  # Foreign key to Doctor
     patient_name: str  # Patient's name
     patient_email: str
     date: str  # Appointment date
     time: str  # Appointment time
     status: str = "Booked"  # Default status ("Booked", "Completed", "Cancelled", etc.)
     send_notification: bool = Field(default=False)
+    start_time: Optional[datetime] = Field(default=None, sa_column=Column(DateTime(timezone=True)))  # Parsed from date + time
+
+
+def utcnow() -> datetime:
+    """
+    Current time as a timezone-aware UTC datetime.
+    """
+    return datetime.now(timezone.utc)
+
+
+# Appointment date/time strings are in the clinic's local time
+CLINIC_TIMEZONE = ZoneInfo(os.getenv("CLINIC_TIMEZONE", "UTC"))
+
+DATE_FORMATS = ["%Y-%m-%d", "%d-%m-%Y", "%d/%m/%Y", "%m/%d/%Y", "%Y/%m/%d", "%B %d, %Y", "%b %d, %Y", "%d %B %Y", "%d %b %Y"]
+TIME_FORMATS = ["%H:%M", "%H:%M:%S", "%I:%M %p", "%I:%M%p", "%I %p", "%I%p"]
+
+
+def parse_appointment_start(date: str, time: str) -> Optional[datetime]:
+    """
+    Parses the free-form appointment date and time into an aware datetime,
+    or returns None if either part isn't in a recognised format.
+    """
+    parsed_date = parsed_time = None
+    for date_format in DATE_FORMATS:
+        try:
+            parsed_date = datetime.strptime(date.strip(), date_format).date()
+            break
+        except ValueError:
+            continue
+    for time_format in TIME_FORMATS:
+        try:
+            parsed_time = datetime.strptime(time.strip().upper(), time_format).time()
+            break
+        except ValueError:
+            continue
+    if parsed_date is None or parsed_time is None:
+        return None
+    return datetime.combine(parsed_date, parsed_time, tzinfo=CLINIC_TIMEZONE)
+
+
+# SQLModel Schema for queued emails (transactional outbox)
+class EmailOutbox(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    to_email: str
+    subject: str
+    body: str
+    status: str = Field(default="pending", index=True)  # "pending", "sending", "sent" or "failed"
+    attempts: int = 0
+    next_attempt_at: datetime = Field(default_factory=utcnow, index=True)
+    last_error: Optional[str] = None
+    created_at: datetime = Field(default_factory=utcnow)
+    sent_at: Optional[datetime] = None
 
 
 def create_db_and_tables() -> None:
@@ -96,11 +358,77 @@ def create_db_and_tables() -> None:
     """
     # Dropping and recreating all tables for a fresh start
     SQLModel.metadata.create_all(engine)
+    upgrade_schema()
     print("Database tables synced successfully.")
 
+
+def upgrade_schema() -> None:
+    """
+    Adds columns, indexes and foreign keys that were introduced after a table was
+    first created, since create_all only creates missing tables. New columns must be nullable.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in SQLModel.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(engine.dialect)
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                    logger.info("Added column %s.%s", table.name, column.name)
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+            # SQLite can't add constraints to an existing table
+            if engine.dialect.name == "postgresql":
+                existing_keys = {tuple(key["constrained_columns"]) for key in inspector.get_foreign_keys(table.name)}
+                for constraint in table.foreign_key_constraints:
+                    if tuple(constraint.column_keys) not in existing_keys:
+                        # NOT VALID: enforced for new rows without scanning (or failing on) old ones
+                        ddl = AddConstraint(constraint).compile(dialect=engine.dialect)
+                        connection.execute(text(f"{ddl} NOT VALID"))
+                        logger.info("Added foreign key on %s(%s)", table.name, ", ".join(constraint.column_keys))
+
 # Create database tables
 create_db_and_tables()
 
+
+def backfill_appointment_start_times(batch_size: int = 500) -> Dict[str, Any]:
+    """
+    Fills Appointment.start_time for rows written before the column existed,
+    parsing their date/time strings one batch (and one short transaction) at a time.
+    Rows that can't be parsed are left NULL and listed in the result.
+    """
+    updated = 0
+    unparsed: List[int] = []
+    last_id = 0
+    statement = update(Appointment).where(Appointment.id == bindparam("appointment_id")).values(start_time=bindparam("parsed_start"))
+    while True:
+        with Session(engine) as session:
+            rows = session.exec(
+                select(Appointment.id, Appointment.date, Appointment.time)
+                .where(Appointment.start_time.is_(None), Appointment.id > last_id)
+                .order_by(Appointment.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            params = []
+            for appointment_id, date, appointment_time in rows:
+                start = parse_appointment_start(date, appointment_time)
+                if start is None:
+                    unparsed.append(appointment_id)
+                else:
+                    params.append({"appointment_id": appointment_id, "parsed_start": start})
+            if params:
+                session.connection().execute(statement, params)
+            session.commit()
+            updated += len(params)
+            logger.info("Backfilled %d appointments (up to id %d)", updated, last_id)
+    return {"updated": updated, "unparsed": unparsed}
+
 # Tools
 
 
@@ -120,6 +448,17 @@ def add_doctor(name: str, specialty: str, available: bool) -> Doctor:
         session.refresh(doctor)
         return doctor
 
+async def aadd_doctor(name: str, specialty: str, available: bool) -> Doctor:
+    """
+    Async twin of add_doctor.
+    """
+    async with async_session() as session:
+        doctor = Doctor(name=name, specialty=specialty, available=available)
+        session.add(doctor)
+        await session.commit()
+        await session.refresh(doctor)
+        return doctor
+
 def get_doctor(doctor_id: int) -> Optional[dict]:
     """
     Retrieves a doctor's information (name and speciality) by their doctor_id.
@@ -138,6 +477,17 @@ def get_doctor(doctor_id: int) -> Optional[dict]:
         else:
             return None
 
+async def aget_doctor(doctor_id: int) -> Optional[dict]:
+    """
+    Async twin of get_doctor.
+    """
+    async with async_session() as session:
+        doctor = (await session.exec(select(Doctor).where(Doctor.id == doctor_id))).first()
+        if doctor:
+            return {"name": doctor.name, "speciality": doctor.specialty}
+        else:
+            return None
+
 def update_doctor(doctor_id: int, name: Optional[str] = None, specialty: Optional[str] = None, available: Optional[bool] = None) -> Optional[Doctor]:
     """
     Updates a doctor's details by their ID.
@@ -157,6 +507,25 @@ def update_doctor(doctor_id: int, name: Optional[str] = None, specialty: Optiona
             return doctor
         return None
 
+async def aupdate_doctor(doctor_id: int, name: Optional[str] = None, specialty: Optional[str] = None, available: Optional[bool] = None) -> Optional[Doctor]:
+    """
+    Async twin of update_doctor.
+    """
+    async with async_session() as session:
+        doctor = (await session.exec(select(Doctor).where(Doctor.id == doctor_id))).first()
+        if doctor:
+            if name:
+                doctor.name = name
+            if specialty:
+                doctor.specialty = specialty
+            if available is not None:
+                doctor.available = available
+            session.add(doctor)
+            await session.commit()
+            await session.refresh(doctor)
+            return doctor
+        return None
+
 def delete_doctor(doctor_id: int) -> bool:
     """
     Deletes a doctor from the database by their ID.
@@ -164,11 +533,27 @@ def delete_doctor(doctor_id: int) -> bool:
     with Session(engine) as session:
         doctor = session.exec(select(Doctor).where(Doctor.id == doctor_id)).first()
         if doctor:
+            if session.exec(select(Appointment.id).where(Appointment.doctor_id == doctor_id).limit(1)).first():
+                raise ValueError("Doctor has appointments; cancel or reassign them before deleting")
             session.delete(doctor)
             session.commit()
             return True
         return False
 
+async def adelete_doctor(doctor_id: int) -> bool:
+    """
+    Async twin of delete_doctor.
+    """
+    async with async_session() as session:
+        doctor = (await session.exec(select(Doctor).where(Doctor.id == doctor_id))).first()
+        if doctor:
+            if (await session.exec(select(Appointment.id).where(Appointment.doctor_id == doctor_id).limit(1))).first():
+                raise ValueError("Doctor has appointments; cancel or reassign them before deleting")
+            await session.delete(doctor)
+            await session.commit()
+            return True
+        return False
+
 
 
 def get_appointments_by_user(id: int) -> list[Appointment]:
@@ -184,6 +569,14 @@ def get_appointments_by_user(id: int) -> list[Appointment]:
         appointments = session.exec(select(Appointment).where(Appointment.id == id)).all()
         return appointments
 
+async def aget_appointments_by_user(id: int) -> list[Appointment]:
+    """
+    Async twin of get_appointments_by_user.
+    """
+    async with async_session() as session:
+        appointments = (await session.exec(select(Appointment).where(Appointment.id == id))).all()
+        return appointments
+
 
 def get_appointments_by_patient_name(patient_name: str) -> List[Appointment]:
     """Retrieves all appointments for a specific patient by their name.
@@ -198,13 +591,30 @@ def get_appointments_by_patient_name(patient_name: str) -> List[Appointment]:
     with Session(engine) as session:
         # Query to get appointments based on patient_name
         appointments = session.exec(
-            select(Appointment).where(Appointment.patient_name == patient_name)
+            select(Appointment)
+            .where(Appointment.patient_name == patient_name)
+            .order_by(Appointment.start_time, Appointment.id)
         ).all()
 
         if not appointments:
              print(f"No appointments found for patient: {patient_name}")
         return appointments
 
+async def aget_appointments_by_patient_name(patient_name: str) -> List[Appointment]:
+    """
+    Async twin of get_appointments_by_patient_name.
+    """
+    async with async_session() as session:
+        appointments = (await session.exec(
+            select(Appointment)
+            .where(Appointment.patient_name == patient_name)
+            .order_by(Appointment.start_time, Appointment.id)
+        )).all()
+
+        if not appointments:
+             print(f"No appointments found for patient: {patient_name}")
+        return appointments
+
 
 
 def update_appointment(appointment_id: int, status: str) -> Optional[Appointment]:
@@ -220,6 +630,19 @@ def update_appointment(appointment_id: int, status: str) -> Optional[Appointment
             session.refresh(appointment)
         return appointment
 
+async def aupdate_appointment(appointment_id: int, status: str) -> Optional[Appointment]:
+    """
+    Async twin of update_appointment.
+    """
+    async with async_session() as session:
+        appointment = (await session.exec(select(Appointment).where(Appointment.id == appointment_id))).first()
+        if appointment:
+            appointment.status = status
+            session.add(appointment)
+            await session.commit()
+            await session.refresh(appointment)
+        return appointment
+
 def delete_appointment(appointment_id: int) -> bool:
     """
     Deletes an appointment from the database by appointment ID.
@@ -232,9 +655,397 @@ def delete_appointment(appointment_id: int) -> bool:
             return True
         return False
 
+async def adelete_appointment(appointment_id: int) -> bool:
+    """
+    Async twin of delete_appointment.
+    """
+    async with async_session() as session:
+        appointment = (await session.exec(select(Appointment).where(Appointment.id == appointment_id))).first()
+        if appointment:
+            await session.delete(appointment)
+            await session.commit()
+            return True
+        return False
+
 
 # Email Sending Function
 
+# Each studio app is deployed on its own (its own langgraph.json and requirements), so
+# this block is a copy of the one in studio/doctor_appointment.py. Change them together.
+# SMTP settings, shared by send_email and the outbox worker
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
+SMTP_SSL = os.getenv("SMTP_SSL", "true").lower() in ["1", "true", "yes"]
+
+# Email outbox worker settings
+EMAIL_OUTBOX_WORKER = os.getenv("EMAIL_OUTBOX_WORKER", "thread")  # 'thread' runs it in this process, 'off' leaves it to a separate process
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "2"))  # seconds
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "30"))  # seconds, doubled per attempt
+OUTBOX_SEND_LEASE = float(os.getenv("OUTBOX_SEND_LEASE", "600"))  # seconds a claimed batch is reserved for its worker
+
+
+def build_email(subject: str, body: str, to_email: str) -> EmailMessage:
+    """
+    Builds the EmailMessage sent from MAIL_USERNAME.
+    """
+    msg = EmailMessage()
+    msg.set_content(body)
+    msg['Subject'] = subject
+    msg['From'] = MAIL_USERNAME
+    msg['To'] = to_email
+    return msg
+
+
+def connect_smtp(host: str = None, port: int = None, use_ssl: bool = None) -> smtplib.SMTP:
+    """
+    Opens and logs in an SMTP connection using the SMTP_* settings.
+    """
+    host = host or SMTP_HOST
+    port = port or SMTP_PORT
+    use_ssl = SMTP_SSL if use_ssl is None else use_ssl
+    server = smtplib.SMTP_SSL(host, port, timeout=30) if use_ssl else smtplib.SMTP(host, port, timeout=30)
+    server.login(MAIL_USERNAME, MAIL_PASSWORD)
+    return server
+
+
+# SMTP connection pool settings
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
+SMTP_MAX_MESSAGES_PER_CONNECTION = int(os.getenv("SMTP_MAX_MESSAGES_PER_CONNECTION", "100"))
+SMTP_KEEPALIVE_INTERVAL = float(os.getenv("SMTP_KEEPALIVE_INTERVAL", "60"))  # seconds between NOOPs
+SMTP_MAX_IDLE = float(os.getenv("SMTP_MAX_IDLE", "300"))  # seconds before an unused session is closed
+
+
+class PooledSMTP:
+    """
+    A logged-in SMTP session plus the bookkeeping the pool needs.
+    """
+
+    def __init__(self, server: smtplib.SMTP):
+        self.server = server
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+    def alive(self) -> bool:
+        try:
+            return self.server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close(self) -> None:
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+
+class SMTPPool:
+    """
+    Keeps up to `size` logged-in SMTP sessions for reuse. Idle sessions get a NOOP
+    keepalive and are closed after SMTP_MAX_IDLE; a session is retired after
+    max_messages sends and replaced when it fails.
+    """
+
+    def __init__(self, size: int = SMTP_POOL_SIZE, max_messages: int = SMTP_MAX_MESSAGES_PER_CONNECTION,
+                 keepalive_interval: float = SMTP_KEEPALIVE_INTERVAL, max_idle: float = SMTP_MAX_IDLE,
+                 host: str = None, port: int = None, use_ssl: bool = None):
+        self.size = size
+        self.max_messages = max_messages
+        self.keepalive_interval = keepalive_interval
+        self.max_idle = max_idle
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.connects = 0
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle: List[PooledSMTP] = []
+        self._lock = threading.Lock()
+        self._keepalive: Optional[threading.Thread] = None
+        self._closed = threading.Event()
+
+    def _checkout(self) -> PooledSMTP:
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        if connection is not None:
+            if time.monotonic() - connection.last_used < self.keepalive_interval or connection.alive():
+                return connection
+            connection.close()
+        connection = PooledSMTP(connect_smtp(self.host, self.port, self.use_ssl))
+        with self._lock:
+            self.connects += 1
+            if self._keepalive is None:
+                self._keepalive = threading.Thread(target=self._keepalive_loop, name="smtp-keepalive", daemon=True)
+                self._keepalive.start()
+        return connection
+
+    def _checkin(self, connection: PooledSMTP) -> None:
+        connection.last_used = time.monotonic()
+        if connection.sent >= self.max_messages or self._closed.is_set():
+            connection.close()
+            return
+        with self._lock:
+            self._idle.append(connection)
+
+    def _keepalive_loop(self) -> None:
+        while not self._closed.wait(self.keepalive_interval):
+            with self._lock:
+                idle, self._idle = self._idle, []
+            keep = []
+            for connection in idle:
+                if time.monotonic() - connection.last_used > self.max_idle or not connection.alive():
+                    connection.close()
+                else:
+                    keep.append(connection)
+            with self._lock:
+                self._idle.extend(keep)
+
+    def send(self, msg: EmailMessage) -> None:
+        """
+        Sends one message, reconnecting once if the pooled session has gone away.
+        """
+        for attempt in range(2):
+            self._slots.acquire()
+            connection = None
+            try:
+                connection = self._checkout()
+                connection.server.send_message(msg)
+                connection.sent += 1
+                self._checkin(connection)
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError):
+                # Only a broken session is dropped and retried. Other SMTPExceptions (which
+                # subclass OSError) are server replies, e.g. a refused recipient, and the
+                # session is still good.
+                if connection is not None:
+                    connection.close()
+                if attempt:
+                    raise
+            except Exception:
+                if connection is not None:
+                    self._checkin(connection)
+                raise
+            finally:
+                self._slots.release()
+
+    def send_many(self, messages: List[EmailMessage]) -> List[Optional[Exception]]:
+        """
+        Sends messages over up to `size` sessions at once. Returns one entry per
+        message: None if it was sent, otherwise the exception it failed with.
+        """
+        def send_one(msg: EmailMessage) -> Optional[Exception]:
+            try:
+                self.send(msg)
+                return None
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            return list(executor.map(send_one, messages))
+
+    def close(self) -> None:
+        self._closed.set()
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"connects": self.connects, "idle": len(self._idle), "size": self.size}
+
+
+smtp_pool = SMTPPool()
+
+
+def send_many(emails: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+    """
+    Sends a batch of emails (dicts with subject, body and to_email) over the
+    pooled SMTP sessions, e.g. for reminder or cancellation blasts.
+    """
+    messages = [build_email(item["subject"], item["body"], item["to_email"]) for item in emails]
+    results = smtp_pool.send_many(messages)
+    return [
+        {"to_email": item["to_email"], "sent": error is None, "error": str(error) if error else None}
+        for item, error in zip(emails, results)
+    ]
+
+
+def enqueue_email(session, subject: str, body: str, to_email: str) -> EmailOutbox:
+    """
+    Adds an email to the outbox in the caller's session, so it is only queued
+    if the caller's transaction commits.
+    """
+    queued = EmailOutbox(to_email=to_email, subject=subject, body=body)
+    session.add(queued)
+    return queued
+
+
+class OutboxWorker:
+    """
+    Drains the email outbox in batches over the pooled SMTP sessions,
+    retrying failed sends with exponential backoff.
+    """
+
+    def __init__(self, pool: Optional[SMTPPool] = None,
+                 batch_size: int = OUTBOX_BATCH_SIZE, max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+                 poll_interval: float = OUTBOX_POLL_INTERVAL, backoff_base: float = OUTBOX_BACKOFF_BASE):
+        self.pool = pool or smtp_pool
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.backoff_base = backoff_base
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def claim_batch(self) -> list:
+        """
+        Marks up to batch_size due emails as 'sending' under a lease of OUTBOX_SEND_LEASE
+        seconds and commits straight away, so no row lock or transaction is held while
+        mailing. Claims whose worker died before recording an outcome come due again
+        when the lease runs out.
+        """
+        now = utcnow()
+        due = and_(EmailOutbox.status.in_(["pending", "sending"]), EmailOutbox.next_attempt_at <= now)
+        with Session(engine) as session:
+            ids = session.exec(
+                select(EmailOutbox.id)
+                .where(due)
+                .order_by(EmailOutbox.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)  # several workers can drain side by side
+            ).all()
+            if not ids:
+                return []
+            # Re-checking `due` makes a worker that lost the race (SQLite has no SKIP LOCKED) claim nothing
+            claimed = session.exec(
+                update(EmailOutbox)
+                .where(EmailOutbox.id.in_(ids), due)
+                .values(status="sending", next_attempt_at=now + timedelta(seconds=OUTBOX_SEND_LEASE))
+                .returning(EmailOutbox.id, EmailOutbox.to_email, EmailOutbox.subject, EmailOutbox.body)
+            ).all()
+            session.commit()
+            return claimed
+
+    def drain_once(self) -> int:
+        """
+        Sends one batch of due emails and returns how many were attempted.
+        """
+        batch = self.claim_batch()
+        if not batch:
+            return 0
+        results = self.pool.send_many([build_email(queued.subject, queued.body, queued.to_email) for queued in batch])
+        errors = {queued.id: error for queued, error in zip(batch, results)}
+        with Session(engine) as session:
+            for queued in session.exec(select(EmailOutbox).where(EmailOutbox.id.in_(list(errors)))).all():
+                error = errors[queued.id]
+                if error is None:
+                    queued.status = "sent"
+                    queued.sent_at = utcnow()
+                    print(f"Email sent successfully to {queued.to_email}")
+                else:
+                    queued.attempts += 1
+                    queued.last_error = str(error)
+                    if queued.attempts >= self.max_attempts:
+                        queued.status = "failed"
+                        print(f"Giving up on email to {queued.to_email}: {error}")
+                    else:
+                        queued.status = "pending"
+                        queued.next_attempt_at = utcnow() + timedelta(seconds=self.backoff_base * 2 ** (queued.attempts - 1))
+                        print(f"Failed to send email to {queued.to_email}, will retry: {error}")
+                session.add(queued)
+            session.commit()
+        return len(batch)
+
+    def run(self) -> None:
+        """
+        Drains the outbox until stop() is called.
+        """
+        while not self._stop.is_set():
+            try:
+                sent = self.drain_once()
+            except Exception as e:
+                print(f"Outbox worker error: {e}")
+                sent = 0
+            if not sent:
+                self._stop.wait(self.poll_interval)
+
+    def start(self) -> "OutboxWorker":
+        self._thread = threading.Thread(target=self.run, name="email-outbox", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class LocalSMTPSink(socketserver.ThreadingTCPServer):
+    """
+    Minimal plain-text SMTP server that accepts any login and keeps the
+    messages it receives in memory. A stand-in for Gmail in tests and benchmarks.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), _SMTPSinkHandler)
+        self.messages: List[EmailMessage] = []
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> "LocalSMTPSink":
+        self._thread = threading.Thread(target=self.serve_forever, name="smtp-sink", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class _SMTPSinkHandler(socketserver.StreamRequestHandler):
+
+    def _reply(self, line: str) -> None:
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self) -> None:
+        self._reply("220 localhost SMTP sink ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line.decode(errors="replace").strip().split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self._reply("250-localhost")
+                self._reply("250 AUTH PLAIN LOGIN")
+            elif verb == "HELO":
+                self._reply("250 localhost")
+            elif verb == "AUTH":
+                self._reply("235 Authentication successful")
+            elif verb in ["MAIL", "RCPT", "RSET", "NOOP"]:
+                self._reply("250 OK")
+            elif verb == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                for data_line in self.rfile:
+                    if data_line in [b".\r\n", b".\n"]:
+                        break
+                    lines.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                self.server.messages.append(email.message_from_bytes(b"".join(lines), policy=email.policy.default))
+                self._reply("250 OK: queued")
+            elif verb == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("502 Command not implemented")
+
+
 def send_email(subject: str, body: str, to_email: str):
     """Sends an email using Gmail's SMTP server.
 
@@ -255,20 +1066,17 @@ def send_email(subject: str, body: str, to_email: str):
         A success message if the email is sent successfully.
         An error message if there is an issue sending the email.
     """
-    msg = EmailMessage()
-    msg.set_content(body)
-    msg['Subject'] = subject
-    msg['From'] = MAIL_USERNAME
-    msg['To'] = to_email
+    msg = build_email(subject, body, to_email)
 
     try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-            server.login(MAIL_USERNAME, MAIL_PASSWORD)
-            server.send_message(msg)
+        smtp_pool.send(msg)
         print(f"Email sent successfully to {to_email}")
     except Exception as e:
         print(f"Failed to send email to {to_email}: {e}")
 
+
+outbox_worker: Optional[OutboxWorker] = OutboxWorker().start() if EMAIL_OUTBOX_WORKER == "thread" else None
+
 def get_all_doctors() -> list[Doctor]:
     """Retrieves all doctors from the database.
 
@@ -279,6 +1087,14 @@ def get_all_doctors() -> list[Doctor]:
         doctors = session.exec(select(Doctor)).all()
         return doctors
 
+async def aget_all_doctors() -> list[Doctor]:
+    """
+    Async twin of get_all_doctors.
+    """
+    async with async_session() as session:
+        doctors = (await session.exec(select(Doctor))).all()
+        return doctors
+
 
 # CRUD Operations for Appointments
 
@@ -295,6 +1111,14 @@ def get_appointment(appointment_id: int) -> Optional[Appointment]:
         appointment = session.exec(select(Appointment).where(Appointment.id == appointment_id)).first()
         return appointment
 
+async def aget_appointment(appointment_id: int) -> Optional[Appointment]:
+    """
+    Async twin of get_appointment.
+    """
+    async with async_session() as session:
+        appointment = (await session.exec(select(Appointment).where(Appointment.id == appointment_id))).first()
+        return appointment
+
 
 
 
@@ -335,6 +1159,24 @@ def update_notification_status(appointment_id: int, send_notification: bool):
             "send_notification": appointment.send_notification,
         }
 
+async def aupdate_notification_status(appointment_id: int, send_notification: bool):
+    """
+    Async twin of update_notification_status.
+    """
+    async with async_session() as session:
+        appointment = await session.get(Appointment, appointment_id)
+        if not appointment:
+            raise ValueError("Appointment not found.")
+
+        appointment.send_notification = send_notification
+        session.add(appointment)
+        await session.commit()
+
+        return {
+            "appointment_id": appointment.id,
+            "send_notification": appointment.send_notification,
+        }
+
 
 # Tools with interup-------
 
@@ -386,42 +1228,6 @@ def update_notification_status(appointment_id: int, send_notification: bool):
 
 #     return notification_status
 
-def book_appointment(data: Appointment) -> Optional[Dict[str, Any]]:
-    """
-    Creates an appointment entry in the database and triggers a confirmation process.
-    """
-    with Session(engine) as session:  
-        # Validate email (optional enhancement)
-# patient_name: str  # Patient's name
-#     patient_email: str
-        # Insert appointment into the database
-        appointment = Appointment(
-            doctor_id=data.doctor_id,
-            patient_name=data.patient_name,
-            date=data.date,
-            time=data.time,
-            status=data.status or "Booked",
-            patient_email=data.patient_email,
-            send_notification=False  # Default to False initially
-        )
-        session.add(appointment)
-        session.commit()
-        session.refresh(appointment)
-
-        # Trigger the NodeInterrupt for confirmation
-        print("Raising NodeInterrupt; waiting for confirmation.")
-        notification_status = interrupt("Do you want me to send email notification? yes/no")
-
-        if notification_status == "yes":
-            appointment.send_notification = True
-            session.add(appointment)
-            session.commit()
-
-        return {"appointment_id": appointment.id, "notification_status": appointment.send_notification}
-
-
-
-
 def handle_appointment_confirmation(appointment_id: int, notification_status: bool) -> Optional[Dict[str, Any]]:
     """
     Sends an email notification for an appointment if the user confirms the notification status.
@@ -445,17 +1251,20 @@ def handle_appointment_confirmation(appointment_id: int, notification_status: bo
         # Step 2: Update the `send_notification` field based on input
         appointment.send_notification = notification_status
         session.add(appointment)
-        session.commit()
 
-        # Step 3: Handle email notification if confirmed
+        # Step 3: Queue the email notification if confirmed; the outbox worker delivers it
         if notification_status:
-            doctor_name = get_doctor(appointment.doctor_id)['name']
-            send_email(
+            doctor = session.get(Doctor, appointment.doctor_id)
+            enqueue_email(
+                session,
                 "Appointment Confirmation",
-                f"Your appointment with Dr. {doctor_name} on {appointment.date} at {appointment.time} is confirmed.",
+                f"Your appointment with Dr. {doctor.name} on {appointment.date} at {appointment.time} is confirmed.",
                 appointment.patient_email,
             )
-            print(f"Email notification sent to {appointment.patient_email}")
+        session.commit()
+
+        if notification_status:
+            print(f"Email notification queued for {appointment.patient_email}")
             return {
                 "appointment_id": appointment.id,
                 "status": appointment.status,
@@ -465,27 +1274,110 @@ def handle_appointment_confirmation(appointment_id: int, notification_status: bo
             print("Email notification skipped as per the user's request.")
             return None
 
+async def ahandle_appointment_confirmation(appointment_id: int, notification_status: bool) -> Optional[Dict[str, Any]]:
+    """
+    Async twin of handle_appointment_confirmation.
+    """
+    async with async_session() as session:
+        appointment = await session.get(Appointment, appointment_id)
+        if not appointment:
+            raise ValueError("Appointment not found.")
+
+        appointment.send_notification = notification_status
+        session.add(appointment)
+
+        if notification_status:
+            doctor = await session.get(Doctor, appointment.doctor_id)
+            enqueue_email(
+                session,
+                "Appointment Confirmation",
+                f"Your appointment with Dr. {doctor.name} on {appointment.date} at {appointment.time} is confirmed.",
+                appointment.patient_email,
+            )
+        await session.commit()
+
+        if notification_status:
+            print(f"Email notification queued for {appointment.patient_email}")
+            return {
+                "appointment_id": appointment.id,
+                "status": appointment.status,
+                "send_notification": appointment.send_notification,
+            }
+        else:
+            print("Email notification skipped as per the user's request.")
+            return None
+
+
+# Upper bound on tool calls from a single assistant turn that run at the same time.
+# Each call still opens its own Session, so this also caps DB connections per turn.
+TOOL_MAX_CONCURRENCY = int(os.getenv("TOOL_MAX_CONCURRENCY", "8"))
+
+# One semaphore per tools-node run, keyed by its checkpoint namespace ("tools:<task id>").
+# Entries drop out once the run's last call finishes, so conversations never share one.
+_tool_semaphores: "weakref.WeakValueDictionary[str, asyncio.Semaphore]" = weakref.WeakValueDictionary()
+
+
+def bounded(coroutine):
+    """
+    Wraps a tool coroutine so at most TOOL_MAX_CONCURRENCY calls from the same
+    assistant turn run at once. Calls made outside a graph run are not limited.
+    """
+    @functools.wraps(coroutine)
+    async def wrapper(*args, **kwargs):
+        try:
+            turn = get_config()["metadata"]["checkpoint_ns"]
+        except (RuntimeError, KeyError):
+            return await coroutine(*args, **kwargs)
+        semaphore = _tool_semaphores.get(turn)
+        if semaphore is None:
+            semaphore = _tool_semaphores[turn] = asyncio.Semaphore(TOOL_MAX_CONCURRENCY)
+        async with semaphore:
+            return await coroutine(*args, **kwargs)
+    return wrapper
+
+
+def threaded(func):
+    """
+    Runs a sync tool on a worker thread, for when there is no async engine.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await asyncio.to_thread(func, *args, **kwargs)
+    return wrapper
+
+
+def make_tool(func, coroutine) -> StructuredTool:
+    """
+    Builds a tool from a sync function and its async twin.
+    """
+    if shared_pool:
+        coroutine = threaded(func)
+    return StructuredTool.from_function(func=func, coroutine=bounded(coroutine))
+
 
 # Tool calling
 # # Define the tools for CRUD operations
+# Each tool carries its sync function and its async twin; ToolNode runs the
+# coroutine when the graph is driven asynchronously (as under the LangGraph server).
+# Independent tool calls from one AIMessage fan out concurrently: gathered on the
+# event loop in async mode, on a thread pool in sync mode, both capped at
+# TOOL_MAX_CONCURRENCY.
 tools=[
-       add_doctor,
-       get_doctor,
-       update_doctor,
-       delete_doctor,
-    #    book_appointment,
-       update_notification_status
-       ,
-       
-       handle_appointment_confirmation,
-       get_appointments_by_user,
-       get_appointments_by_patient_name,
-       update_appointment,
-       delete_appointment,
+       make_tool(add_doctor, aadd_doctor),
+       make_tool(get_doctor, aget_doctor),
+       make_tool(update_doctor, aupdate_doctor),
+       make_tool(delete_doctor, adelete_doctor),
+       make_tool(update_notification_status, aupdate_notification_status),
+
+       make_tool(handle_appointment_confirmation, ahandle_appointment_confirmation),
+       make_tool(get_appointments_by_user, aget_appointments_by_user),
+       make_tool(get_appointments_by_patient_name, aget_appointments_by_patient_name),
+       make_tool(update_appointment, aupdate_appointment),
+       make_tool(delete_appointment, adelete_appointment),
       #  send_email,
-       get_all_doctors,
-       get_appointment,
-  
+       make_tool(get_all_doctors, aget_all_doctors),
+       make_tool(get_appointment, aget_appointment),
+
        ]
 
 
@@ -597,7 +1489,7 @@ def assistant(state: State_Update) -> State_Update:
 # Build graph
 builder: StateGraph = StateGraph(State_Update)
 builder.add_node("assistant", assistant)
-builder.add_node("tools", ToolNode(tools))
+builder.add_node("tools", ToolNode(tools).with_config(max_concurrency=TOOL_MAX_CONCURRENCY))
 builder.add_edge(START, "assistant")
 builder.add_conditional_edges(
     "assistant",
@@ -608,7 +1500,36 @@ builder.add_conditional_edges(
 builder.add_edge("tools", "assistant")
 
 # Compile graph
-# graph: CompiledStateGraph = builder.compile(checkpointer=memory)
 graph: CompiledStateGraph = builder.compile(checkpointer=checkpointer)
 
 
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Doctor appointment system maintenance commands.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("outbox-worker", help="Drain the email outbox in the foreground.")
+    backfill = commands.add_parser("backfill-start-times", help="Parse legacy date/time strings into Appointment.start_time.")
+    backfill.add_argument("--batch-size", type=int, default=500)
+    smtp_sink = commands.add_parser("smtp-sink", help="Run a local SMTP stand-in that prints what it receives.")
+    smtp_sink.add_argument("--port", type=int, default=1025)
+    args = parser.parse_args()
+
+    if args.command == "outbox-worker":
+        if outbox_worker is not None:
+            outbox_worker.stop()
+        OutboxWorker().run()
+    elif args.command == "backfill-start-times":
+        result = backfill_appointment_start_times(args.batch_size)
+        print(f"Updated {result['updated']} rows; could not parse {len(result['unparsed'])}: {result['unparsed']}")
+    elif args.command == "smtp-sink":
+        sink = LocalSMTPSink(port=args.port).start()
+        print(f"SMTP sink listening on 127.0.0.1:{sink.port} (use SMTP_SSL=false)")
+        seen = 0
+        while True:
+            time.sleep(1)
+            for message in sink.messages[seen:]:
+                print(f"To: {message['To']} | Subject: {message['Subject']}")
+            seen = len(sink.messages)
@@ -0,0 +1,21 @@
+import os
+import sys
+
+# studio3 opens its Postgres checkpointer and shared pool at import time, so these
+# tests need a scratch Postgres database. Set STUDIO3_TEST_DATABASE_URL to run them.
+_database = os.getenv("STUDIO3_TEST_DATABASE_URL")
+collect_ignore_glob = [] if _database else ["test_*.py"]
+if _database:
+    os.environ.update({
+        "DATABASE_URL": _database,
+        "DB_URL": _database,
+        "SHARED_DB_POOL": "true",
+        "DB_POOL_SIZE": "2",
+        "DB_MAX_OVERFLOW": "2",
+        "DB_STATEMENT_TIMEOUT_MS": "15000",
+        "MAIL_USERNAME": "clinic@example.com",
+        "MAIL_PASSWORD": "unused",
+        "GOOGLE_API_KEY": "unused",
+        "EMAIL_OUTBOX_WORKER": "off",
+    })
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,29 @@
+from sqlalchemy import text
+
+import doctor_appointment as app
+
+
+def test_same_database_compares_server_database_and_user():
+    assert app.same_database("postgresql://u@db:5432/clinic", "postgresql+psycopg://u:secret@db:5432/clinic")
+    assert app.same_database("postgresql://u@/clinic?host=/tmp/pg", "postgresql://u@/clinic?host=/tmp/pg")
+    assert not app.same_database("postgresql://u@db/clinic", "postgresql://u@db/checkpoints")
+    assert not app.same_database("postgresql://u@db/clinic", "postgresql://other@db/clinic")
+    assert not app.same_database("postgresql://u@/clinic?host=/tmp/a", "postgresql://u@/clinic?host=/tmp/b")
+
+
+def test_engine_and_checkpointer_share_one_pool():
+    assert app.shared_pool is not None
+    assert app.pool is app.shared_pool.pool
+    assert app.async_engine is None  # no second pool for the tool coroutines
+
+
+def test_engine_connections_go_back_to_the_pool_ready_for_the_checkpointer():
+    before = app.shared_pool.stats().get("requests_num", 0)
+    with app.engine.connect() as connection:
+        assert connection.execute(text("SHOW statement_timeout")).scalar() == "15s"
+        connection.execute(text("SELECT 1"))
+    assert app.shared_pool.stats()["requests_num"] == before + 1
+
+    with app.pool.connection() as connection:
+        assert connection.autocommit  # reset for the checkpointer after SQLAlchemy's transaction
+    assert app.checkpointer.get_tuple({"configurable": {"thread_id": "shared-pool-test"}}) is None